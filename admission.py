@@ -0,0 +1,178 @@
+# admission.py
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, g, jsonify, request
+from flask_jwt_extended import decode_token
+
+from identity import principal_kind
+
+# KEYS[1] = bucket, ARGV = rate, burst, cost. Returns the seconds to wait, 0 when admitted.
+# Redis' clock is used, so workers on different hosts agree on the refill.
+TOKEN_BUCKET_SCRIPT = '''
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local rate, burst, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+local tokens = tonumber(state[1]) or burst
+local at = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - at) * rate)
+local wait = 0
+if tokens >= cost then tokens = tokens - cost else wait = (cost - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'at', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(wait)
+'''
+
+
+class LocalBuckets:
+    # bucket key -> [tokens, refilled at], the least recently used dropped past maxsize.
+    # A dropped bucket starts full again, which only matters for callers idle long enough to refill anyway.
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost=1):
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [burst, now]
+                if len(self.buckets) > self.maxsize:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                return 0.0
+            return (cost - bucket[0]) / rate
+
+
+class RedisBuckets:
+    # One hash per bucket, shared by every worker, updated by a script so a take is atomic
+
+    def __init__(self, url, prefix='admission:'):
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self.script = self.redis.register_script(TOKEN_BUCKET_SCRIPT)
+        self.prefix = prefix
+
+    def take(self, key, rate, burst, cost=1):
+        return float(self.script(keys=[self.prefix + key], args=[rate, burst, cost]))
+
+
+class AdmissionControl:
+    # Runs before any view, so rejected requests never touch the database. Each caller gets a
+    # token bucket per endpoint in ADMISSION_RATE_LIMITS ({endpoint: (per second, burst)}), keyed
+    # on the access token's identity, or on the client address without a valid token. The
+    # ADMISSION_HEAVY_ENDPOINTS share ADMISSION_MAX_CONCURRENT slots per process, so they never
+    # hold the whole connection pool.
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ADMISSION_ENABLED', True)
+        app.config.setdefault('ADMISSION_BACKEND', 'local')
+        app.config.setdefault('ADMISSION_URL', None)
+        app.config.setdefault('ADMISSION_MAX_KEYS', 100000)
+        app.config.setdefault('ADMISSION_RATE_LIMITS', {})
+        app.config.setdefault('ADMISSION_HEAVY_ENDPOINTS', ())
+        app.config.setdefault('ADMISSION_MAX_CONCURRENT', 10)
+        app.config.setdefault('ADMISSION_RETRY_AFTER', 1)
+        self.reset(app)
+        if app.config['ADMISSION_ENABLED']:
+            app.before_request(self.admit)
+            app.teardown_request(self.release)
+
+    def reset(self, app):
+        app.extensions['admission'] = {'buckets': None, 'lock': threading.Lock(),
+                                       'slots': threading.BoundedSemaphore(app.config['ADMISSION_MAX_CONCURRENT'])}
+
+    @property
+    def buckets(self):
+        # Created on first use, so redis is only imported and connected once a request needs it
+        state = current_app.extensions['admission']
+        if state['buckets'] is None:
+            with state['lock']:
+                if state['buckets'] is None:
+                    state['buckets'] = self.build(current_app.config)
+        return state['buckets']
+
+    def build(self, config):
+        if config['ADMISSION_BACKEND'] == 'redis':
+            return RedisBuckets(config['ADMISSION_URL'])
+        return LocalBuckets(config['ADMISSION_MAX_KEYS'])
+
+    def caller(self):
+        # Batch sub-requests carry the claims the batch verified. Otherwise only the signature
+        # and expiry are checked here; the caller is loaded later by @jwt_required.
+        claims = g.get('_jwt_extended_jwt')
+        kind, _, token = request.headers.get('Authorization', '').partition(' ')
+        if not claims and kind.lower() == 'bearer' and token:
+            try:
+                claims = decode_token(token)
+            except Exception:
+                pass
+        if claims:
+            kind = principal_kind(claims.get('user_type'))
+            if kind is not None:
+                return '{}:{}'.format(kind, claims[current_app.config['JWT_IDENTITY_CLAIM']])
+        return 'addr:{}'.format(request.remote_addr)
+
+    def limit(self):
+        # A 429 response when the caller's bucket for the current endpoint is empty, else None.
+        config = current_app.config
+        if not config['ADMISSION_ENABLED']:
+            return None
+        limit = config['ADMISSION_RATE_LIMITS'].get(request.endpoint)
+        if limit is None:
+            return None
+        rate, burst = limit
+        try:
+            wait = self.buckets.take('{}:{}'.format(request.endpoint, self.caller()), rate, burst)
+        except Exception:
+            # A shared backend that is down must not take the API with it
+            current_app.logger.exception('Admission backend failed, admitting the request')
+            return None
+        if wait:
+            return self.reject(429, 'Too many requests', wait)
+        return None
+
+    def admit(self):
+        # Also called by BatchRunner for each sub-request, which does not run before_request
+        config = current_app.config
+        if not config['ADMISSION_ENABLED']:
+            return None
+        endpoint = request.endpoint
+        rejected = self.limit()
+        if rejected is not None:
+            return rejected
+
+        if endpoint in config['ADMISSION_HEAVY_ENDPOINTS']:
+            if not current_app.extensions['admission']['slots'].acquire(blocking=False):
+                return self.reject(503, 'Server busy, retry shortly', config['ADMISSION_RETRY_AFTER'])
+            # On the request, not g: batch sub-requests share g and tear down on their own
+            request.environ['admission.slot'] = True
+
+    def release(self, exc=None):
+        # Teardown runs once the response is sent, after streamed bodies too
+        if request.environ.pop('admission.slot', False):
+            current_app.extensions['admission']['slots'].release()
+
+    def reject(self, status, error, retry_after):
+        response = jsonify({'msg': '', 'error': error})
+        response.status_code = status
+        response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+        return response
+
+
+admission = AdmissionControl()
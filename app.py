@@ -1,22 +1,104 @@
 # app.py
-from datetime import datetime, timedelta
+import os
+import weakref
+from datetime import date, datetime, timedelta
 
-from flask import Flask, request, jsonify
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
+from flask import Blueprint, Flask, current_app, request, jsonify
+from flask_jwt_extended import JWTManager, create_access_token, get_jwt_identity
 # from flask_cors import CORS
 
+from admission import admission
+from batch import batch_runner, jwt_required, parse_batch
+from cache import catalog_cache, menu_namespace
 from config import Config
-from models import db, User, Restaurant, Dish, DeliveryPartner, Order, DishesOrdered
-from services import create_user
-
-app = Flask(__name__)
-app.config.from_object(Config)
-db.init_app(app)
-jwt = JWTManager(app)
-# CORS(app)
-
-
-@app.route('/register/user', methods=['POST'])
+import archive
+import migrations
+import rollups
+from dispatch import dispatcher
+from events import event_hub, order_event
+import idempotency
+from idempotency import idempotent
+from identity import identity_cache, principal_kind
+from menu_import import menu_importer
+from metrics import metrics
+from nearby import nearby_restaurants
+from opening_hours import open_restaurants, week_intervals
+from passwords import passwords
+from models import db, User, Restaurant, Dish, DeliveryPartner, Order, DishesOrdered, TERMINAL_ORDER_STATUSES
+from search import search_index
+from pagination import page_args, keyset_page, stream_orders
+from routing import db_router, replica_reads
+import serializers
+from serializers import (fields_arg, restaurant_listing, restaurant_summary, restaurant_detail, dish_listing,
+                         ordered_dish, user_profile, user_contact, partner_contact, order_summary,
+                         restaurant_order, delivery_partner_order, user_order)
+from services import archived_order_history_query, create_user, order_history_query, place_order
+
+api = Blueprint('api', __name__)
+jwt = JWTManager()
+
+@jwt.user_lookup_loader
+def load_principal(jwt_header, jwt_data):
+    # The caller as a cached Principal (flask_jwt_extended.current_user); tokens without a
+    # known user_type, or naming a principal that no longer exists, are rejected with 401
+    kind = principal_kind(jwt_data.get('user_type'))
+    if kind is None:
+        return None
+    return identity_cache.get(kind, jwt_data[current_app.config['JWT_IDENTITY_CLAIM']])
+
+
+# Every app built by create_app, so a forked worker can drop what it inherited
+instances = weakref.WeakSet()
+
+
+def create_app(config=Config):
+    # Nothing here connects or builds an index: engines connect, and the catalog cache,
+    # event broker, dispatch, nearby and search indexes are built, on first use
+    app = Flask(__name__)
+    app.config.from_object(config)
+    db_router.init_app(app)
+    db.init_app(app)
+    jwt.init_app(app)
+    identity_cache.init_app(app)
+    batch_runner.init_app(app)
+    menu_importer.init_app(app)
+    catalog_cache.init_app(app)
+    dispatcher.init_app(app)
+    nearby_restaurants.init_app(app)
+    open_restaurants.init_app(app)
+    search_index.init_app(app)
+    event_hub.init_app(app)
+    serializers.init_app(app)
+    metrics.init_app(app)
+    admission.init_app(app)
+    passwords.init_app(app)
+    archive.init_app(app)
+    idempotency.init_app(app)
+    migrations.init_app(app)
+    rollups.init_app(app)
+    # CORS(app)
+    app.register_blueprint(api)
+    instances.add(app)
+    return app
+
+
+def after_fork():
+    # In a worker forked from a preloaded parent (gunicorn --preload) the pooled connections
+    # and Redis clients are the parent's. Drop them without closing, the parent still owns the sockets.
+    for app in list(instances):
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
+        catalog_cache.reset(app)
+        event_hub.reset(app)
+        admission.reset(app)
+        passwords.reset(app)
+
+
+os.register_at_fork(after_in_child=after_fork)
+
+
+@api.route('/register/user', methods=['POST'])
 def signup():
     data = request.json
     name = data.get('name')
@@ -28,11 +110,14 @@ def signup():
 
     if not name or not username or not password:
         return jsonify({'error': 'Name, username, and password are required.'}), 400
+    if not isinstance(password, str):
+        return jsonify({'error': 'Password must be a string.'}), 400
 
     existing_user = User.query.filter_by(username=username).first()
     if existing_user:
         return jsonify({'msg': '', 'error': 'Username is already taken'}), 400
 
+    password = passwords.hash(password)
     try:
         create_user(name, username, password, address, mobile, user_type)
         return jsonify({'msg': 'User created successfully.', 'error': ''}), 201
@@ -40,7 +125,7 @@ def signup():
         return jsonify({'msg': 'Error in creating user', 'error': str(e)}), 500
 
 
-@app.route('/login', methods=['POST'])
+@api.route('/login', methods=['POST'])
 def login():
     data = request.json
     username = data.get('username')
@@ -50,6 +135,8 @@ def login():
 
     if not username or not password:
         return jsonify({'error': 'Username and password are required.'}), 400
+    if not isinstance(password, str):
+        return jsonify({'error': 'Password must be a string.'}), 400
 
     if user_type == "RESTAURANT":
         user = Restaurant.query.filter_by(username=username).first()
@@ -60,11 +147,17 @@ def login():
         if user:
             membership_type = user.type
 
-    if not user or not user.password:
+    matches, new_hash = passwords.verify(user.password if user else None, password)
+    if not matches:
         return jsonify({'error': 'Invalid username or password.'}), 401
+    if new_hash:
+        # Plaintext or an older cost, stored with the current method from now on
+        user.password = new_hash
+        db.session.commit()
 
-    # Generate JWT token
-    access_token = create_access_token(identity=user.id, expires_delta=timedelta(hours=24))
+    # Generate JWT token; any other user_type signed in from the users table above
+    access_token = create_access_token(identity=user.id, expires_delta=timedelta(hours=24),
+                                       additional_claims={'user_type': principal_kind(user_type) or 'USER'})
     return jsonify({
         'user_token': access_token,
         'user_details': {
@@ -75,7 +168,7 @@ def login():
         }}), 200
 
 
-@app.route('/register/restaurant', methods=['POST'])
+@api.route('/register/restaurant', methods=['POST'])
 @jwt_required()
 def register_restaurant():
     data = request.json
@@ -88,10 +181,18 @@ def register_restaurant():
     cuisine = data.get('cuisine')
     open_time = data.get('open_time')
     close_time = data.get('close_time')
+    latitude = data.get('latitude')
+    longitude = data.get('longitude')
 
     # Check if all required fields are present
     if not username or not password or not name or not mobile or not address or not cuisine or not open_time or not close_time:
         return jsonify({'msg': '', 'error': 'All fields are required'}), 400
+    if not isinstance(password, str):
+        return jsonify({'msg': '', 'error': 'password must be a string'}), 400
+    try:
+        week_intervals(open_time, close_time)
+    except ValueError:
+        return jsonify({'msg': '', 'error': 'open_time and close_time must be times like 9:00 AM'}), 400
 
     # Check if the username is already taken
     existing_restaurant = Restaurant.query.filter_by(username=username).first()
@@ -101,24 +202,30 @@ def register_restaurant():
     # Create a new restaurant instance
     new_restaurant = Restaurant(
         username=username,
-        password=password,
+        password=passwords.hash(password),
         name=name,
         mobile=mobile,
         address=address,
         image_url=image_url,
         cuisine=cuisine,
         open_time=open_time,
-        close_time=close_time
+        close_time=close_time,
+        latitude=latitude,
+        longitude=longitude
     )
 
     # Add the restaurant to the database
     db.session.add(new_restaurant)
     db.session.commit()
+    catalog_cache.invalidate('restaurants')
+    nearby_restaurants.refresh(new_restaurant)
+    open_restaurants.refresh(new_restaurant)
+    search_index.add_restaurant(new_restaurant)
 
     return jsonify({'msg': 'Restaurant registered successfully', 'error': ''}), 201
 
 
-@app.route('/register/delivery-partner', methods=['POST'])
+@api.route('/register/delivery-partner', methods=['POST'])
 def register_delivery_partner():
     data = request.json
     username = data.get('username')
@@ -129,6 +236,8 @@ def register_delivery_partner():
     # Check if all required fields are present
     if not username or not password or not name or not mobile:
         return jsonify({'msg': '', 'error': 'All fields are required'}), 400
+    if not isinstance(password, str):
+        return jsonify({'msg': '', 'error': 'password must be a string'}), 400
 
     # Check if the username is already taken
     existing_delivery_partner = DeliveryPartner.query.filter_by(username=username).first()
@@ -138,7 +247,7 @@ def register_delivery_partner():
     # Create a new delivery partner instance
     new_delivery_partner = DeliveryPartner(
         username=username,
-        password=password,
+        password=passwords.hash(password),
         name=name,
         mobile=mobile
     )
@@ -150,33 +259,94 @@ def register_delivery_partner():
     return jsonify({'msg': 'Delivery partner registered successfully', 'error': ''}), 201
 
 
-@app.route('/restaurants', methods=['GET'])
+@api.route('/restaurants', methods=['GET'])
 @jwt_required()
+@replica_reads
 def get_restaurants():
     current_user_id = get_jwt_identity()
     # You can use current_user_id to fetch user details if needed
 
-    # Get all restaurant lists
-    restaurants = Restaurant.query.order_by(Restaurant.id.asc()).all()
-    restaurant_list = [{"id": restaurant.id,
-                        "name": restaurant.name,
-                        "mobile": restaurant.mobile,
-                        "address": restaurant.address,
-                        "image_url": restaurant.image_url,
-                        "reviews": restaurant.reviews,
-                        "distance": restaurant.distance,
-                        "expected_delivery_time": restaurant.expected_delivery_time,
-                        "cuisine": restaurant.cuisine,
-                        "open_time": restaurant.open_time,
-                        "close_time": restaurant.close_time,
-                        "rating": restaurant.rating,
-                        "offers": restaurant.offers}
-                       for restaurant in restaurants]
+    fields = fields_arg()
+    serialize = restaurant_listing.only(fields)
+    variant = fields and ','.join(fields)
+
+    if request.args.get('open_now') in ('1', 'true'):
+        # Every minute of one segment has the same restaurants open, so it shares one cache entry
+        segment, open_ids = open_restaurants.open_at(open_restaurants.now())
+        variant = 'open:{}'.format(segment) + (':' + variant if variant else '')
+
+        def build():
+            restaurants = (Restaurant.query.filter(Restaurant.id.in_(open_ids)).order_by(Restaurant.id.asc()).all()
+                           if open_ids else [])
+            return {'restaurants': [serialize(restaurant) for restaurant in restaurants]}
+    else:
+        def build():
+            # Get all restaurant lists
+            restaurants = Restaurant.query.order_by(Restaurant.id.asc()).all()
+            return {'restaurants': [serialize(restaurant) for restaurant in restaurants]}
+
+    # Served from the catalog cache until a restaurant is registered or updated
+    return catalog_cache.response('restaurants', build, variant)
+
+
+@api.route('/restaurants/nearby', methods=['GET'])
+@jwt_required()
+def get_nearby_restaurants():
+    config = current_app.config
+    lat = request.args.get('lat', type=float)
+    lng = request.args.get('lng', type=float)
+    radius = request.args.get('radius', config['NEARBY_DEFAULT_RADIUS_KM'], type=float)
+    limit = request.args.get('limit', config['NEARBY_DEFAULT_LIMIT'], type=int)
+
+    if lat is None or lng is None or not -90 <= lat <= 90 or not -180 <= lng <= 180:
+        return jsonify({'msg': '', 'error': 'Valid lat and lng are required'}), 400
+    if radius <= 0 or limit < 1:
+        return jsonify({'msg': '', 'error': 'radius and limit must be positive'}), 400
+
+    # Served from the in-memory grid, distances are computed for this request
+    matches = nearby_restaurants.search(lat, lng, min(radius, config['NEARBY_MAX_RADIUS_KM']),
+                                        min(limit, config['NEARBY_MAX_LIMIT']))
+    restaurant_list = [dict(listing, distance='{:.1f} km'.format(distance), distance_km=round(distance, 3))
+                       for distance, listing in matches]
 
     return jsonify({'restaurants': restaurant_list}), 200
 
 
-@app.route('/dishes/<int:restaurant_id>', methods=['POST'])
+@api.route('/search', methods=['GET'])
+@jwt_required()
+def search():
+    config = current_app.config
+    query = request.args.get('q', '').strip()
+    limit = request.args.get('limit', config['SEARCH_DEFAULT_LIMIT'], type=int)
+
+    if not query:
+        return jsonify({'msg': '', 'error': 'Search query is required'}), 400
+    if limit < 1:
+        return jsonify({'msg': '', 'error': 'limit must be positive'}), 400
+
+    # Rank in memory, then load only the matching rows
+    ranked = search_index.search(query, min(limit, config['SEARCH_MAX_LIMIT']))
+    restaurant_ids = [key for score, (kind, key) in ranked if kind == 'restaurant']
+    dish_ids = [key for score, (kind, key) in ranked if kind == 'dish']
+    restaurants = {restaurant.id: restaurant
+                   for restaurant in Restaurant.query.filter(Restaurant.id.in_(restaurant_ids))} if restaurant_ids else {}
+    dishes = {dish.id: dish for dish in Dish.query.filter(Dish.id.in_(dish_ids))} if dish_ids else {}
+
+    results = []
+    for score, (kind, key) in ranked:
+        if kind == 'restaurant' and key in restaurants:
+            results.append({'type': 'restaurant',
+                            'score': round(score, 3),
+                            'restaurant': restaurant_listing(restaurants[key])})
+        elif kind == 'dish' and key in dishes:
+            results.append({'type': 'dish',
+                            'score': round(score, 3),
+                            'dish': dish_listing(dishes[key])})
+
+    return jsonify({'results': results}), 200
+
+
+@api.route('/dishes/<int:restaurant_id>', methods=['POST'])
 @jwt_required()
 def create_dish(restaurant_id):
     current_user_id = get_jwt_identity()
@@ -200,49 +370,57 @@ def create_dish(restaurant_id):
     )
     db.session.add(dish)
     db.session.commit()
+    catalog_cache.invalidate(menu_namespace(restaurant_id))
+    search_index.add_dish(dish)
 
     return jsonify({'msg': 'Dish added successfully'}), 201
 
 
-@app.route('/dishes/<int:restaurant_id>', methods=['GET'])
+@api.route('/dishes/<int:restaurant_id>/import', methods=['POST'])
+@jwt_required()
+def import_dishes(restaurant_id):
+    current_user_id = get_jwt_identity()
+    restaurant = Restaurant.query.filter_by(id=restaurant_id).first()
+    if not restaurant:
+        return jsonify({'msg': '', 'error': 'Restaurant not found'}), 404
+
+    # The body is parsed as it arrives, one row at a time
+    rows = menu_importer.read(request.mimetype, request.stream)
+    if rows is None:
+        return jsonify({'msg': '', 'error': 'Send the menu as NDJSON (application/x-ndjson) or CSV (text/csv)'}), 415
+
+    report = menu_importer.run(restaurant_id, rows)
+    if not report.rows:
+        return jsonify({'msg': '', 'error': 'The upload has no rows'}), 400
+    return jsonify(dict(report.as_dict(), msg='Menu imported')), 200
+
+
+@api.route('/dishes/<int:restaurant_id>', methods=['GET'])
 @jwt_required()
+@replica_reads
 def get_dishes(restaurant_id):
     current_user_id = get_jwt_identity()
+    fields = fields_arg()
+    serialize = dish_listing.only(fields)
+
+    def build():
+        # Fetch dishes for the provided restaurant_id
+        restaurant = Restaurant.query.filter_by(id=restaurant_id).first()
+        if not restaurant:
+            return None
+        dishes = Dish.query.filter_by(restaurant_id=restaurant_id).all()
+
+        return {'dishes': [serialize(dish) for dish in dishes],
+                'restaurant': restaurant_listing(restaurant)}
+
+    # Served from the catalog cache until the menu or the restaurant changes
+    response = catalog_cache.response(menu_namespace(restaurant_id), build, fields and ','.join(fields))
+    if response is None:
+        return jsonify({'msg': '', 'error': 'Restaurant not found'}), 404
+    return response
 
-    # Fetch dishes for the provided restaurant_id
-    dishes = Dish.query.filter_by(restaurant_id=restaurant_id).all()
-    restaurant = Restaurant.query.filter_by(id=restaurant_id).first()
 
-    # Construct response data
-    dish_list = [{
-        'id': dish.id,
-        'name': dish.name,
-        'description': dish.description,
-        'image_url': dish.image_url,
-        'price': dish.price,
-        'rating': dish.rating,
-        'restaurant_id': dish.restaurant_id
-    } for dish in dishes]
-
-    return jsonify({'dishes': dish_list,
-                    'restaurant': {
-                        'id': restaurant.id,
-                        "name": restaurant.name,
-                        "mobile": restaurant.mobile,
-                        "address": restaurant.address,
-                        "image_url": restaurant.image_url,
-                        "reviews": restaurant.reviews,
-                        "distance": restaurant.distance,
-                        "expected_delivery_time": restaurant.expected_delivery_time,
-                        "cuisine": restaurant.cuisine,
-                        "open_time": restaurant.open_time,
-                        "close_time": restaurant.close_time,
-                        "rating": restaurant.rating,
-                        "offers": restaurant.offers
-                    }}), 200
-
-
-@app.route('/dishes/<int:restaurant_id>', methods=['PUT'])
+@api.route('/dishes/<int:restaurant_id>', methods=['PUT'])
 @jwt_required()
 def edit_dish(restaurant_id):
     current_user_id = get_jwt_identity()
@@ -270,58 +448,45 @@ def edit_dish(restaurant_id):
 
     # Commit changes to the database
     db.session.commit()
+    catalog_cache.invalidate(menu_namespace(restaurant_id))
+    search_index.add_dish(dish)
 
     return jsonify({'msg': 'Dish updated successfully'}), 200
 
 
-@app.route('/order_now', methods=['POST'])
+@api.route('/order_now', methods=['POST'])
 @jwt_required()
+@idempotent
 def order_now():
     user_id = get_jwt_identity()
     data = request.json
     restaurant_id = data.get('restaurant_id')
     dish_ids = data.get('dish_ids')
-    total_price = data.get('total_price')
     order_status = data.get('order_status')
     user_type = data.get('user_type')
 
     # Validate if all required fields are present
-    if not restaurant_id or not dish_ids or not total_price:
-        return jsonify({'msg': '', 'error': 'Restaurant ID, dish IDs, and total price are required'}), 400
-
-    if user_type:
-        user = User.query.filter_by(id=user_id).first()
-        user.type = user_type
-        db.session.add(user)
-        db.session.commit()
-
-    # Create a new order instance
-    new_order = Order(
-        restaurant_id=restaurant_id,
-        user_id=user_id,
-        total=total_price,
-        status=order_status
-    )
-
-    # Add the order to the database
-    db.session.add(new_order)
-    db.session.commit()
-
-    for dish_id in dish_ids:
-        dish = Dish.query.get(dish_id)
-        if dish:
-            new_dishes_ordered = DishesOrdered(
-                dish_id=dish_id,
-                order_id=new_order.id
-            )
-            db.session.add(new_dishes_ordered)
+    if not restaurant_id or not dish_ids:
+        return jsonify({'msg': '', 'error': 'Restaurant ID and dish IDs are required'}), 400
 
+    # total_price from the client is ignored, the total comes from current dish prices
+    try:
+        new_order = place_order(user_id, restaurant_id, dish_ids, order_status, user_type)
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'msg': '', 'error': str(e)}), 400
+    response = current_app.make_response((jsonify({'order_id': new_order.id, 'order_status': new_order.status}), 201))
+    # Committed with the order, so a retry with the same Idempotency-Key replays it whatever fails below
+    idempotent.record(response)
     db.session.commit()
+    if user_type:
+        identity_cache.invalidate('USER', user_id)
+    event_hub.publish_order(new_order)
 
-    return jsonify({'order_id': new_order.id, 'order_status': new_order.status}), 201
+    return response
 
 
-@app.route('/restaurants/<int:restaurant_id>', methods=['PUT'])
+@api.route('/restaurants/<int:restaurant_id>', methods=['PUT'])
 @jwt_required()
 def update_restaurant(restaurant_id):
     data = request.json
@@ -330,10 +495,18 @@ def update_restaurant(restaurant_id):
     restaurant = Restaurant.query.get(restaurant_id)
     if not restaurant:
         return jsonify({'msg': '', 'error': 'Restaurant not found'}), 404
+    if data.get('password') and not isinstance(data['password'], str):
+        return jsonify({'msg': '', 'error': 'password must be a string'}), 400
+    if 'open_time' in data or 'close_time' in data:
+        try:
+            week_intervals(data.get('open_time', restaurant.open_time), data.get('close_time', restaurant.close_time))
+        except ValueError:
+            return jsonify({'msg': '', 'error': 'open_time and close_time must be times like 9:00 AM'}), 400
 
     # Update the restaurant details
     restaurant.username = data.get('username', restaurant.username)
-    restaurant.password = data.get('password', restaurant.password)
+    if data.get('password'):
+        restaurant.password = passwords.hash(data['password'])
     restaurant.name = data.get('name', restaurant.name)
     restaurant.mobile = data.get('mobile', restaurant.mobile)
     restaurant.address = data.get('address', restaurant.address)
@@ -341,15 +514,22 @@ def update_restaurant(restaurant_id):
     restaurant.cuisine = data.get('cuisine', restaurant.cuisine)
     restaurant.open_time = data.get('open_time', restaurant.open_time)
     restaurant.close_time = data.get('close_time', restaurant.close_time)
-    restaurant.modified_at = datetime.utcnow()  # Update the modification timestamp
+    restaurant.latitude = data.get('latitude', restaurant.latitude)
+    restaurant.longitude = data.get('longitude', restaurant.longitude)
+    restaurant.modified_at = datetime.now()  # Same clock as the column default, which SearchIndex.sync compares with
 
     # Commit changes to the database
     db.session.commit()
+    catalog_cache.invalidate('restaurants', menu_namespace(restaurant_id))
+    identity_cache.invalidate('RESTAURANT', restaurant_id)
+    nearby_restaurants.refresh(restaurant)
+    open_restaurants.refresh(restaurant)
+    search_index.add_restaurant(restaurant)
 
     return jsonify({'msg': 'Restaurant updated successfully'}), 200
 
 
-@app.route('/delivery_partner/<int:partner_id>', methods=['PUT'])
+@api.route('/delivery_partner/<int:partner_id>', methods=['PUT'])
 @jwt_required()
 def update_delivery_partner(partner_id):
     data = request.json
@@ -358,22 +538,29 @@ def update_delivery_partner(partner_id):
     partner = DeliveryPartner.query.get(partner_id)
     if not partner:
         return jsonify({'msg': '', 'error': 'Delivery partner not found'}), 404
+    if data.get('password') and not isinstance(data['password'], str):
+        return jsonify({'msg': '', 'error': 'password must be a string'}), 400
 
     # Update the delivery partner details
     partner.username = data.get('username', partner.username)
-    partner.password = data.get('password', partner.password)
+    if data.get('password'):
+        partner.password = passwords.hash(data['password'])
     partner.name = data.get('name', partner.name)
     partner.mobile = data.get('mobile', partner.mobile)
     partner.rating = data.get('rating', partner.rating)
-    partner.modified_at = datetime.utcnow()  # Update the modification timestamp
+    partner.latitude = data.get('latitude', partner.latitude)
+    partner.longitude = data.get('longitude', partner.longitude)
+    partner.modified_at = datetime.now()  # Update the modification timestamp
 
     # Commit changes to the database
     db.session.commit()
+    identity_cache.invalidate('DELIVERY_PARTNER', partner_id)
+    dispatcher.update_partner(partner.id, partner.latitude, partner.longitude)
 
     return jsonify({'msg': 'Delivery partner updated successfully'}), 200
 
 
-@app.route('/order/<int:order_id>', methods=['PUT'])
+@api.route('/order/<int:order_id>', methods=['PUT'])
 @jwt_required()
 def update_order_status(order_id):
     data = request.json
@@ -388,292 +575,225 @@ def update_order_status(order_id):
     if not order:
         return jsonify({'msg': '', 'error': 'Order not found'}), 404
 
-    if new_status == 'REST_ACCEPTED':
-        delivery_partner = DeliveryPartner.query.first()
-        order.delivery_partner_id = delivery_partner.id
-
-    # Update the order status
-    order.status = new_status
-    order.modified_at = datetime.utcnow()  # Update the modification timestamp
-
-    # Commit changes to the database
-    db.session.commit()
+    # Assign the nearest free delivery partner to the restaurant
+    assigned_partner_id = None
+    if new_status == 'REST_ACCEPTED' and not order.delivery_partner_id:
+        restaurant = order.restaurant
+        assigned_partner_id = dispatcher.assign(restaurant.latitude, restaurant.longitude)
+        if not assigned_partner_id:
+            return jsonify({'msg': '', 'error': 'No delivery partner available'}), 409
+        order.delivery_partner_id = assigned_partner_id
+
+    # Free the delivery partner once the order is finished
+    releases_partner = (order.delivery_partner_id and new_status in TERMINAL_ORDER_STATUSES
+                        and order.status not in TERMINAL_ORDER_STATUSES)
+
+    # Update the order status and commit, giving back the partner's slot claimed above
+    # if the assignment never reaches the database
+    try:
+        old_status = order.status
+        order.status = new_status
+        order.modified_at = datetime.now()  # Update the modification timestamp
+        rollups.record_status_change(order, old_status)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        if assigned_partner_id:
+            dispatcher.release(assigned_partner_id)
+        raise
+    if releases_partner:
+        dispatcher.release(order.delivery_partner_id)
+    event_hub.publish_order(order)
 
     return jsonify({'order_id': order.id, 'order_status': order.status, 'delivery_partner_id': order.delivery_partner_id}), 200
 
 
-@app.route('/order/<int:order_id>', methods=['GET'])
+@api.route('/order/<int:order_id>', methods=['GET'])
 @jwt_required()
+@replica_reads
 def get_order(order_id):
     user_id = get_jwt_identity()
-    order = Order.query.get(order_id)
+    order = order_history_query(id=order_id).first() or archived_order_history_query(id=order_id).first()
     if not order:
         return jsonify({'status': 'error', 'data': {'msg': '', 'error': 'Order not found'}}), 404
 
-    restaurant = Restaurant.query.filter_by(id=order.restaurant_id).first()
-    dishes_ordered = DishesOrdered.query.filter_by(order_id=order.id).all()
-    dishes = [Dish.query.get(dish_ordered.dish_id) for dish_ordered in dishes_ordered]
-    delivery_partner = DeliveryPartner.query.filter_by(id=order.delivery_partner_id).first()
-    user = User.query.filter_by(id=user_id).first()
-
-    if not delivery_partner:
-        delivery_partner = {'name': "", 'mobile': "", 'rating': ''}
+    user = identity_cache.get('USER', user_id)
 
     response_data = {
-        'restaurant': {
-            'id': restaurant.id,
-            'name': restaurant.name,
-            'distance': restaurant.distance,
-            'mobile': restaurant.mobile,
-            'address': restaurant.address,
-            'rating': restaurant.rating,
-            'image_url': restaurant.image_url,
-            'reviews': restaurant.reviews,
-            'cuisine': restaurant.cuisine,
-            'offers': restaurant.offers,
-            'expected_delivery_time': restaurant.expected_delivery_time,
-            'opens_at': restaurant.open_time,
-            'closes_at': restaurant.close_time,
-        },
-        'user': {
-            'name': user.name,
-            'address': user.address,
-            'mobile': user.mobile,
-            'type': user.type
-        },
-        'order': {
-            'total': order.total,
-            'status': order.status,
-            'order_date': order.created_at,
-            'id': order.id,
-        },
-        # 'delivery_partner': {
-        #     'name': delivery_partner.name,
-        #     'mobile': delivery_partner.mobile,
-        #     'rating': delivery_partner.rating
-        # },
-        'dishes': [{
-            'id': dish.id,
-            'name': dish.name,
-            'description': dish.description,
-            'image_url': dish.image_url,
-            'price': dish.price,
-            'restaurant_id': dish.restaurant_id,
-            'rating': dish.rating,
-        } for dish in dishes]
+        'restaurant': restaurant_detail(order.restaurant),
+        'user': user_profile(user),
+        'order': order_summary(order),
+        'dishes': [ordered_dish(line) for line in order.dishes_ordered]
     }
 
     return jsonify(response_data), 200
 
 
-@app.route('/restaurant/orders/<int:restaurant_id>', methods=['GET'])
+# The two event streams hold their worker for as long as the client listens: serve the app with
+# an async worker (gunicorn -k gevent, gevent is in requirements.txt), or every open stream takes a thread
+@api.route('/order/<int:order_id>/events', methods=['GET'])
 @jwt_required()
+def order_events(order_id):
+    order = Order.query.get(order_id)
+    if not order:
+        return jsonify({'msg': '', 'error': 'Order not found'}), 404
+
+    # Current status first, then every transition as it is published
+    return event_hub.stream(['order:{}'.format(order_id)], [order_event(order)])
+
+
+@api.route('/restaurant/orders/<int:restaurant_id>/events', methods=['GET'])
+@jwt_required()
+def restaurant_order_events(restaurant_id):
+    restaurant = Restaurant.query.get(restaurant_id)
+    if not restaurant:
+        return jsonify({'msg': '', 'error': 'Restaurant not found'}), 404
+
+    # New orders and status transitions for every order of the restaurant
+    return event_hub.stream(['restaurant:{}'.format(restaurant_id)])
+
+
+@api.route('/restaurant/orders/<int:restaurant_id>', methods=['GET'])
+@jwt_required()
+@replica_reads
 def get_orders_by_restaurant(restaurant_id):
     user_id = get_jwt_identity()
 
+    try:
+        limit, after, stream = page_args()
+    except ValueError:
+        return jsonify({'msg': '', 'error': 'Invalid limit or cursor'}), 400
+
     # Fetch the restaurant
-    restaurant = Restaurant.query.get(restaurant_id)
+    restaurant = identity_cache.get('RESTAURANT', restaurant_id)
     if not restaurant:
         return jsonify({'msg': '', 'error': 'Restaurant not found'}), 404
 
-    # Fetch all orders for the given restaurant
-    orders = Order.query.filter_by(restaurant_id=restaurant_id).order_by(Order.created_at.desc()).all()
+    response_data = {'restaurant': restaurant_summary(restaurant)}
+
+    order_data = restaurant_order.only(fields_arg())
+    query = order_history_query(restaurant_id=restaurant_id)
+    archived = archived_order_history_query(restaurant_id=restaurant_id)
+    if stream:
+        return stream_orders(query, after, response_data, order_data, archived)
+
+    # Fetch one page of orders for the given restaurant
+    orders, next_cursor = keyset_page(query, limit, after, archived)
     # if not orders:
         # return jsonify({'msg': '', 'error': 'No orders found for the given restaurant'}), 404
 
+    response_data['orders'] = [order_data(order) for order in orders]
+    response_data['next_cursor'] = next_cursor
 
-    orders_data = []
-    for order in orders:
-        user = User.query.filter_by(id=user_id).first()
-        delivery_partner = DeliveryPartner.query.filter_by(id=order.delivery_partner_id).first()
-        dishes_ordered = DishesOrdered.query.filter_by(order_id=order.id).all()
-        dishes = [Dish.query.get(dish_ordered.dish_id) for dish_ordered in dishes_ordered]
-
-        order_data = {
-            'order': {
-                'total': order.total,
-                'status': order.status,
-                'order_date': order.created_at,
-                'id': order.id,
-            },
-            'user': {
-                'address': user.address,
-                'name': user.name,
-                'mobile': user.mobile,
-                'id': user.id,
-            },
-            'delivery_partner': {
-                'name': delivery_partner.name if delivery_partner else None,
-                'mobile': delivery_partner.mobile if delivery_partner else None,
-                'id': delivery_partner.id if delivery_partner else None
-            },
-            'dishes': [{
-                'id': dish.id,
-                'name': dish.name,
-                'description': dish.description,
-                'image_url': dish.image_url,
-                'price': dish.price,
-                'restaurant_id': dish.restaurant_id,
-            } for dish in dishes]
-        }
-        orders_data.append(order_data)
+    return jsonify(response_data), 200
 
-    response_data = {
-        'restaurant': {
-            'id': restaurant.id,
-            'name': restaurant.name,
-            'distance': restaurant.distance,
-            'mobile': restaurant.mobile,
-            'address': restaurant.address,
-            'rating': restaurant.rating,
-            'image_url': restaurant.image_url,
-            'expected_delivery_time': restaurant.expected_delivery_time,
-            'opens_at': restaurant.open_time,
-            'closes_at': restaurant.close_time
-        },
-        'orders': orders_data
-    }
 
+@api.route('/restaurant/analytics/<int:restaurant_id>', methods=['GET'])
+@jwt_required()
+@replica_reads
+def get_restaurant_analytics(restaurant_id):
+    config = current_app.config
+    try:
+        end = date.fromisoformat(request.args['to']) if 'to' in request.args else date.today()
+        start = (date.fromisoformat(request.args['from']) if 'from' in request.args
+                 else end - timedelta(days=config['ANALYTICS_DEFAULT_DAYS'] - 1))
+    except ValueError:
+        return jsonify({'msg': '', 'error': 'from and to must be YYYY-MM-DD dates'}), 400
+    if start > end or (end - start).days >= config['ANALYTICS_MAX_DAYS']:
+        return jsonify({'msg': '', 'error': 'from must be before to, at most {} days apart'.format(
+            config['ANALYTICS_MAX_DAYS'])}), 400
+    top = min(max(request.args.get('top', config['ANALYTICS_TOP_DISHES'], type=int), 0), 50)
+
+    restaurant = identity_cache.get('RESTAURANT', restaurant_id)
+    if not restaurant:
+        return jsonify({'msg': '', 'error': 'Restaurant not found'}), 404
+
+    # Daily counters kept by order_now and update_order_status, not the orders themselves
+    response_data = {'restaurant': restaurant_summary(restaurant), 'from': start.isoformat(), 'to': end.isoformat()}
+    response_data.update(rollups.restaurant_sales(restaurant_id, start, end, top))
     return jsonify(response_data), 200
 
 
-@app.route('/delivery_partner/orders/<int:delivery_partner_id>', methods=['GET'])
+@api.route('/delivery_partner/orders/<int:delivery_partner_id>', methods=['GET'])
 @jwt_required()
+@replica_reads
 def get_orders_by_delivery_partner(delivery_partner_id):
     user_id = get_jwt_identity()
 
+    try:
+        limit, after, stream = page_args()
+    except ValueError:
+        return jsonify({'msg': '', 'error': 'Invalid limit or cursor'}), 400
+
     # Fetch the delivery partner
-    delivery_partner = DeliveryPartner.query.get(delivery_partner_id)
+    delivery_partner = identity_cache.get('DELIVERY_PARTNER', delivery_partner_id)
     if not delivery_partner:
         return jsonify({'msg': '', 'error': 'Delivery partner not found'}), 404
 
-    # Fetch all orders for the given delivery partner
-    orders = Order.query.filter_by(delivery_partner_id=delivery_partner_id).order_by(Order.created_at.desc()).all()
-    if not orders:
-        return jsonify({'msg': '', 'error': 'No orders found for the delivery partner'}), 404
+    response_data = {'delivery_partner': partner_contact(delivery_partner)}
 
-    orders_data = []
-    for order in orders:
-        user = User.query.filter_by(id=user_id).first()
-        restaurant = Restaurant.query.filter_by(id=order.restaurant_id).first()
-        dishes_ordered = DishesOrdered.query.filter_by(order_id=order.id).all()
-        dishes = [Dish.query.get(dish_ordered.dish_id) for dish_ordered in dishes_ordered]
-
-        order_data = {
-            'order': {
-                'total': order.total,
-                'status': order.status,
-                'order_date': order.created_at,
-                'id': order.id,
-            },
-            'user': {
-                'address': user.address,
-                'name': user.name,
-                'mobile': user.mobile,
-                'id': user.id,
-            },
-            'restaurant': {
-                'id': restaurant.id,
-                'name': restaurant.name,
-                'distance': restaurant.distance,
-                'mobile': restaurant.mobile,
-                'address': restaurant.address,
-                'rating': restaurant.rating,
-                'image_url': restaurant.image_url,
-                'expected_delivery_time': restaurant.expected_delivery_time,
-                'opens_at': restaurant.open_time,
-                'closes_at': restaurant.close_time
-            },
-            'dishes': [{
-                'id': dish.id,
-                'name': dish.name,
-                'description': dish.description,
-                'image_url': dish.image_url,
-                'price': dish.price,
-                'restaurant_id': dish.restaurant_id,
-            } for dish in dishes]
-        }
-        orders_data.append(order_data)
+    order_data = delivery_partner_order.only(fields_arg())
+    query = order_history_query(delivery_partner_id=delivery_partner_id)
+    archived = archived_order_history_query(delivery_partner_id=delivery_partner_id)
+    if stream:
+        return stream_orders(query, after, response_data, order_data, archived)
 
-    response_data = {
-        'delivery_partner': {
-            'name': delivery_partner.name,
-            'mobile': delivery_partner.mobile,
-            'id': delivery_partner.id
-        },
-        'orders': orders_data
-    }
+    # Fetch one page of orders for the given delivery partner
+    orders, next_cursor = keyset_page(query, limit, after, archived)
+    if not orders and not after:
+        return jsonify({'msg': '', 'error': 'No orders found for the delivery partner'}), 404
+
+    response_data['orders'] = [order_data(order) for order in orders]
+    response_data['next_cursor'] = next_cursor
 
     return jsonify(response_data), 200
 
 
-@app.route('/users/orders/<int:user_id>', methods=['GET'])
+@api.route('/users/orders/<int:user_id>', methods=['GET'])
 @jwt_required()
+@replica_reads
 def get_orders_by_user(user_id):
+    try:
+        limit, after, stream = page_args()
+    except ValueError:
+        return jsonify({'msg': '', 'error': 'Invalid limit or cursor'}), 400
+
     # Fetch the user
-    user = User.query.get(user_id)
+    user = identity_cache.get('USER', user_id)
     if not user:
         return jsonify({'msg': '', 'error': 'User not found'}), 404
 
-    # Fetch all orders for the given user
-    orders = Order.query.filter_by(user_id=user_id).order_by(Order.created_at.desc()).all()
-    if not orders:
-        return jsonify({'msg': '', 'error': 'No orders found for the user'}), 404
+    response_data = {'user': user_contact(user)}
 
-    orders_data = []
-    for order in orders:
-        restaurant = Restaurant.query.filter_by(id=order.restaurant_id).first()
-        delivery_partner = DeliveryPartner.query.filter_by(id=order.delivery_partner_id).first()
-        dishes_ordered = DishesOrdered.query.filter_by(order_id=order.id).all()
-        dishes = [Dish.query.get(dish_ordered.dish_id) for dish_ordered in dishes_ordered]
-
-        order_data = {
-            'order': {
-                'total': order.total,
-                'status': order.status,
-                'order_date': order.created_at,
-                'id': order.id,
-            },
-            'delivery_partner': {
-                'name': delivery_partner.name if delivery_partner else None,
-                'mobile': delivery_partner.mobile if delivery_partner else None,
-                'id': delivery_partner.id if delivery_partner else None
-            },
-            'restaurant': {
-                'id': restaurant.id,
-                'name': restaurant.name,
-                'distance': restaurant.distance,
-                'mobile': restaurant.mobile,
-                'address': restaurant.address,
-                'rating': restaurant.rating,
-                'image_url': restaurant.image_url,
-                'expected_delivery_time': restaurant.expected_delivery_time,
-                'opens_at': restaurant.open_time,
-                'closes_at': restaurant.close_time
-            },
-            'dishes': [{
-                'id': dish.id,
-                'name': dish.name,
-                'description': dish.description,
-                'image_url': dish.image_url,
-                'price': dish.price,
-                'restaurant_id': dish.restaurant_id,
-            } for dish in dishes]
-        }
-        orders_data.append(order_data)
+    order_data = user_order.only(fields_arg())
+    query = order_history_query(user_id=user_id)
+    archived = archived_order_history_query(user_id=user_id)
+    if stream:
+        return stream_orders(query, after, response_data, order_data, archived)
 
-    response_data = {
-        'user': {
-            'address': user.address,
-            'name': user.name,
-            'mobile': user.mobile,
-            'id': user.id,
-        },
-        'orders': orders_data
-    }
+    # Fetch one page of orders for the given user
+    orders, next_cursor = keyset_page(query, limit, after, archived)
+    if not orders and not after:
+        return jsonify({'msg': '', 'error': 'No orders found for the user'}), 404
+
+    response_data['orders'] = [order_data(order) for order in orders]
+    response_data['next_cursor'] = next_cursor
 
     return jsonify(response_data), 200
 
 
+@api.route('/batch', methods=['POST'])
+@jwt_required()
+def batch():
+    data = request.get_json(silent=True)
+    try:
+        items = parse_batch(data, current_app.config['BATCH_MAX_REQUESTS'])
+    except ValueError as e:
+        return jsonify({'msg': '', 'error': str(e)}), 400
+
+    # Sub-requests run with the caller's token, in order; {"parallel": true} runs reads concurrently
+    return batch_runner.response(items, bool(data.get('parallel')))
+
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
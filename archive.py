@@ -0,0 +1,80 @@
+# archive.py
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import delete, func, insert, select
+
+from models import db, ArchivedDishOrdered, ArchivedOrder, DishesOrdered, Order, TERMINAL_ORDER_STATUSES
+
+archive_cli = AppGroup('archive', help='Move finished orders out of the hot tables.')
+
+
+def archive_horizon():
+    # Only orders created before this are ever archived, so newer history is always in orders
+    return datetime.now() - timedelta(days=current_app.config['ARCHIVE_AFTER_DAYS'])
+
+
+def copy_rows(source, target, condition):
+    columns = [column.name for column in source.__table__.columns]
+    db.session.execute(insert(target).from_select(columns, select(*source.__table__.columns).filter(condition)))
+
+
+def archive_batch(cutoff, batch_size):
+    # Moves up to batch_size finished orders created before cutoff, with their dishes, in one
+    # transaction, and returns how many moved. A batch moves completely or not at all, so
+    # archiving can be stopped at any point and picks up where it left off.
+    session = db.session
+    ids = (select(Order.id)
+           .filter(Order.status.in_(TERMINAL_ORDER_STATUSES), Order.created_at < cutoff)
+           .order_by(Order.id).limit(batch_size))
+    if session.get_bind().dialect.name == 'postgresql':
+        # Another archiver, or a late status update, keeps its rows for the next batch
+        ids = ids.with_for_update(skip_locked=True)
+    ids = session.scalars(ids).all()
+    if not ids:
+        session.rollback()
+        return 0
+
+    copy_rows(Order, ArchivedOrder, Order.id.in_(ids))
+    copy_rows(DishesOrdered, ArchivedDishOrdered, DishesOrdered.order_id.in_(ids))
+    session.execute(delete(DishesOrdered).filter(DishesOrdered.order_id.in_(ids)))
+    session.execute(delete(Order).filter(Order.id.in_(ids)))
+    session.commit()
+    return len(ids)
+
+
+def archive_orders(batch_size, max_batches=None):
+    cutoff = archive_horizon()
+    moved = batches = 0
+    while max_batches is None or batches < max_batches:
+        count = archive_batch(cutoff, batch_size)
+        if not count:
+            break
+        moved += count
+        batches += 1
+    return moved, batches
+
+
+@archive_cli.command('orders')
+@click.option('--batch-size', type=int, help='Orders per transaction, ARCHIVE_BATCH_SIZE by default.')
+@click.option('--max-batches', type=int, help='Stop after this many batches.')
+def archive_orders_command(batch_size, max_batches):
+    """Move finished orders older than ARCHIVE_AFTER_DAYS into the archive tables."""
+    moved, batches = archive_orders(batch_size or current_app.config['ARCHIVE_BATCH_SIZE'], max_batches)
+    click.echo('Archived {} orders in {} batches'.format(moved, batches))
+
+
+@archive_cli.command('status')
+def status_command():
+    """Count the orders in the hot and archive tables."""
+    for name, model in (('orders', Order), ('archived', ArchivedOrder)):
+        click.echo('{}: {}'.format(name, db.session.scalar(select(func.count()).select_from(model))))
+    click.echo('archiving orders created before {:%Y-%m-%d %H:%M}'.format(archive_horizon()))
+
+
+def init_app(app):
+    app.config.setdefault('ARCHIVE_AFTER_DAYS', 90)
+    app.config.setdefault('ARCHIVE_BATCH_SIZE', 1000)
+    app.cli.add_command(archive_cli)
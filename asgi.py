@@ -0,0 +1,291 @@
+# asgi.py
+# ASGI entry point:  uvicorn asgi:application --workers 4
+#
+# The order lookup and order-history endpoints run as coroutines on an AsyncSession, so
+# a worker keeps serving while their queries are in flight. Every other route, and the
+# streamed history responses, go to the WSGI app on asgiref's thread pool.
+import io
+import itertools
+import sys
+from urllib.parse import parse_qsl
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from flask import current_app, jsonify, request
+from flask_jwt_extended import decode_token, get_jwt_identity, verify_jwt_in_request
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from werkzeug.exceptions import HTTPException
+
+from app import create_app
+from identity import PRINCIPAL_MODELS, identity_cache, principal_kind
+from models import User, Restaurant, DeliveryPartner
+from pagination import after_cursor, cursor_page, merge_newest, page_args, reaches_archive
+from routing import db_router, engine_options
+from serializers import (fields_arg, restaurant_detail, restaurant_summary, user_profile, user_contact, partner_contact,
+                         order_summary, ordered_dish, restaurant_order, delivery_partner_order, user_order)
+from services import archived_order_history_select, order_history_select
+
+ASYNC_DRIVERS = {'postgresql': 'postgresql+asyncpg', 'sqlite': 'sqlite+aiosqlite'}
+
+
+def async_url(url):
+    scheme, rest = url.split('://', 1)
+    return '{}://{}'.format(ASYNC_DRIVERS.get(scheme.split('+')[0], scheme), rest)
+
+
+def async_engine_options(url, config):
+    options = engine_options(url, config)
+    # asyncpg takes server settings instead of libpq's options string
+    if 'connect_args' in options:
+        options['connect_args'] = {'server_settings': {'statement_timeout': str(config['DB_STATEMENT_TIMEOUT_MS'])}}
+    return options
+
+
+class AsyncDatabase:
+    # Engines are created on first use, inside the server's event loop
+
+    def __init__(self, app):
+        self.app = app
+        self.primary = None
+        self.replicas = []
+        self.next_replica = itertools.count()
+
+    def engines(self):
+        if self.primary is None:
+            config = self.app.config
+            url = config['ASYNC_DATABASE_URL'] or async_url(config['SQLALCHEMY_DATABASE_URI'])
+            self.primary = async_sessionmaker(create_async_engine(url, **async_engine_options(url, config)),
+                                              expire_on_commit=False)
+            for replica_url in config['DATABASE_REPLICA_URLS']:
+                replica_url = async_url(replica_url)
+                self.replicas.append(async_sessionmaker(
+                    create_async_engine(replica_url, **async_engine_options(replica_url, config)),
+                    expire_on_commit=False))
+        return self.primary, self.replicas
+
+    def read_session(self):
+        # Same rule as @replica_reads: a caller who wrote recently reads the primary
+        primary, replicas = self.engines()
+        if not replicas or db_router.wrote_recently(get_jwt_identity()):
+            return primary()
+        return replicas[next(self.next_replica) % len(replicas)]()
+
+    async def principal(self, kind, principal_id):
+        # identity_cache.get, reading a miss from the primary without blocking the event loop
+        found, principal = identity_cache.peek(kind, principal_id)
+        if not found:
+            primary, _ = self.engines()
+            async with primary() as session:
+                row = await session.get(PRINCIPAL_MODELS[kind], principal_id)
+            principal = identity_cache.remember(kind, principal_id, row)
+        return principal
+
+    async def dispose(self):
+        if self.primary is not None:
+            for sessionmaker in [self.primary] + self.replicas:
+                await sessionmaker.kw['bind'].dispose()
+            self.primary = None
+            self.replicas = []
+
+
+async def keyset_page(session, statement, limit, after, archived):
+    orders = (await session.execute(after_cursor(statement, after).limit(limit + 1))).scalars().all()
+    if reaches_archive(orders, limit):
+        archived_orders = (await session.execute(after_cursor(archived, after).limit(limit + 1))).scalars().all()
+        orders = merge_newest(limit + 1, orders, archived_orders)
+    return cursor_page(orders, limit)
+
+
+async def get_order(session, order_id):
+    order = (await session.execute(order_history_select(id=order_id).limit(1))).scalars().first()
+    if not order:
+        order = (await session.execute(archived_order_history_select(id=order_id).limit(1))).scalars().first()
+    if not order:
+        return jsonify({'status': 'error', 'data': {'msg': '', 'error': 'Order not found'}}), 404
+    # Already loaded into the request by load_caller when the caller is this user
+    user = await current_app.extensions['async_database'].principal('USER', get_jwt_identity())
+
+    response_data = {
+        'restaurant': restaurant_detail(order.restaurant),
+        'user': user_profile(user),
+        'order': order_summary(order),
+        'dishes': [ordered_dish(line) for line in order.dishes_ordered]
+    }
+    return jsonify(response_data), 200
+
+
+async def order_history(session, owner_model, owner_id, owner_key, owner_data, record, not_found, empty):
+    try:
+        limit, after, stream = page_args()
+    except ValueError:
+        return jsonify({'msg': '', 'error': 'Invalid limit or cursor'}), 400
+
+    owner = await session.get(owner_model, owner_id)
+    if not owner:
+        return jsonify({'msg': '', 'error': not_found}), 404
+
+    response_data = {owner_key: owner_data(owner)}
+    order_data = record.only(fields_arg())
+    filters = {owner_key + '_id': owner_id}
+    orders, next_cursor = await keyset_page(session, order_history_select(**filters), limit, after,
+                                            archived_order_history_select(**filters))
+    if empty and not orders and not after:
+        return jsonify({'msg': '', 'error': empty}), 404
+
+    response_data['orders'] = [order_data(order) for order in orders]
+    response_data['next_cursor'] = next_cursor
+    return jsonify(response_data), 200
+
+
+async def get_orders_by_restaurant(session, restaurant_id):
+    return await order_history(session, Restaurant, restaurant_id, 'restaurant', restaurant_summary,
+                               restaurant_order, 'Restaurant not found', None)
+
+
+async def get_orders_by_delivery_partner(session, delivery_partner_id):
+    return await order_history(session, DeliveryPartner, delivery_partner_id, 'delivery_partner', partner_contact,
+                               delivery_partner_order, 'Delivery partner not found',
+                               'No orders found for the delivery partner')
+
+
+async def get_orders_by_user(session, user_id):
+    return await order_history(session, User, user_id, 'user', user_contact, user_order,
+                               'User not found', 'No orders found for the user')
+
+
+# Flask endpoint name -> coroutine taking the session and the URL arguments
+ASYNC_VIEWS = {
+    'api.get_order': get_order,
+    'api.get_orders_by_restaurant': get_orders_by_restaurant,
+    'api.get_orders_by_delivery_partner': get_orders_by_delivery_partner,
+    'api.get_orders_by_user': get_orders_by_user,
+}
+
+
+def wsgi_environ(scope):
+    # Enough of PEP 3333 for Flask to build its request; async views never read a body
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    server = scope.get('server') or ('localhost', 80)
+    environ['SERVER_NAME'], environ['SERVER_PORT'] = server[0], str(server[1])
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+    for name, value in scope['headers']:
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+            continue
+        key = 'HTTP_' + name
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+class ThreadedWsgiInstance(WsgiToAsgiInstance):
+    # asgiref runs WSGI calls thread_sensitive, all on one shared thread, which serialises every
+    # fallback request of a worker (and trips its deadlock check on keep-alive connections).
+    # The Flask app is thread safe, so the calls go to the loop's thread pool instead.
+    run_wsgi_app = sync_to_async(vars(WsgiToAsgiInstance)['run_wsgi_app'].func, thread_sensitive=False)
+
+
+class ThreadedWsgiToAsgi(WsgiToAsgi):
+    async def __call__(self, scope, receive, send):
+        await ThreadedWsgiInstance(self.wsgi_application, self.duplicate_header_limit)(scope, receive, send)
+
+
+class Application:
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self.wsgi = ThreadedWsgiToAsgi(flask_app)
+        self.database = AsyncDatabase(flask_app)
+        flask_app.extensions['async_database'] = self.database
+        flask_app.config.setdefault('ASYNC_DATABASE_URL', None)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        view = self.async_view(scope) if scope['type'] == 'http' else None
+        if view is None:
+            return await self.wsgi(scope, receive, send)
+        await self.dispatch(view, scope, send)
+
+    def async_view(self, scope):
+        if scope['method'] != 'GET':
+            return None
+        query = dict(parse_qsl(scope['query_string'].decode('latin1')))
+        if query.get('stream', '').lower() in ('1', 'true', 'yes'):
+            return None
+        try:
+            endpoint, view_args = self.app.url_map.bind_to_environ(wsgi_environ(scope)).match()
+        except HTTPException:
+            return None
+        view = ASYNC_VIEWS.get(endpoint)
+        return (view, view_args) if view else None
+
+    async def dispatch(self, view, scope, send):
+        # Mirrors Flask's full_dispatch_request, so before/after request hooks, JWT error
+        # handlers and the metrics still apply, with the view awaited in between
+        view, view_args = view
+        app = self.app
+        with app.request_context(wsgi_environ(scope)):
+            try:
+                try:
+                    rv = app.preprocess_request()
+                    if rv is None:
+                        await self.load_caller()
+                        verify_jwt_in_request()
+                        async with self.database.read_session() as session:
+                            rv = await view(session, **view_args)
+                except Exception as e:
+                    rv = app.handle_user_exception(e)
+                response = app.make_response(rv)
+            except Exception as e:
+                response = app.handle_exception(e)
+            response = app.process_response(response)
+            body = response.get_data()
+            await send({'type': 'http.response.start', 'status': response.status_code,
+                        'headers': [(name.lower().encode('latin1'), value.encode('latin1'))
+                                    for name, value in response.headers.items()]})
+            await send({'type': 'http.response.body', 'body': body})
+
+    async def load_caller(self):
+        # verify_jwt_in_request looks the caller up through the identity cache, which would
+        # query synchronously on a miss; the principal is read on the AsyncSession first.
+        # An invalid or missing token, or one without a known user_type, is left for
+        # verify_jwt_in_request to reject.
+        config = self.app.config
+        scheme, _, token = request.headers.get(config['JWT_HEADER_NAME'], '').partition(' ')
+        if scheme != config['JWT_HEADER_TYPE'] or not token:
+            return
+        try:
+            claims = decode_token(token.strip())
+        except Exception:
+            return
+        kind = principal_kind(claims.get('user_type'))
+        if kind is not None:
+            await self.database.principal(kind, claims[config['JWT_IDENTITY_CLAIM']])
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.database.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+application = Application(create_app())
@@ -0,0 +1,187 @@
+# batch.py
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+from flask import current_app, g, request
+from flask_jwt_extended import jwt_required as verify_jwt
+
+from admission import admission
+from metrics import RequestStats, request_stats
+from models import db
+
+# Endpoints a batch cannot run: event streams never finish, and batches do not nest
+UNBATCHABLE_ENDPOINTS = {'api.batch', 'api.order_events', 'api.restaurant_order_events'}
+
+# Where flask_jwt_extended keeps the verified token and the caller on g
+JWT_ATTRIBUTES = ('_jwt_extended_jwt', '_jwt_extended_jwt_header', '_jwt_extended_jwt_user',
+                  '_jwt_extended_jwt_location')
+
+
+def jwt_required(**options):
+    # flask_jwt_extended's jwt_required, except in batch sub-requests: the batch verified the
+    # token and loaded the caller once, and BatchRunner hands both to every sub-request
+    def decorator(fn):
+        verified_fn = verify_jwt(**options)(fn)
+
+        @wraps(fn)
+        def view(*args, **kwargs):
+            if request.environ.get('batch.verified'):
+                return current_app.ensure_sync(fn)(*args, **kwargs)
+            return verified_fn(*args, **kwargs)
+        return view
+    return decorator
+
+
+def parse_batch(data, max_requests):
+    # {"requests": [{"id": ..., "method": "GET", "path": "/order/1", "headers": {}, "body": {}}, ...]}
+    # Raises ValueError when the payload is malformed.
+    items = data.get('requests') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        raise ValueError('requests must be a non-empty list')
+    if len(items) > max_requests:
+        raise ValueError('At most {} requests per batch'.format(max_requests))
+
+    parsed = []
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get('path'), str) or not item['path'].startswith('/'):
+            raise ValueError('Every request needs a path starting with /')
+        headers = item.get('headers') or {}
+        if not isinstance(headers, dict):
+            raise ValueError('headers must be an object')
+        parsed.append({'id': item.get('id'),
+                       'method': str(item.get('method') or 'GET').upper(),
+                       'path': item['path'],
+                       'headers': {str(name): str(value) for name, value in headers.items()
+                                   if name.lower() != 'authorization'},
+                       'body': item.get('body')})
+    return parsed
+
+
+def read_key(item):
+    return item['path'], tuple(sorted(item['headers'].items()))
+
+
+class BatchRunner:
+    # Runs sub-requests against the app's own views, inside the caller's request: they share its
+    # app context, so its database session, the caller loaded by @jwt_required and the query
+    # count in Server-Timing. before/after request hooks run once, for the batch; admission
+    # runs for each sub-request.
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BATCH_MAX_REQUESTS', 20)
+        app.config.setdefault('BATCH_MAX_WORKERS', 4)
+        app.extensions['batch'] = {'executor': None, 'lock': threading.Lock()}
+
+    @property
+    def executor(self):
+        state = current_app.extensions['batch']
+        if state['executor'] is None:
+            with state['lock']:
+                if state['executor'] is None:
+                    state['executor'] = ThreadPoolExecutor(current_app.config['BATCH_MAX_WORKERS'],
+                                                           thread_name_prefix='batch')
+        return state['executor']
+
+    def run(self, items, parallel=False):
+        # One (status, headers, body) per item, in order. Identical GETs since the last write run
+        # once. With parallel, each run of consecutive GETs is spread over the thread pool, where
+        # every read gets its own session; writes always run alone, in order.
+        app = current_app._get_current_object()
+        caller = {name: g.get(name) for name in JWT_ATTRIBUTES}
+        results = [None] * len(items)
+        duplicates = {}
+        reads = {}
+        pending = []
+
+        def flush():
+            if parallel and len(pending) > 1:
+                principals = g.setdefault('_principals', {})
+                stats = request_stats()
+                futures = [(index, self.executor.submit(self.dispatch_in_thread, app, items[index],
+                                                        caller, principals, stats)) for index in pending]
+                for index, future in futures:
+                    results[index], thread_stats = future.result()
+                    if stats is not None:
+                        stats.merge(thread_stats)
+            else:
+                for index in pending:
+                    results[index] = self.dispatch(app, items[index], caller, admission.limit)
+            pending.clear()
+
+        for index, item in enumerate(items):
+            if item['method'] == 'GET':
+                key = read_key(item)
+                if key in reads:
+                    duplicates[index] = reads[key]
+                else:
+                    reads[key] = index
+                    pending.append(index)
+            else:
+                flush()
+                results[index] = self.dispatch(app, item, caller, admission.limit)
+                reads.clear()
+        flush()
+
+        for index, original in duplicates.items():
+            results[index] = results[original]
+        return results
+
+    def dispatch_in_thread(self, app, item, caller, principals, stats):
+        # A fresh app context per thread; its queries are counted apart and added to the batch's
+        with app.app_context():
+            g._principals = principals
+            if stats is not None:
+                g._request_stats = RequestStats(stats.statements is not None)
+            return self.dispatch(app, item, caller, admission.admit), g.pop('_request_stats', None)
+
+    def dispatch(self, app, item, caller, admit):
+        with app.test_request_context(item['path'], method=item['method'], headers=item['headers'],
+                                      json=item['body'], environ_base={'batch.verified': True}):
+            # g is shared with the batch, so the previous view's replica routing must not carry over
+            g.pop('_replica_reads', None)
+            for name, value in caller.items():
+                setattr(g, name, value)
+            if request.endpoint in UNBATCHABLE_ENDPOINTS:
+                return 400, {}, app.json.dumps({'msg': '', 'error': 'Not allowed in a batch'}).encode()
+            # Each sub-request takes a token from its own endpoint's bucket, as it would on its own.
+            # Those run on the batch's thread share its heavy endpoint slot; parallel ones on a
+            # heavy endpoint each take another until they finish.
+            rejected = admit()
+            if rejected is not None:
+                return rejected.status_code, {'Retry-After': rejected.headers['Retry-After']}, rejected.get_data()
+            try:
+                try:
+                    rv = app.dispatch_request()
+                except Exception as e:
+                    rv = app.handle_user_exception(e)
+                response = app.make_response(rv)
+                # Streamed history is drained here, while the sub-request is still active
+                body = response.get_data()
+            except Exception:
+                app.log_exception(sys.exc_info())
+                db.session.rollback()
+                return 500, {}, app.json.dumps({'msg': '', 'error': 'Internal server error'}).encode()
+            headers = {name: value for name, value in response.headers.items()
+                       if name not in ('Content-Type', 'Content-Length')}
+            if not response.is_json:
+                body = app.json.dumps(body.decode() or None).encode()
+            return response.status_code, headers, body
+
+    def response(self, items, parallel=False):
+        # The sub-responses are already JSON, so their bodies are spliced in rather than re-encoded
+        dumps = current_app.json.dumps
+        parts = []
+        for item, (status, headers, body) in zip(items, self.run(items, parallel)):
+            head = dumps({'id': item['id'], 'status': status, 'headers': headers})[:-1]
+            parts.append(head.encode() + b', "body": ' + (body.strip() or b'null') + b'}')
+        return current_app.response_class(b'{"responses": [' + b', '.join(parts) + b']}',
+                                          mimetype='application/json')
+
+
+batch_runner = BatchRunner()
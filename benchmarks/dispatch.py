@@ -0,0 +1,75 @@
+# benchmarks/dispatch.py
+# Simulated dispatch load against the in-memory engine, no database involved.
+#
+#   python -m benchmarks.dispatch --partners 5000 --orders 100000
+import argparse
+import random
+import statistics
+import time
+from collections import deque
+
+from dispatch import DispatchEngine
+from geo import KM_PER_DEGREE
+
+
+def percentile(samples, pct):
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated delivery partner dispatch')
+    parser.add_argument('--partners', type=int, default=5000)
+    parser.add_argument('--orders', type=int, default=100000)
+    parser.add_argument('--city-km', type=float, default=30.0, help='side of the square city')
+    parser.add_argument('--in-flight', type=int, default=8000, help='orders being delivered at any time')
+    parser.add_argument('--cell-km', type=float, default=1.0)
+    parser.add_argument('--max-active', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    base_lat, base_lng = 12.90, 77.50
+    span = args.city_km / KM_PER_DEGREE
+
+    def point():
+        return base_lat + rng.random() * span, base_lng + rng.random() * span
+
+    engine = DispatchEngine(args.cell_km, args.max_active)
+    for partner_id in range(args.partners):
+        engine.update_partner(partner_id, *point())
+
+    pickups = [point() for _ in range(args.orders)]
+    in_flight = deque()
+    timings = []
+    unassigned = 0
+
+    started = time.perf_counter()
+    for lat, lng in pickups:
+        # Finish the oldest deliveries so the fleet keeps a steady load
+        while len(in_flight) >= args.in_flight:
+            engine.release(in_flight.popleft())
+
+        t0 = time.perf_counter()
+        partner_id = engine.assign(lat, lng)
+        timings.append(time.perf_counter() - t0)
+
+        if partner_id is None:
+            unassigned += 1
+        else:
+            in_flight.append(partner_id)
+            # Couriers drift towards the pickup point they were sent to
+            engine.update_partner(partner_id, lat, lng)
+    elapsed = time.perf_counter() - started
+
+    timings.sort()
+    print('partners        {}'.format(args.partners))
+    print('orders          {}'.format(args.orders))
+    print('unassigned      {}'.format(unassigned))
+    print('throughput      {:.0f} dispatches/s'.format(args.orders / elapsed))
+    print('mean            {:.1f} us'.format(statistics.mean(timings) * 1e6))
+    for pct in (50, 95, 99, 99.9):
+        print('p{:<14}{:.1f} us'.format(pct, percentile(timings, pct) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# benchmarks/nearby.py
+# Latency of "restaurants near me" lookups against the in-memory grid, no database involved.
+#
+#   python -m benchmarks.nearby --restaurants 50000 --queries 5000
+import argparse
+import random
+import time
+from types import SimpleNamespace
+
+from geo import KM_PER_DEGREE, load_numpy
+from nearby import RestaurantGeoIndex
+
+
+def percentile(samples, pct):
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Nearby restaurant search latency')
+    parser.add_argument('--restaurants', type=int, default=50000)
+    parser.add_argument('--queries', type=int, default=5000)
+    parser.add_argument('--city-km', type=float, default=30.0, help='side of the square city')
+    parser.add_argument('--radius-km', type=float, default=5.0)
+    parser.add_argument('--limit', type=int, default=50)
+    parser.add_argument('--cell-km', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    base_lat, base_lng = 12.90, 77.50
+    span = args.city_km / KM_PER_DEGREE
+
+    def point():
+        return base_lat + rng.random() * span, base_lng + rng.random() * span
+
+    index = RestaurantGeoIndex(args.cell_km)
+    for restaurant_id in range(args.restaurants):
+        lat, lng = point()
+        index.upsert(SimpleNamespace(
+            id=restaurant_id, name='Restaurant {}'.format(restaurant_id), mobile='', address='', image_url='',
+            reviews='', distance='', expected_delivery_time='30 minutes', cuisine='', open_time='9:00 AM',
+            close_time='9:00 PM', rating=4.0, offers='', latitude=lat, longitude=lng))
+
+    timings = []
+    found = 0
+    for _ in range(args.queries):
+        lat, lng = point()
+        t0 = time.perf_counter()
+        found += len(index.search(lat, lng, args.radius_km, args.limit))
+        timings.append(time.perf_counter() - t0)
+
+    timings.sort()
+    print('restaurants     {}'.format(args.restaurants))
+    print('numpy           {}'.format('yes' if load_numpy() is not None else 'no'))
+    print('mean results    {:.1f}'.format(found / args.queries))
+    for pct in (50, 95, 99):
+        print('p{:<14}{:.2f} ms'.format(pct, percentile(timings, pct) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
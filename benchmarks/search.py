@@ -0,0 +1,80 @@
+# benchmarks/search.py
+# Build, query and update cost of the search index on a synthetic corpus, no database involved.
+#
+#   python -m benchmarks.search --dishes 1000000
+import argparse
+import itertools
+import random
+import resource
+import time
+
+from search import DISH_FIELDS, InvertedIndex
+
+CUISINES = ['indian', 'chinese', 'italian', 'thai', 'mexican', 'japanese', 'korean', 'lebanese',
+            'mughlai', 'bengali', 'kerala', 'continental', 'american', 'turkish', 'greek']
+
+
+def percentile(samples, pct):
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Search index benchmark')
+    parser.add_argument('--dishes', type=int, default=1000000)
+    parser.add_argument('--restaurants', type=int, default=20000)
+    parser.add_argument('--vocabulary', type=int, default=20000, help='distinct synthetic words')
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--updates', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = sorted({''.join(rng.choice(letters) for _ in range(rng.randint(4, 9))) for _ in range(args.vocabulary)})
+    # Zipf-like word popularity, like real menus where "chicken" is everywhere
+    cum_weights = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(len(words))))
+
+    def phrase(count):
+        return ' '.join(rng.choices(words, cum_weights=cum_weights, k=count))
+
+    index = InvertedIndex()
+    started = time.perf_counter()
+    for restaurant_id in range(args.restaurants):
+        index.add(('restaurant', restaurant_id), [(phrase(2), 3.0), (rng.choice(CUISINES), 2.0)], rng.uniform(2, 5))
+    for dish_id in range(args.dishes):
+        index.add(('dish', dish_id), [(phrase(3), DISH_FIELDS[0][1]), (phrase(8), DISH_FIELDS[1][1])],
+                  rng.uniform(2, 5))
+    build = time.perf_counter() - started
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def timed(queries):
+        timings = []
+        for query in queries:
+            t0 = time.perf_counter()
+            index.search(query, 20)
+            timings.append(time.perf_counter() - t0)
+        timings.sort()
+        return timings
+
+    typeahead = timed([rng.choice(words)[:rng.randint(2, 4)] for _ in range(args.queries)])
+    two_terms = timed([phrase(1) + ' ' + rng.choice(words)[:3] for _ in range(args.queries)])
+
+    updates = []
+    for _ in range(args.updates):
+        dish_id = rng.randrange(args.dishes)
+        t0 = time.perf_counter()
+        index.add(('dish', dish_id), [(phrase(3), 3.0), (phrase(8), 1.0)], rng.uniform(2, 5))
+        updates.append(time.perf_counter() - t0)
+    updates.sort()
+
+    print('documents       {}'.format(len(index)))
+    print('tokens          {}'.format(len(index.vocabulary)))
+    print('build           {:.1f} s'.format(build))
+    print('max rss         {:.0f} MB'.format(rss_mb))
+    for name, timings in (('typeahead', typeahead), ('two terms', two_terms), ('update', updates)):
+        print('{:<16}p50 {:.3f} ms  p95 {:.3f} ms  p99 {:.3f} ms'.format(
+            name, percentile(timings, 50) * 1e3, percentile(timings, 95) * 1e3, percentile(timings, 99) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
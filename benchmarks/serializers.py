@@ -0,0 +1,104 @@
+# benchmarks/serializers.py
+# CPU cost of turning one page of order history into JSON, no database involved.
+# Compares hand-built dicts and Flask's stdlib encoder against the shared serializers and
+# the app's JSON provider, with and without a ?fields= projection.
+#
+#   python -m benchmarks.serializers --orders 500 --rounds 200
+import argparse
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from flask import Flask
+
+import serializers
+from serializers import orjson, user_order
+
+
+def percentile(samples, pct):
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def fake_orders(count, lines):
+    restaurant = SimpleNamespace(
+        id=1, name='Spicy Kitchen', distance='10 km', mobile='8000000001', address='Road 1', rating=4.3,
+        image_url='https://placehold.co/restaurant.png', expected_delivery_time='30 minutes',
+        open_time='9:00 AM', close_time='9:00 PM')
+    partner = SimpleNamespace(id=1, name='Partner 1', mobile='7000000001')
+    dishes = [SimpleNamespace(dish_id=i, dish_name='Dish {}'.format(i), unit_price=120.0 + i, quantity=1 + i % 2)
+              for i in range(lines)]
+    now = datetime.now()
+    return [SimpleNamespace(id=i, total=480.0, status='DELIVERED', created_at=now - timedelta(minutes=i),
+                            restaurant=restaurant, delivery_partner=partner,
+                            dishes_ordered=dishes)
+            for i in range(count)]
+
+
+def hand_built(order):
+    # The dict app.py used to build for each order of GET /users/orders/<id>
+    restaurant = order.restaurant
+    delivery_partner = order.delivery_partner
+    return {
+        'order': {'total': order.total, 'status': order.status, 'order_date': order.created_at, 'id': order.id},
+        'delivery_partner': {
+            'name': delivery_partner.name if delivery_partner else None,
+            'mobile': delivery_partner.mobile if delivery_partner else None,
+            'id': delivery_partner.id if delivery_partner else None
+        },
+        'restaurant': {
+            'id': restaurant.id, 'name': restaurant.name, 'distance': restaurant.distance,
+            'mobile': restaurant.mobile, 'address': restaurant.address, 'rating': restaurant.rating,
+            'image_url': restaurant.image_url, 'expected_delivery_time': restaurant.expected_delivery_time,
+            'opens_at': restaurant.open_time, 'closes_at': restaurant.close_time
+        },
+        'dishes': [{'id': line.dish_id, 'name': line.dish_name, 'price': line.unit_price, 'quantity': line.quantity}
+                   for line in order.dishes_ordered]
+    }
+
+
+def measure(rounds, fn):
+    timings = []
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - t0)
+    timings.sort()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Order history serialization cost')
+    parser.add_argument('--orders', type=int, default=500, help='orders in one page')
+    parser.add_argument('--lines', type=int, default=3, help='line items per order')
+    parser.add_argument('--rounds', type=int, default=200)
+    parser.add_argument('--fields', default='order.id,order.status,order.order_date,restaurant.name,dishes.name')
+    args = parser.parse_args()
+
+    orders = fake_orders(args.orders, args.lines)
+    stdlib_app = Flask('stdlib')
+    app = Flask('fast')
+    serializers.init_app(app)
+    stdlib, fast = stdlib_app.json, app.json
+    paths = tuple(sorted(args.fields.split(',')))
+    projected = user_order.only(paths)
+
+    cases = [
+        ('hand-built + stdlib json', lambda: stdlib.response({'orders': [hand_built(order) for order in orders]})),
+        ('serializers + stdlib json', lambda: stdlib.response({'orders': [user_order(order) for order in orders]})),
+        ('serializers + app provider', lambda: fast.response({'orders': [user_order(order) for order in orders]})),
+        ('?fields= + app provider', lambda: fast.response({'orders': [projected(order) for order in orders]})),
+    ]
+
+    print('orders per page {}'.format(args.orders))
+    print('orjson          {}'.format('yes' if orjson is not None else 'no'))
+    baseline = None
+    for name, fn in cases:
+        timings = measure(args.rounds, fn)
+        median = percentile(timings, 50)
+        baseline = baseline or median
+        print('{:<28} p50 {:>7.2f} ms  p95 {:>7.2f} ms  {:>5.2f}x'.format(
+            name, median * 1e3, percentile(timings, 95) * 1e3, baseline / median))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+# cache.py
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, current_app, request
+
+from routing import db_router
+
+
+class LRUCache:
+    # With a ttl (seconds) entries also expire, and are dropped when next read
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires_at, value = self._data[key]
+            except KeyError:
+                return default
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class CatalogBackend:
+    # Storage for catalog version counters and pre-serialized bodies.
+    # Bodies are keyed by namespace and version, so bumping a version is the only invalidation needed.
+
+    def get_version(self, namespace):
+        raise NotImplementedError
+
+    def bump_version(self, namespace):
+        raise NotImplementedError
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, entry):
+        raise NotImplementedError
+
+
+class LocalCatalogBackend(CatalogBackend):
+    # Per-process storage, only coherent when the app runs in a single worker
+
+    def __init__(self, maxsize=1024):
+        self._versions = {}
+        self._lock = threading.Lock()
+        self._entries = LRUCache(maxsize)
+
+    def get_version(self, namespace):
+        return self._versions.get(namespace, 0)
+
+    def bump_version(self, namespace):
+        with self._lock:
+            self._versions[namespace] = self._versions.get(namespace, 0) + 1
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def set(self, key, entry):
+        self._entries.set(key, entry)
+
+
+class RedisCatalogBackend(CatalogBackend):
+    # Shared storage so every gunicorn worker sees the same versions and bodies
+
+    def __init__(self, url, ttl=3600, prefix='catalog:'):
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+        self._ttl = ttl
+        self._prefix = prefix
+
+    def get_version(self, namespace):
+        return int(self._redis.get(self._prefix + 'version:' + namespace) or 0)
+
+    def bump_version(self, namespace):
+        self._redis.incr(self._prefix + 'version:' + namespace)
+
+    def get(self, key):
+        raw = self._redis.get(self._prefix + 'body:' + key)
+        if raw is None:
+            return None
+        etag, _, body = raw.partition(b'\n')
+        return etag.decode(), body
+
+    def set(self, key, entry):
+        etag, body = entry
+        self._redis.set(self._prefix + 'body:' + key, etag.encode() + b'\n' + body, ex=self._ttl)
+
+
+class CatalogCache:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CATALOG_CACHE_BACKEND', 'local')
+        app.config.setdefault('CATALOG_CACHE_SIZE', 1024)
+        app.config.setdefault('CATALOG_CACHE_URL', None)
+        app.config.setdefault('CATALOG_CACHE_TTL', 3600)
+        self.reset(app)
+
+    @property
+    def backend(self):
+        # Created on first use, so redis is only imported and connected once a request needs it
+        state = current_app.extensions['catalog_cache']
+        if state['backend'] is None:
+            with state['lock']:
+                if state['backend'] is None:
+                    state['backend'] = self.build(current_app.config)
+        return state['backend']
+
+    def build(self, config):
+        if config['CATALOG_CACHE_BACKEND'] == 'redis':
+            return RedisCatalogBackend(config['CATALOG_CACHE_URL'], config['CATALOG_CACHE_TTL'])
+        return LocalCatalogBackend(config['CATALOG_CACHE_SIZE'])
+
+    def reset(self, app):
+        app.extensions['catalog_cache'] = {'backend': None, 'lock': threading.Lock()}
+
+    def response(self, namespace, build, variant=None):
+        # build() returns the JSON-able payload, or None when the resource does not exist.
+        # variant tells apart differently shaped bodies of one namespace, e.g. a ?fields= projection.
+        backend = self.backend
+        key = '{}:{}'.format(namespace, backend.get_version(namespace))
+        if variant:
+            key += ':' + variant
+        entry = backend.get(key)
+        if entry is None:
+            # A lagging replica would pin stale rows under the new version, so builds read the primary
+            with db_router.primary():
+                data = build()
+            if data is None:
+                return None
+            body = current_app.json.dumps(data).encode()
+            entry = (hashlib.sha1(body).hexdigest(), body)
+            backend.set(key, entry)
+
+        etag, body = entry
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        return response
+
+    def invalidate(self, *namespaces):
+        for namespace in namespaces:
+            self.backend.bump_version(namespace)
+
+
+def menu_namespace(restaurant_id):
+    return 'menu:{}'.format(restaurant_id)
+
+
+catalog_cache = CatalogCache()
@@ -0,0 +1,154 @@
+# dispatch.py
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import func
+
+from geo import GridIndex, haversine_km
+from models import db, DeliveryPartner, Order, TERMINAL_ORDER_STATUSES
+
+
+class DispatchEngine:
+    # In-memory view of delivery partners: last known position and number of active orders
+
+    def __init__(self, cell_km=1.0, max_active_orders=3, max_radius_km=15.0):
+        self.grid = GridIndex(cell_km)
+        self.active = {}
+        self.max_active_orders = max_active_orders
+        self.max_radius_km = max_radius_km
+        self.lock = threading.Lock()
+
+    def update_partner(self, partner_id, lat, lng):
+        with self.lock:
+            self.active.setdefault(partner_id, 0)
+            if lat is None or lng is None:
+                self.grid.remove(partner_id)
+            else:
+                self.grid.add(partner_id, lat, lng)
+
+    def set_active(self, partner_id, count):
+        with self.lock:
+            self.active[partner_id] = count
+
+    def assign(self, lat, lng):
+        # Nearest partner below max_active_orders, fewer active orders breaking ties
+        with self.lock:
+            partner_id = self._nearest(lat, lng)
+            if partner_id is not None:
+                self.active[partner_id] += 1
+            return partner_id
+
+    def claim(self, partner_id):
+        with self.lock:
+            self.active[partner_id] = self.active.get(partner_id, 0) + 1
+
+    def release(self, partner_id):
+        with self.lock:
+            if self.active.get(partner_id):
+                self.active[partner_id] -= 1
+
+    def _nearest(self, lat, lng):
+        grid = self.grid
+        active = self.active
+        points = grid.points
+        capacity = self.max_active_orders
+        best = None
+        best_key = None
+
+        for radius in range(grid.rings_for_km(lat, self.max_radius_km)):
+            # Stop once no point in the remaining rings can beat the best match
+            if best is not None and grid.ring_min_km(lat, radius) > best_key[0]:
+                break
+            for partner_id in grid.ring(lat, lng, radius):
+                load = active[partner_id]
+                if load >= capacity:
+                    continue
+                partner_lat, partner_lng = points[partner_id]
+                key = (haversine_km(lat, lng, partner_lat, partner_lng), load)
+                if best_key is None or key < best_key:
+                    best, best_key = partner_id, key
+
+        if best is None or best_key[0] > self.max_radius_km:
+            return None
+        return best
+
+
+class Dispatcher:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('DISPATCH_CELL_KM', 1.0)
+        app.config.setdefault('DISPATCH_MAX_ACTIVE_ORDERS', 3)
+        app.config.setdefault('DISPATCH_MAX_RADIUS_KM', 15.0)
+        app.config.setdefault('DISPATCH_REBUILD_SECONDS', 300)
+        app.extensions['dispatch'] = {'engine': None, 'built_at': 0.0, 'lock': threading.Lock()}
+
+    @property
+    def engine(self):
+        # Built from the database on first use and rebuilt periodically, since other
+        # workers assign and complete orders this process never sees
+        state = current_app.extensions['dispatch']
+        max_age = current_app.config['DISPATCH_REBUILD_SECONDS']
+        if state['engine'] is None or time.monotonic() - state['built_at'] > max_age:
+            with state['lock']:
+                if state['engine'] is None or time.monotonic() - state['built_at'] > max_age:
+                    state['engine'] = self.build()
+                    state['built_at'] = time.monotonic()
+        return state['engine']
+
+    def build(self):
+        config = current_app.config
+        engine = DispatchEngine(config['DISPATCH_CELL_KM'],
+                                config['DISPATCH_MAX_ACTIVE_ORDERS'],
+                                config['DISPATCH_MAX_RADIUS_KM'])
+        partners = db.session.query(DeliveryPartner.id, DeliveryPartner.latitude, DeliveryPartner.longitude)
+        for partner_id, lat, lng in partners:
+            engine.update_partner(partner_id, lat, lng)
+        for partner_id, count in active_order_counts():
+            engine.set_active(partner_id, count)
+        return engine
+
+    def assign(self, lat, lng):
+        # Nearest free partner with a known position. Partners without one can't be
+        # ranked by distance, so they are the only fallback, least loaded first; when the
+        # pickup point itself is unknown every partner with spare capacity qualifies.
+        partner_id = None
+        unplaced_only = lat is not None and lng is not None
+        if unplaced_only:
+            partner_id = self.engine.assign(lat, lng)
+        if partner_id is None:
+            partner_id = least_loaded_partner(current_app.config['DISPATCH_MAX_ACTIVE_ORDERS'], unplaced_only)
+            if partner_id is not None:
+                self.engine.claim(partner_id)
+        return partner_id
+
+    def release(self, partner_id):
+        self.engine.release(partner_id)
+
+    def update_partner(self, partner_id, lat, lng):
+        self.engine.update_partner(partner_id, lat, lng)
+
+
+def active_order_counts():
+    # (delivery_partner_id, number of assigned orders not yet in a terminal status)
+    return (db.session.query(Order.delivery_partner_id, func.count(Order.id).label('active'))
+            .filter(Order.delivery_partner_id.isnot(None),
+                    Order.status.notin_(TERMINAL_ORDER_STATUSES))
+            .group_by(Order.delivery_partner_id))
+
+
+def least_loaded_partner(max_active_orders, unplaced_only=False):
+    active = active_order_counts().subquery()
+    load = func.coalesce(active.c.active, 0)
+    query = (db.session.query(DeliveryPartner.id)
+             .outerjoin(active, active.c.delivery_partner_id == DeliveryPartner.id)
+             .filter(load < max_active_orders))
+    if unplaced_only:
+        query = query.filter((DeliveryPartner.latitude.is_(None)) | (DeliveryPartner.longitude.is_(None)))
+    row = query.order_by(load, DeliveryPartner.id).first()
+    return row[0] if row else None
+
+dispatcher = Dispatcher()
@@ -0,0 +1,179 @@
+# events.py
+import queue
+import threading
+from collections import defaultdict
+
+from flask import Response, current_app
+
+
+def order_event(order):
+    return {
+        'order_id': order.id,
+        'status': order.status,
+        'restaurant_id': order.restaurant_id,
+        'user_id': order.user_id,
+        'delivery_partner_id': order.delivery_partner_id,
+        'modified_at': order.modified_at,
+    }
+
+
+class Subscription:
+    def __init__(self, broker, topics, maxsize):
+        self.broker = broker
+        self.topics = topics
+        self.messages = queue.Queue(maxsize)
+        self.closed = False
+
+    def put(self, message):
+        # A subscriber that stopped reading is dropped rather than buffered without bound
+        try:
+            self.messages.put_nowait(message)
+        except queue.Full:
+            self.closed = True
+
+    def get(self, timeout):
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.closed = True
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    # Fan-out inside one process. Waiting subscribers block on their own queue, so under
+    # a gevent or eventlet worker each idle stream costs a greenlet, not a thread.
+
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self.subscribers = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def subscribe(self, topics):
+        subscription = Subscription(self, topics, self.queue_size)
+        with self.lock:
+            for topic in topics:
+                self.subscribers[topic].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for topic in subscription.topics:
+                members = self.subscribers.get(topic)
+                if members is not None:
+                    members.discard(subscription)
+                    if not members:
+                        del self.subscribers[topic]
+
+    def publish(self, topic, message):
+        self.deliver(topic, message)
+
+    def deliver(self, topic, message):
+        with self.lock:
+            members = list(self.subscribers.get(topic, ()))
+        for subscription in members:
+            subscription.put(message)
+
+
+class RedisBroker(LocalBroker):
+    # Publishes through Redis so every worker sees every event. One listener thread per
+    # process relays messages to the local subscribers.
+
+    def __init__(self, url, queue_size=100, prefix='events:'):
+        import redis
+
+        super().__init__(queue_size)
+        self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.listener = None
+
+    def subscribe(self, topics):
+        if self.listener is None:
+            with self.lock:
+                if self.listener is None:
+                    self.listener = threading.Thread(target=self.listen, name='event-relay', daemon=True)
+                    self.listener.start()
+        return super().subscribe(topics)
+
+    def listen(self):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.psubscribe(self.prefix + '*')
+        for message in pubsub.listen():
+            topic = message['channel'].decode()[len(self.prefix):]
+            self.deliver(topic, message['data'].decode())
+
+    def publish(self, topic, message):
+        self.redis.publish(self.prefix + topic, message)
+
+
+class EventHub:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('EVENTS_BACKEND', 'local')
+        app.config.setdefault('EVENTS_URL', None)
+        app.config.setdefault('EVENTS_QUEUE_SIZE', 100)
+        app.config.setdefault('EVENTS_HEARTBEAT_SECONDS', 15)
+        self.reset(app)
+
+    @property
+    def broker(self):
+        # Created on first use; a broker built before a fork would keep the parent's relay thread
+        state = current_app.extensions['events']
+        if state['broker'] is None:
+            with state['lock']:
+                if state['broker'] is None:
+                    state['broker'] = self.build(current_app.config)
+        return state['broker']
+
+    def build(self, config):
+        if config['EVENTS_BACKEND'] == 'redis':
+            return RedisBroker(config['EVENTS_URL'], config['EVENTS_QUEUE_SIZE'])
+        return LocalBroker(config['EVENTS_QUEUE_SIZE'])
+
+    def reset(self, app):
+        app.extensions['events'] = {'broker': None, 'lock': threading.Lock()}
+
+    def publish_order(self, order):
+        # Call after the commit so subscribers never see a status that was rolled back. The write
+        # already happened, so a failing broker is logged rather than failing the request.
+        message = current_app.json.dumps(order_event(order))
+        try:
+            broker = self.broker
+            broker.publish('order:{}'.format(order.id), message)
+            broker.publish('restaurant:{}'.format(order.restaurant_id), message)
+        except Exception:
+            current_app.logger.exception('Publishing the status of order %s failed', order.id)
+
+    def stream(self, topics, initial=()):
+        # Server-Sent Events response. The generator only needs the broker, so the request
+        # context and its database connection are released as soon as streaming starts.
+        broker = self.broker
+        heartbeat = current_app.config['EVENTS_HEARTBEAT_SECONDS']
+        dumps = current_app.json.dumps
+        subscription = broker.subscribe(topics)
+        initial = [dumps(data) for data in initial]
+
+        def generate():
+            try:
+                yield 'retry: 3000\n\n'
+                for message in initial:
+                    yield 'event: order_status\ndata: {}\n\n'.format(message)
+                while not subscription.closed:
+                    message = subscription.get(heartbeat)
+                    if message is None:
+                        yield ': keepalive\n\n'
+                    else:
+                        yield 'event: order_status\ndata: {}\n\n'.format(message)
+            finally:
+                subscription.close()
+
+        return Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+event_hub = EventHub()
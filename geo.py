@@ -0,0 +1,95 @@
+# geo.py
+import math
+from collections import defaultdict
+from functools import lru_cache
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 111.32
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+class GridIndex:
+    # Buckets points into square cells of cell_km (measured along a meridian).
+    # Meant for city-scale searches, so longitude wrap-around is not handled.
+
+    def __init__(self, cell_km=1.0):
+        self.cell_deg = cell_km / KM_PER_DEGREE
+        self.cells = defaultdict(set)
+        self.points = {}
+
+    def __len__(self):
+        return len(self.points)
+
+    def __contains__(self, key):
+        return key in self.points
+
+    def cell(self, lat, lng):
+        return int(math.floor(lat / self.cell_deg)), int(math.floor(lng / self.cell_deg))
+
+    def add(self, key, lat, lng):
+        self.remove(key)
+        self.points[key] = (lat, lng)
+        self.cells[self.cell(lat, lng)].add(key)
+
+    def remove(self, key):
+        point = self.points.pop(key, None)
+        if point is None:
+            return
+        cell = self.cell(*point)
+        members = self.cells[cell]
+        members.discard(key)
+        if not members:
+            del self.cells[cell]
+
+    def ring(self, lat, lng, radius):
+        # Keys in the cells exactly `radius` cells away from the one holding (lat, lng)
+        row, col = self.cell(lat, lng)
+        cells = self.cells
+        if radius == 0:
+            yield from cells.get((row, col), ())
+            return
+        for c in range(col - radius, col + radius + 1):
+            yield from cells.get((row - radius, c), ())
+            yield from cells.get((row + radius, c), ())
+        for r in range(row - radius + 1, row + radius):
+            yield from cells.get((r, col - radius), ())
+            yield from cells.get((r, col + radius), ())
+
+    def ring_min_km(self, lat, radius):
+        # Lower bound on the distance from (lat, lng) to any point in ring `radius`.
+        # Cells are narrowest along the parallel, so the bound uses the longitude side.
+        return max(radius - 1, 0) * self.cell_deg * KM_PER_DEGREE * math.cos(math.radians(lat))
+
+    def rings_for_km(self, lat, km):
+        # Number of rings needed to cover every point within km of (lat, lng)
+        width = self.cell_deg * KM_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01)
+        return int(math.ceil(km / width)) + 1
+
+
+@lru_cache(maxsize=None)
+def load_numpy():
+    # Imported on the first distance batch rather than at startup, numpy is most of geo's import time
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def haversine_km_many(lat, lng, lats, lngs):
+    # Distances from one point to many, vectorised when numpy is available
+    numpy = load_numpy()
+    if numpy is None:
+        return [haversine_km(lat, lng, other_lat, other_lng) for other_lat, other_lng in zip(lats, lngs)]
+    lat, lng = math.radians(lat), math.radians(lng)
+    lats = numpy.radians(numpy.asarray(lats, dtype=float))
+    lngs = numpy.radians(numpy.asarray(lngs, dtype=float))
+    a = (numpy.sin((lats - lat) / 2) ** 2
+         + math.cos(lat) * numpy.cos(lats) * numpy.sin((lngs - lng) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * numpy.arcsin(numpy.sqrt(a))
@@ -0,0 +1,202 @@
+# idempotency.py
+import hashlib
+import threading
+import time
+from datetime import datetime, timedelta
+from functools import wraps
+
+import click
+from flask import current_app, g, jsonify, request
+from flask.cli import AppGroup
+from flask_jwt_extended import current_user
+from sqlalchemy import delete, or_, select, update
+
+from cache import LRUCache
+from models import db, IdempotencyKey
+from rollups import UPSERTS, check_upserts
+from routing import db_router
+
+idempotency_cli = AppGroup('idempotency', help='Maintain the Idempotency-Key store.')
+
+MAX_KEY_LENGTH = 255
+
+
+def request_fingerprint():
+    # A key may only be replayed for the same request it was first used with
+    digest = hashlib.sha256(request.method.encode() + b' ' + request.path.encode() + b'\n')
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+class IdempotencyStore:
+    # Requests carrying an Idempotency-Key run once per key and caller; retries get the first
+    # response back. Finished responses are cached per process for IDEMPOTENCY_CACHE_TTL seconds
+    # and kept in idempotency_keys for IDEMPOTENCY_KEY_TTL seconds. The first request claims the
+    # key with a row in its own transaction, so duplicates on any worker wait for its response,
+    # up to IDEMPOTENCY_WAIT_SECONDS, instead of running the view again. A view that writes calls
+    # record() before its commit, so the response is stored in the same transaction as the write.
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('IDEMPOTENCY_KEY_TTL', 86400)
+        app.config.setdefault('IDEMPOTENCY_CACHE_SIZE', 10000)
+        app.config.setdefault('IDEMPOTENCY_CACHE_TTL', 300)
+        app.config.setdefault('IDEMPOTENCY_WAIT_SECONDS', 10)
+        app.config.setdefault('IDEMPOTENCY_POLL_SECONDS', 0.05)
+        app.config.setdefault('IDEMPOTENCY_LOCK_TIMEOUT', 60)
+        app.extensions['idempotency'] = {
+            'responses': LRUCache(app.config['IDEMPOTENCY_CACHE_SIZE'], app.config['IDEMPOTENCY_CACHE_TTL']),
+            'running': {},
+            'lock': threading.Lock(),
+        }
+
+    def __call__(self, view):
+        # Place below @jwt_required(), keys are scoped to the caller
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request.headers.get('Idempotency-Key')
+            if key is None:
+                return view(*args, **kwargs)
+            if not key or len(key) > MAX_KEY_LENGTH:
+                return jsonify({'msg': '', 'error': 'Idempotency-Key must be 1 to {} characters'.format(
+                    MAX_KEY_LENGTH)}), 400
+            owner = '{}:{}'.format(current_user.kind, current_user.id)
+            # A write, so everything here goes to the primary
+            with db_router.primary():
+                return self.run((owner, key), request_fingerprint(), lambda: view(*args, **kwargs))
+        return wrapper
+
+    def run(self, key, fingerprint, call):
+        config = current_app.config
+        state = current_app.extensions['idempotency']
+        deadline = time.monotonic() + config['IDEMPOTENCY_WAIT_SECONDS']
+        while True:
+            stored = state['responses'].get(key) or self.load(key)
+            if stored is not None and stored[0] != fingerprint:
+                return jsonify({'msg': '', 'error': 'Idempotency-Key was already used for a different request'}), 422
+            if stored is not None and stored[1] is not None:
+                return self.replay(stored)
+            if self.claim(key, fingerprint):
+                break
+            # Another request holds the key; one in this process wakes its duplicates when done
+            if time.monotonic() >= deadline:
+                response = jsonify({'msg': '', 'error': 'A request with this Idempotency-Key is still in progress'})
+                response.headers['Retry-After'] = '1'
+                return response, 409
+            running = state['running'].get(key)
+            if running is not None:
+                running.wait(max(0.0, deadline - time.monotonic()))
+            else:
+                time.sleep(config['IDEMPOTENCY_POLL_SECONDS'])
+
+        with state['lock']:
+            state['running'][key] = threading.Event()
+        g._idempotency_key = (key, fingerprint)
+        try:
+            response = current_app.make_response(call())
+            recorded = g.pop('_idempotency_recorded', None)
+            if recorded is not None:
+                state['responses'].set(key, recorded)
+            elif response.status_code >= 500:
+                self.release(key)
+            else:
+                self.save(key, fingerprint, response)
+            return response
+        except BaseException:
+            # Once record() committed with the view's write the row has its response and
+            # release() leaves it, so a retry replays the response instead of writing again
+            db.session.rollback()
+            self.release(key)
+            raise
+        finally:
+            g.pop('_idempotency_key', None)
+            g.pop('_idempotency_recorded', None)
+            with state['lock']:
+                state['running'].pop(key).set()
+
+    def record(self, response):
+        # Call inside the view's transaction, before its commit. Without an Idempotency-Key
+        # on the request this does nothing.
+        running = g.get('_idempotency_key')
+        if running is None:
+            return
+        (owner, key), fingerprint = running
+        stored = (fingerprint, response.status_code, response.get_data())
+        db.session.execute(update(IdempotencyKey).filter_by(owner=owner, key=key)
+                           .values(status_code=stored[1], response=stored[2])
+                           .execution_options(synchronize_session=False))
+        g._idempotency_recorded = stored
+
+    def load(self, key):
+        # (fingerprint, status code or None, body) of an unexpired row
+        row = db.session.execute(select(IdempotencyKey.fingerprint, IdempotencyKey.status_code,
+                                        IdempotencyKey.response)
+                                 .filter_by(owner=key[0], key=key[1])
+                                 .filter(IdempotencyKey.expires_at > datetime.now())).first()
+        # Ends the read, so the next poll sees rows committed meanwhile
+        db.session.rollback()
+        return tuple(row) if row is not None else None
+
+    def claim(self, key, fingerprint):
+        # True when this request now holds the key: a new row, or an expired one, or one whose
+        # request stopped without answering more than IDEMPOTENCY_LOCK_TIMEOUT seconds ago
+        config = current_app.config
+        now = datetime.now()
+        values = {'fingerprint': fingerprint, 'status_code': None, 'response': None, 'created_at': now,
+                  'expires_at': now + timedelta(seconds=config['IDEMPOTENCY_KEY_TTL'])}
+        session = db.session
+        insert = UPSERTS[session.get_bind().dialect.name]
+        claimed = session.execute(insert(IdempotencyKey).values(owner=key[0], key=key[1], **values)
+                                  .on_conflict_do_nothing()).rowcount == 1
+        if not claimed:
+            stale = now - timedelta(seconds=config['IDEMPOTENCY_LOCK_TIMEOUT'])
+            claimed = session.execute(
+                update(IdempotencyKey).filter_by(owner=key[0], key=key[1])
+                .filter(or_(IdempotencyKey.expires_at <= now,
+                            IdempotencyKey.status_code.is_(None) & (IdempotencyKey.created_at < stale)))
+                .values(**values).execution_options(synchronize_session=False)).rowcount == 1
+        session.commit()
+        return claimed
+
+    def save(self, key, fingerprint, response):
+        stored = (fingerprint, response.status_code, response.get_data())
+        db.session.execute(update(IdempotencyKey).filter_by(owner=key[0], key=key[1])
+                           .values(status_code=stored[1], response=stored[2])
+                           .execution_options(synchronize_session=False))
+        db.session.commit()
+        current_app.extensions['idempotency']['responses'].set(key, stored)
+
+    def release(self, key):
+        # A failed request leaves nothing behind, so a retry runs it again
+        db.session.execute(delete(IdempotencyKey).filter_by(owner=key[0], key=key[1], status_code=None)
+                           .execution_options(synchronize_session=False))
+        db.session.commit()
+
+    def replay(self, stored):
+        response = current_app.response_class(stored[2], status=stored[1], mimetype='application/json')
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+    def purge(self):
+        deleted = db.session.execute(delete(IdempotencyKey).filter(IdempotencyKey.expires_at <= datetime.now())
+                                     .execution_options(synchronize_session=False)).rowcount
+        db.session.commit()
+        return deleted
+
+
+idempotent = IdempotencyStore()
+
+
+@idempotency_cli.command('purge')
+def purge_command():
+    """Delete expired Idempotency-Key rows."""
+    click.echo('Deleted {} expired keys'.format(idempotent.purge()))
+
+
+def init_app(app):
+    check_upserts(app)
+    idempotent.init_app(app)
+    app.cli.add_command(idempotency_cli)
@@ -0,0 +1,93 @@
+# identity.py
+from flask import current_app, g, has_request_context
+from sqlalchemy import inspect
+
+from cache import LRUCache
+from models import db, User, Restaurant, DeliveryPartner
+from routing import db_router
+
+# user_type claim of the access token -> model of the principal
+PRINCIPAL_MODELS = {'USER': User, 'RESTAURANT': Restaurant, 'DELIVERY_PARTNER': DeliveryPartner}
+
+
+def principal_kind(user_type):
+    # None for tokens without a known user_type, including those issued before the claim
+    # existed; guessing a kind would let an id from one table stand for a row in another
+    return user_type if user_type in PRINCIPAL_MODELS else None
+
+
+class Principal:
+    # Detached copy of a user, restaurant or delivery partner row, without the password.
+    # Safe to share between requests and threads; the serializers read it like the row.
+
+    def __init__(self, kind, values):
+        self.kind = kind
+        self.__dict__.update(values)
+
+
+def principal_columns(model):
+    return tuple(column.key for column in inspect(model).column_attrs if column.key != 'password')
+
+
+PRINCIPAL_COLUMNS = {kind: principal_columns(model) for kind, model in PRINCIPAL_MODELS.items()}
+
+
+def principal_from_row(kind, row):
+    return Principal(kind, {key: getattr(row, key) for key in PRINCIPAL_COLUMNS[kind]})
+
+
+class IdentityCache:
+    # Principals by (kind, id): first from the request, then from a per-process TTL LRU,
+    # then from the primary. Updates in this process invalidate at once; other workers
+    # see them within IDENTITY_CACHE_TTL seconds.
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('IDENTITY_CACHE_SIZE', 10000)
+        app.config.setdefault('IDENTITY_CACHE_TTL', 60)
+        app.extensions['identity'] = LRUCache(app.config['IDENTITY_CACHE_SIZE'], app.config['IDENTITY_CACHE_TTL'])
+
+    def get(self, kind, principal_id):
+        found, principal = self.peek(kind, principal_id)
+        if not found:
+            principal = self.remember(kind, principal_id, self.load(kind, principal_id))
+        return principal
+
+    def peek(self, kind, principal_id):
+        # (found, principal) from the request or this process, without touching the database
+        key = (kind, principal_id)
+        principals = g.setdefault('_principals', {})
+        if key in principals:
+            return True, principals[key]
+        principal = current_app.extensions['identity'].get(key)
+        if principal is not None:
+            principals[key] = principal
+            return True, principal
+        return False, None
+
+    def remember(self, kind, principal_id, row):
+        # row as read from the primary, or None; missing principals are remembered for the request only
+        key = (kind, principal_id)
+        principal = None
+        if row is not None:
+            principal = principal_from_row(kind, row)
+            current_app.extensions['identity'].set(key, principal)
+        g.setdefault('_principals', {})[key] = principal
+        return principal
+
+    def load(self, kind, principal_id):
+        # A lagging replica would keep a stale profile cached for the whole TTL
+        with db_router.primary():
+            return db.session.get(PRINCIPAL_MODELS[kind], principal_id)
+
+    def invalidate(self, kind, principal_id):
+        # Call after the commit
+        current_app.extensions['identity'].delete((kind, principal_id))
+        if has_request_context():
+            g.get('_principals', {}).pop((kind, principal_id), None)
+
+
+identity_cache = IdentityCache()
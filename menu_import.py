@@ -0,0 +1,220 @@
+# menu_import.py
+import csv
+import math
+
+from flask import current_app
+from sqlalchemy import insert, select, update
+
+from cache import catalog_cache, menu_namespace
+from models import db, Dish, Restaurant
+from search import search_index
+
+# (field, lowest, highest) of the numeric dish columns
+NUMERIC_FIELDS = (('price', 0, None), ('rating', 0, 5))
+TEXT_FIELDS = ('name', 'description', 'image_url')
+
+
+def read_ndjson(stream, max_row_bytes):
+    # (line, row) per non-blank line, reading one line at a time. Rows that cannot be read
+    # are ValueErrors, so they end up in the report instead of stopping the import.
+    loads = current_app.json.loads
+    line = 0
+    while True:
+        raw = stream.readline(max_row_bytes + 1)
+        if not raw:
+            return
+        line += 1
+        if len(raw) > max_row_bytes and not raw.endswith(b'\n'):
+            while raw and not raw.endswith(b'\n'):
+                raw = stream.readline(max_row_bytes)
+            yield line, ValueError('Row is longer than {} bytes'.format(max_row_bytes))
+            continue
+        if not raw.strip():
+            continue
+        try:
+            row = loads(raw)
+        except ValueError:
+            yield line, ValueError('Invalid JSON')
+            continue
+        yield line, row if isinstance(row, dict) else ValueError('Row must be a JSON object')
+
+
+def csv_lines(stream, max_row_bytes):
+    # Decoded lines for the csv module; WSGI input streams are not io objects, so no TextIOWrapper
+    encoding = 'utf-8-sig'
+    while True:
+        raw = stream.readline(max_row_bytes + 1)
+        if not raw:
+            return
+        if len(raw) > max_row_bytes and not raw.endswith(b'\n'):
+            raise csv.Error('line is longer than {} bytes'.format(max_row_bytes))
+        yield raw.decode(encoding)
+        encoding = 'utf-8'
+
+
+def read_csv(stream, max_row_bytes):
+    # (line, row) per record after the header row. Empty cells leave the field unchanged.
+    reader = csv.DictReader(csv_lines(stream, max_row_bytes))
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except (csv.Error, UnicodeDecodeError) as e:
+            # The reader cannot tell where the next record starts
+            yield reader.line_num, ValueError('Unreadable CSV, the rest of the upload was skipped: {}'.format(e))
+            return
+        yield reader.line_num, {key: value for key, value in row.items() if key and value not in (None, '')}
+
+
+MENU_FORMATS = {'application/x-ndjson': read_ndjson, 'application/ndjson': read_ndjson,
+                'application/jsonl': read_ndjson, 'text/csv': read_csv}
+
+
+def dish_values(row):
+    # (dish id or None, {column: value}) for a row; raises ValueError when a field is invalid
+    dish_id = row.get('id')
+    if dish_id is not None:
+        try:
+            dish_id = int(dish_id)
+        except (TypeError, ValueError):
+            raise ValueError('id must be an integer')
+
+    values = {}
+    for field in TEXT_FIELDS:
+        value = row.get(field)
+        if value is not None:
+            if not isinstance(value, str):
+                raise ValueError('{} must be a string'.format(field))
+            values[field] = value
+    if 'name' in values:
+        values['name'] = values['name'].strip()
+        if not values['name']:
+            raise ValueError('name must not be empty')
+
+    for field, lowest, highest in NUMERIC_FIELDS:
+        value = row.get(field)
+        if value is None:
+            continue
+        try:
+            if isinstance(value, bool):
+                raise ValueError
+            number = float(value)
+        except (TypeError, ValueError):
+            raise ValueError('{} must be a number'.format(field))
+        if not math.isfinite(number) or number < lowest or (highest is not None and number > highest):
+            raise ValueError('{} must be at least {}{}'.format(
+                field, lowest, ' and at most {}'.format(highest) if highest is not None else ''))
+        values[field] = number
+    return dish_id, values
+
+
+class ImportReport:
+    def __init__(self, max_errors):
+        self.rows = self.created = self.updated = self.failed = 0
+        self.errors = []
+        self.max_errors = max_errors
+
+    def fail(self, line, error):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'line': line, 'error': str(error)})
+
+    def as_dict(self):
+        return {'rows': self.rows, 'created': self.created, 'updated': self.updated, 'failed': self.failed,
+                'errors': self.errors, 'errors_truncated': self.failed > len(self.errors)}
+
+
+class MenuImporter:
+    # Creates and updates the dishes of one restaurant from an NDJSON or CSV upload. Rows are
+    # read from the request stream and written MENU_IMPORT_BATCH_SIZE at a time, one transaction
+    # per batch, so memory stays bounded however large the upload is. A row with an id updates
+    # that dish; one without updates the restaurant's dish of the same name, or adds a new dish.
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MENU_IMPORT_BATCH_SIZE', 1000)
+        app.config.setdefault('MENU_IMPORT_MAX_ERRORS', 1000)
+        app.config.setdefault('MENU_IMPORT_MAX_ROW_BYTES', 65536)
+
+    def read(self, mimetype, stream):
+        # (line, row) pairs for a supported content type, None for any other
+        read = MENU_FORMATS.get(mimetype)
+        if read is None:
+            return None
+        return read(stream, current_app.config['MENU_IMPORT_MAX_ROW_BYTES'])
+
+    def run(self, restaurant_id, rows):
+        config = current_app.config
+        report = ImportReport(config['MENU_IMPORT_MAX_ERRORS'])
+        batch = []
+        try:
+            for line, row in rows:
+                report.rows += 1
+                try:
+                    if isinstance(row, ValueError):
+                        raise row
+                    dish_id, values = dish_values(row)
+                except ValueError as e:
+                    report.fail(line, e)
+                    continue
+                batch.append((line, dish_id, values))
+                if len(batch) >= config['MENU_IMPORT_BATCH_SIZE']:
+                    self.write_batch(restaurant_id, batch, report)
+                    batch = []
+            if batch:
+                self.write_batch(restaurant_id, batch, report)
+        finally:
+            if report.created or report.updated:
+                catalog_cache.invalidate(menu_namespace(restaurant_id))
+        return report
+
+    def write_batch(self, restaurant_id, batch, report):
+        session = db.session
+        # Imports of the same restaurant take turns, so a new name is never inserted twice
+        session.execute(select(Restaurant.id).filter_by(id=restaurant_id).with_for_update())
+
+        ids = {dish_id for _, dish_id, _ in batch if dish_id is not None}
+        names = {values['name'] for _, dish_id, values in batch if dish_id is None and 'name' in values}
+        known = set(session.scalars(select(Dish.id).filter(Dish.restaurant_id == restaurant_id,
+                                                           Dish.id.in_(ids)))) if ids else set()
+        # Newest first, so a name shared by several dishes resolves to the oldest
+        by_name = dict(session.execute(select(Dish.name, Dish.id)
+                                       .filter(Dish.restaurant_id == restaurant_id, Dish.name.in_(names))
+                                       .order_by(Dish.id.desc())).all()) if names else {}
+
+        updates = {}
+        inserts = {}
+        for line, dish_id, values in batch:
+            if dish_id is None:
+                if 'name' not in values:
+                    report.fail(line, 'name is required for a new dish')
+                    continue
+                dish_id = by_name.get(values['name'])
+            elif dish_id not in known:
+                report.fail(line, 'Dish not found')
+                continue
+
+            # Later rows for the same dish win, field by field
+            if dish_id is not None:
+                updates.setdefault(dish_id, {}).update(values)
+                report.updated += 1
+            elif values['name'] in inserts:
+                inserts[values['name']].update(values)
+                report.updated += 1
+            else:
+                inserts[values['name']] = dict(values, restaurant_id=restaurant_id)
+                report.created += 1
+
+        created = session.scalars(insert(Dish).returning(Dish.id), list(inserts.values())).all() if inserts else []
+        changed = [dict(values, id=dish_id) for dish_id, values in updates.items() if values]
+        if changed:
+            session.execute(update(Dish), changed)
+        session.commit()
+        search_index.add_dishes(created + list(updates))
+
+
+menu_importer = MenuImporter()
@@ -0,0 +1,207 @@
+# metrics.py
+import bisect
+import threading
+import time
+
+from flask import Response, current_app, g, has_request_context, request
+from flask.json.provider import JSONProvider
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    # Cumulative counts are only computed when exported, so an observation is one bisect
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield format_bound(bound), cumulative
+        yield '+Inf', self.count
+
+
+def format_bound(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class RequestStats:
+    def __init__(self, capture_sql):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.serialize_seconds = 0.0
+        self.statements = [] if capture_sql else None
+
+    def merge(self, other):
+        # Adds the work of a batch sub-request run on another thread
+        self.queries += other.queries
+        self.db_seconds += other.db_seconds
+        self.serialize_seconds += other.serialize_seconds
+        if self.statements is not None:
+            self.statements.extend(other.statements)
+
+
+def request_stats():
+    if has_request_context():
+        return g.get('_request_stats')
+    return None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if request_stats() is not None:
+        context._query_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = request_stats()
+    started = getattr(context, '_query_started', None)
+    if stats is None or started is None:
+        return
+    elapsed = time.perf_counter() - started
+    stats.queries += 1
+    stats.db_seconds += elapsed
+    if stats.statements is not None and len(stats.statements) < current_app.config['METRICS_SLOW_SQL_LIMIT']:
+        stats.statements.append((elapsed, statement))
+
+
+class TimedJSONProvider(JSONProvider):
+    # Wraps the app's JSON provider to add the time spent serializing to the request stats
+
+    def __init__(self, app, provider):
+        super().__init__(app)
+        self.provider = provider
+
+    def dumps(self, obj, **kwargs):
+        stats = request_stats()
+        if stats is None:
+            return self.provider.dumps(obj, **kwargs)
+        started = time.perf_counter()
+        try:
+            return self.provider.dumps(obj, **kwargs)
+        finally:
+            stats.serialize_seconds += time.perf_counter() - started
+
+    def loads(self, s, **kwargs):
+        return self.provider.loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        stats = request_stats()
+        if stats is None:
+            return self.provider.response(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return self.provider.response(*args, **kwargs)
+        finally:
+            stats.serialize_seconds += time.perf_counter() - started
+
+
+class Metrics:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_ENABLED', True)
+        app.config.setdefault('METRICS_ENDPOINT', '/metrics')
+        app.config.setdefault('METRICS_SERVER_TIMING', True)
+        app.config.setdefault('METRICS_SLOW_REQUEST_MS', None)
+        app.config.setdefault('METRICS_SLOW_SQL_LIMIT', 50)
+        app.extensions['metrics'] = {'histograms': {}, 'requests': {}, 'lock': threading.Lock()}
+        if not app.config['METRICS_ENABLED']:
+            return
+
+        app.json = TimedJSONProvider(app, app.json)
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        if app.config['METRICS_ENDPOINT']:
+            app.add_url_rule(app.config['METRICS_ENDPOINT'], 'metrics', self.export)
+
+    def start_request(self):
+        # SQL text is only kept when the slow-request log is on
+        g._request_stats = RequestStats(current_app.config['METRICS_SLOW_REQUEST_MS'] is not None)
+
+    def finish_request(self, response):
+        stats = g.pop('_request_stats', None)
+        if stats is None:
+            return response
+        # For streamed bodies this covers the time to the first byte, not the whole stream
+        total = time.perf_counter() - stats.started
+        endpoint = request.endpoint or 'unmatched'
+
+        if current_app.config['METRICS_SERVER_TIMING']:
+            response.headers.add('Server-Timing', 'db;dur={:.3f};desc="{} queries", serialize;dur={:.3f}, total;dur={:.3f}'
+                                 .format(stats.db_seconds * 1000, stats.queries,
+                                         stats.serialize_seconds * 1000, total * 1000))
+        self.observe(endpoint, request.method, response.status_code, stats, total)
+
+        slow_ms = current_app.config['METRICS_SLOW_REQUEST_MS']
+        if slow_ms is not None and total * 1000 >= slow_ms:
+            lines = ['Slow request {} {} -> {} in {:.1f} ms, {} queries ({:.1f} ms)'.format(
+                request.method, request.path, response.status_code, total * 1000,
+                stats.queries, stats.db_seconds * 1000)]
+            lines.extend('  {:.3f} ms  {}'.format(elapsed * 1000, ' '.join(statement.split()))
+                         for elapsed, statement in stats.statements)
+            current_app.logger.warning('\n'.join(lines))
+        return response
+
+    def observe(self, endpoint, method, status, stats, total):
+        state = current_app.extensions['metrics']
+        with state['lock']:
+            histograms = state['histograms'].get(endpoint)
+            if histograms is None:
+                histograms = state['histograms'][endpoint] = {
+                    'request_duration_seconds': Histogram(LATENCY_BUCKETS),
+                    'db_duration_seconds': Histogram(LATENCY_BUCKETS),
+                    'serialize_duration_seconds': Histogram(LATENCY_BUCKETS),
+                    'db_queries': Histogram(QUERY_BUCKETS),
+                }
+            histograms['request_duration_seconds'].observe(total)
+            histograms['db_duration_seconds'].observe(stats.db_seconds)
+            histograms['serialize_duration_seconds'].observe(stats.serialize_seconds)
+            histograms['db_queries'].observe(stats.queries)
+            key = (endpoint, method, status)
+            state['requests'][key] = state['requests'].get(key, 0) + 1
+
+    def export(self):
+        # Prometheus text exposition format, version 0.0.4
+        state = current_app.extensions['metrics']
+        lines = []
+        with state['lock']:
+            lines.append('# TYPE http_requests_total counter')
+            for (endpoint, method, status), count in sorted(state['requests'].items()):
+                lines.append('http_requests_total{{endpoint="{}",method="{}",status="{}"}} {}'
+                             .format(escape_label(endpoint), method, status, count))
+            for name in ('request_duration_seconds', 'db_duration_seconds', 'serialize_duration_seconds', 'db_queries'):
+                metric = 'http_' + name
+                lines.append('# TYPE {} histogram'.format(metric))
+                for endpoint, histograms in sorted(state['histograms'].items()):
+                    histogram = histograms[name]
+                    label = escape_label(endpoint)
+                    for bound, count in histogram.samples():
+                        lines.append('{}_bucket{{endpoint="{}",le="{}"}} {}'.format(metric, label, bound, count))
+                    lines.append('{}_sum{{endpoint="{}"}} {}'.format(metric, label, repr(float(histogram.sum))))
+                    lines.append('{}_count{{endpoint="{}"}} {}'.format(metric, label, histogram.count))
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+metrics = Metrics()
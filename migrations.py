@@ -0,0 +1,197 @@
+# migrations.py
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, delete, func, inspect, select, text, update
+from sqlalchemy.schema import CreateIndex
+
+from models import (db, ArchivedDishOrdered, ArchivedOrder, DeliveryPartner, Dish, DishDailySales, Order, DishesOrdered,
+                    IdempotencyKey, Restaurant, RestaurantDailySales)
+
+schema_cli = AppGroup('schema', help='Create and upgrade the database schema.')
+
+# Kept out of db.metadata so create_all() never touches it
+schema_migrations = Table(
+    'schema_migrations', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('description', String),
+    Column('applied_at', DateTime, default=datetime.now),
+)
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    # Register fn(conn) as a schema step. Steps run in version order on an autocommit
+    # connection and must be safe to re-run, since a failed step is retried as a whole.
+    def decorator(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return fn
+    return decorator
+
+
+def create_index(conn, index):
+    # Postgres builds the index without blocking writes; a failed concurrent build
+    # leaves an INVALID index behind, which is dropped before retrying.
+    ddl = str(CreateIndex(index, if_not_exists=True).compile(dialect=conn.dialect))
+    if conn.dialect.name == 'postgresql':
+        invalid = conn.execute(text(
+            "SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+            "WHERE c.relname = :name AND NOT i.indisvalid"), {'name': index.name}).scalar()
+        if invalid:
+            conn.execute(text('DROP INDEX CONCURRENTLY IF EXISTS {}'.format(index.name)))
+        ddl = ddl.replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY', 1)
+    conn.execute(text(ddl))
+
+
+def add_foreign_key(conn, table, column, referred_table):
+    # NOT VALID followed by VALIDATE keeps the table writable while existing rows are checked.
+    # SQLite cannot add constraints to an existing table, so there it only exists on new databases.
+    if conn.dialect.name != 'postgresql':
+        return
+    name = '{}_{}_fkey'.format(table, column)
+    exists = conn.execute(text("SELECT 1 FROM pg_constraint WHERE conname = :name"), {'name': name}).scalar()
+    if not exists:
+        conn.execute(text('ALTER TABLE {} ADD CONSTRAINT {} FOREIGN KEY ({}) REFERENCES {} (id) NOT VALID'
+                          .format(table, name, column, referred_table)))
+    conn.execute(text('ALTER TABLE {} VALIDATE CONSTRAINT {}'.format(table, name)))
+
+
+def add_column(conn, column):
+    # Nullable columns without a server default are a catalog-only change in Postgres
+    table = column.table.name
+    if column.name in {existing['name'] for existing in inspect(conn).get_columns(table)}:
+        return
+    conn.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+        table, column.name, column.type.compile(dialect=conn.dialect))))
+
+
+@migration(1, 'Foreign keys and history indexes on orders and dishes_ordered')
+def order_keys_and_indexes(conn):
+    add_foreign_key(conn, 'orders', 'restaurant_id', 'restaurants')
+    add_foreign_key(conn, 'orders', 'user_id', 'users')
+    add_foreign_key(conn, 'orders', 'delivery_partner_id', 'delivery_partners')
+    add_foreign_key(conn, 'dishes_ordered', 'order_id', 'orders')
+    add_foreign_key(conn, 'dishes_ordered', 'dish_id', 'dishes')
+    for table in (Order.__table__, DishesOrdered.__table__, Dish.__table__):
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            create_index(conn, index)
+
+
+@migration(2, 'Positions for restaurants and delivery partners')
+def partner_positions(conn):
+    for table in (Restaurant.__table__, DeliveryPartner.__table__):
+        add_column(conn, table.c.latitude)
+        add_column(conn, table.c.longitude)
+
+
+@migration(3, 'Daily sales rollups per restaurant and dish')
+def sales_rollups(conn):
+    # Empty until `flask rollups rebuild` backfills them
+    RestaurantDailySales.__table__.create(conn, checkfirst=True)
+    DishDailySales.__table__.create(conn, checkfirst=True)
+
+
+@migration(4, 'Archive tables for finished orders')
+def order_archive(conn):
+    ArchivedOrder.__table__.create(conn, checkfirst=True)
+    ArchivedDishOrdered.__table__.create(conn, checkfirst=True)
+
+
+@migration(5, 'Dish lookups by restaurant and name')
+def dish_names(conn):
+    create_index(conn, next(index for index in Dish.__table__.indexes if index.name == 'ix_dishes_restaurant_id_name'))
+
+
+@migration(6, 'Idempotency keys')
+def idempotency_keys(conn):
+    IdempotencyKey.__table__.create(conn, checkfirst=True)
+
+
+def collapse_line_items(conn, model, batch_size=10000):
+    # Fills quantity and the dish snapshot of old line items and merges repeated dishes of an order
+    # into the first of their rows, batch_size orders per transaction, so locks stay short. A batch
+    # commits whole, and only rows with quantity NULL are filled, so a rerun never counts a row twice.
+    table = model.__table__
+    low, high = conn.execute(select(func.min(table.c.order_id), func.max(table.c.order_id))).one()
+    if low is None:
+        return
+    other = table.alias()
+    dish = Dish.__table__
+    for first in range(low, high + 1, batch_size):
+        batch = table.c.order_id.between(first, first + batch_size - 1)
+        with conn.engine.begin() as batch_conn:
+            batch_conn.execute(update(table).where(batch, table.c.quantity.is_(None)).values(
+                quantity=1,
+                unit_price=select(dish.c.price).where(dish.c.id == table.c.dish_id).scalar_subquery(),
+                dish_name=select(dish.c.name).where(dish.c.id == table.c.dish_id).scalar_subquery()))
+            repeated = (select(func.min(table.c.id)).where(batch, table.c.dish_id.isnot(None))
+                        .group_by(table.c.order_id, table.c.dish_id).having(func.count() > 1))
+            batch_conn.execute(update(table).where(table.c.id.in_(repeated)).values(
+                quantity=select(func.sum(other.c.quantity))
+                .where(other.c.order_id == table.c.order_id, other.c.dish_id == table.c.dish_id).scalar_subquery()))
+            kept = (select(func.min(table.c.id)).where(batch, table.c.dish_id.isnot(None))
+                    .group_by(table.c.order_id, table.c.dish_id))
+            batch_conn.execute(delete(table).where(batch, table.c.dish_id.isnot(None), table.c.id.notin_(kept)))
+
+
+@migration(7, 'Quantities and dish snapshots on line items')
+def line_item_quantities(conn):
+    for model in (DishesOrdered, ArchivedDishOrdered):
+        table = model.__table__
+        for column in (table.c.quantity, table.c.unit_price, table.c.dish_name):
+            add_column(conn, column)
+        collapse_line_items(conn, model)
+
+
+def applied_versions(conn):
+    schema_migrations.create(conn, checkfirst=True)
+    return set(conn.execute(select(schema_migrations.c.version)).scalars())
+
+
+def upgrade():
+    # A database without the application tables is created from the models and
+    # stamped with every known version; an existing one gets the pending steps.
+    applied = []
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        if conn.dialect.name == 'postgresql':
+            # Index builds and validations outlast the request statement timeout
+            conn.execute(text('SET statement_timeout = 0'))
+        done = applied_versions(conn)
+        fresh = not inspect(conn).has_table(Order.__tablename__)
+        if fresh:
+            db.metadata.create_all(conn)
+
+        for version, description, fn in MIGRATIONS:
+            if version in done:
+                continue
+            if not fresh:
+                fn(conn)
+            conn.execute(schema_migrations.insert().values(version=version, description=description))
+            applied.append((version, description))
+    return applied
+
+
+@schema_cli.command('upgrade')
+def upgrade_command():
+    """Apply pending schema migrations."""
+    applied = upgrade()
+    for version, description in applied:
+        click.echo('Applied {}: {}'.format(version, description))
+    if not applied:
+        click.echo('Schema is up to date')
+
+
+@schema_cli.command('status')
+def status_command():
+    """List schema migrations and whether they are applied."""
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        done = applied_versions(conn)
+    for version, description, fn in MIGRATIONS:
+        click.echo('[{}] {}: {}'.format('x' if version in done else ' ', version, description))
+
+
+def init_app(app):
+    app.cli.add_command(schema_cli)
@@ -2,9 +2,14 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
 
+from routing import RoutingSession
+
 from werkzeug.security import generate_password_hash, check_password_hash
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+# Orders in these statuses no longer occupy a delivery partner
+TERMINAL_ORDER_STATUSES = ('DELIVERED', 'CANCELLED', 'REST_REJECTED')
 
 restaurant_default_image = 'https://www.google.com/url?sa=i&url=https%3A%2F%2Funsplash.com%2Fs%2Fphotos%2Frestaurant&psig=AOvVaw12009lD8_ktWG7K6quioZz&ust=1715929793904000&source=images&cd=vfe&opi=89978449&ved=2ahUKEwimwO_fzpGGAxU8bmwGHVvAA9QQjRx6BAgAEBY'
 # order_dish_association = db.Table('order_dish_association',
@@ -26,6 +31,8 @@ class User(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.now)
     modified_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
 
+    orders = db.relationship('Order', back_populates='user')
+
 
 class Restaurant(db.Model):
     __tablename__ = 'restaurants'
@@ -45,9 +52,14 @@ class Restaurant(db.Model):
     close_time = db.Column(db.String, default="9:00 PM")
     rating = db.Column(db.Double, default=4.0)
     offers = db.Column(db.String, default="Free food devilery")
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
     created_at = db.Column(db.DateTime, default=datetime.now)
     modified_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
 
+    dishes = db.relationship('Dish', back_populates='restaurant')
+    orders = db.relationship('Order', back_populates='restaurant')
+
 
 class DeliveryPartner(db.Model):
     __tablename__ = 'delivery_partners'
@@ -58,15 +70,19 @@ class DeliveryPartner(db.Model):
     name = db.Column(db.String)
     mobile = db.Column(db.String)
     rating = db.Column(db.Float, default=4.0)
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
     created_at = db.Column(db.DateTime, default=datetime.now)
     modified_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
 
+    orders = db.relationship('Order', back_populates='delivery_partner')
+
 
 class Dish(db.Model):
     __tablename__ = 'dishes'
 
     id = db.Column(db.Integer, primary_key=True)
-    restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurants.id'))
+    restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurants.id'), index=True)
     name = db.Column(db.String)
     description = db.Column(db.String)
     image_url = db.Column(db.String, default="https://placehold.co/js/main.js?id=a724dadcca62e6c347623dd51681d1fb")
@@ -75,23 +91,124 @@ class Dish(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.now)
     modified_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
 
+    # Menu imports match rows to dishes by name
+    __table_args__ = (db.Index('ix_dishes_restaurant_id_name', restaurant_id, name),)
+
+    restaurant = db.relationship('Restaurant', back_populates='dishes')
+
 
 class Order(db.Model):
     __tablename__ = 'orders'
 
     id = db.Column(db.Integer, primary_key=True)
-    restaurant_id = db.Column(db.Integer)
-    user_id = db.Column(db.Integer)
-    delivery_partner_id = db.Column(db.Integer)
+    restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurants.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    delivery_partner_id = db.Column(db.Integer, db.ForeignKey('delivery_partners.id'))
     total = db.Column(db.Float)
     status = db.Column(db.String, default='PAID')
     created_at = db.Column(db.DateTime, default=datetime.now)
     modified_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
 
+    # Order history is always filtered by one owner and listed newest first
+    __table_args__ = (
+        db.Index('ix_orders_restaurant_id_created_at', restaurant_id, created_at.desc(), id.desc()),
+        db.Index('ix_orders_user_id_created_at', user_id, created_at.desc(), id.desc()),
+        db.Index('ix_orders_delivery_partner_id_created_at', delivery_partner_id, created_at.desc(), id.desc()),
+    )
+
+    restaurant = db.relationship('Restaurant', back_populates='orders')
+    user = db.relationship('User', back_populates='orders')
+    delivery_partner = db.relationship('DeliveryPartner', back_populates='orders')
+    dishes_ordered = db.relationship('DishesOrdered', back_populates='order', order_by='DishesOrdered.id')
+
 
 class DishesOrdered(db.Model):
     __tablename__ = 'dishes_ordered'
 
+    # One row per dish of an order, with the dish's name and price when it was ordered, so orders
+    # render without reading dishes
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer)
-    dish_id = db.Column(db.Integer)
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), index=True)
+    dish_id = db.Column(db.Integer, db.ForeignKey('dishes.id'), index=True)
+    quantity = db.Column(db.Integer, default=1)
+    unit_price = db.Column(db.Float)
+    dish_name = db.Column(db.String)
+
+    order = db.relationship('Order', back_populates='dishes_ordered')
+    dish = db.relationship('Dish')
+
+
+class RestaurantDailySales(db.Model):
+    __tablename__ = 'restaurant_daily_sales'
+
+    # Counters per restaurant and order day, kept by rollups.py in the order's transaction.
+    # revenue leaves out cancelled and rejected orders.
+    restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurants.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    cancelled = db.Column(db.Integer, nullable=False, default=0)
+    delivered = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+
+
+class DishDailySales(db.Model):
+    __tablename__ = 'dish_daily_sales'
+
+    # Dishes sold per restaurant and order day, cancelled and rejected orders left out
+    restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurants.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    dish_id = db.Column(db.Integer, db.ForeignKey('dishes.id'), primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+
+
+class ArchivedOrder(db.Model):
+    __tablename__ = 'orders_archive'
+
+    # Finished orders moved out of orders by archive.py, with their ids and timestamps kept
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurants.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    delivery_partner_id = db.Column(db.Integer, db.ForeignKey('delivery_partners.id'))
+    total = db.Column(db.Float)
+    status = db.Column(db.String)
+    created_at = db.Column(db.DateTime)
+    modified_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_orders_archive_restaurant_id_created_at', restaurant_id, created_at.desc(), id.desc()),
+        db.Index('ix_orders_archive_user_id_created_at', user_id, created_at.desc(), id.desc()),
+        db.Index('ix_orders_archive_delivery_partner_id_created_at', delivery_partner_id, created_at.desc(), id.desc()),
+    )
+
+    restaurant = db.relationship('Restaurant')
+    user = db.relationship('User')
+    delivery_partner = db.relationship('DeliveryPartner')
+    dishes_ordered = db.relationship('ArchivedDishOrdered', back_populates='order', order_by='ArchivedDishOrdered.id')
+
+
+class ArchivedDishOrdered(db.Model):
+    __tablename__ = 'dishes_ordered_archive'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('orders_archive.id'), index=True)
+    dish_id = db.Column(db.Integer, db.ForeignKey('dishes.id'))
+    quantity = db.Column(db.Integer, default=1)
+    unit_price = db.Column(db.Float)
+    dish_name = db.Column(db.String)
+
+    order = db.relationship('ArchivedOrder', back_populates='dishes_ordered')
+    dish = db.relationship('Dish')
+
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+
+    # One row per Idempotency-Key and caller, kept by idempotency.py. status_code is NULL while
+    # the first request is still running.
+    owner = db.Column(db.String, primary_key=True)
+    key = db.Column(db.String, primary_key=True)
+    fingerprint = db.Column(db.String, nullable=False)
+    status_code = db.Column(db.Integer)
+    response = db.Column(db.LargeBinary)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
@@ -0,0 +1,114 @@
+# nearby.py
+import heapq
+import threading
+
+from flask import current_app
+
+from cache import catalog_cache
+from geo import GridIndex, haversine_km_many
+from models import Restaurant
+from routing import db_router
+from serializers import restaurant_listing
+
+
+class RestaurantGeoIndex:
+    # Restaurants with a known position, bucketed in a grid, with their listing kept alongside
+
+    def __init__(self, cell_km=0.5):
+        self.grid = GridIndex(cell_km)
+        self.listings = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.grid)
+
+    def upsert(self, restaurant):
+        with self.lock:
+            if restaurant.latitude is None or restaurant.longitude is None:
+                self.grid.remove(restaurant.id)
+                self.listings.pop(restaurant.id, None)
+            else:
+                self.grid.add(restaurant.id, restaurant.latitude, restaurant.longitude)
+                self.listings[restaurant.id] = restaurant_listing(restaurant)
+
+    def search(self, lat, lng, radius_km, limit):
+        # Nearest `limit` restaurants within radius_km as (distance_km, listing), closest first.
+        # Rings are scanned outwards until no unseen cell can hold a closer match.
+        grid = self.grid
+        matches = []
+        with self.lock:
+            for ring in range(grid.rings_for_km(lat, radius_km)):
+                ring_min = grid.ring_min_km(lat, ring)
+                if ring_min > radius_km or (len(matches) >= limit and ring_min > -matches[0][0]):
+                    break
+                ids = list(grid.ring(lat, lng, ring))
+                if not ids:
+                    continue
+                points = [grid.points[restaurant_id] for restaurant_id in ids]
+                distances = haversine_km_many(lat, lng, [point[0] for point in points],
+                                              [point[1] for point in points])
+                for distance, restaurant_id in zip(distances, ids):
+                    if distance > radius_km:
+                        continue
+                    # Max-heap on distance holding the best `limit` matches so far
+                    if len(matches) < limit:
+                        heapq.heappush(matches, (-float(distance), restaurant_id))
+                    elif distance < -matches[0][0]:
+                        heapq.heapreplace(matches, (-float(distance), restaurant_id))
+            found = sorted((-distance, restaurant_id) for distance, restaurant_id in matches)
+            return [(distance, self.listings[restaurant_id]) for distance, restaurant_id in found]
+
+
+class NearbyRestaurants:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('NEARBY_CELL_KM', 0.5)
+        app.config.setdefault('NEARBY_DEFAULT_RADIUS_KM', 5.0)
+        app.config.setdefault('NEARBY_MAX_RADIUS_KM', 25.0)
+        app.config.setdefault('NEARBY_DEFAULT_LIMIT', 50)
+        app.config.setdefault('NEARBY_MAX_LIMIT', 200)
+        app.extensions['nearby'] = {'index': None, 'version': None, 'lock': threading.Lock()}
+
+    def catalog_version(self):
+        # The restaurant catalog version is shared between workers when the catalog cache
+        # uses a shared backend, so a write in any worker triggers a rebuild here
+        return catalog_cache.backend.get_version('restaurants')
+
+    @property
+    def index(self):
+        state = current_app.extensions['nearby']
+        version = self.catalog_version()
+        if state['index'] is None or state['version'] != version:
+            with state['lock']:
+                if state['index'] is None or state['version'] != version:
+                    index = RestaurantGeoIndex(current_app.config['NEARBY_CELL_KM'])
+                    # Kept until the next catalog version, so a lagging replica must not fill it
+                    with db_router.primary():
+                        restaurants = Restaurant.query.filter(Restaurant.latitude.isnot(None),
+                                                              Restaurant.longitude.isnot(None)).all()
+                    for restaurant in restaurants:
+                        index.upsert(restaurant)
+                    state['index'] = index
+                    state['version'] = version
+        return state['index']
+
+    def refresh(self, restaurant):
+        # Call after the catalog version was bumped for this write. If other writes
+        # happened in between, the version stays behind and the next search rebuilds.
+        state = current_app.extensions['nearby']
+        if state['index'] is None:
+            return
+        version = self.catalog_version()
+        with state['lock']:
+            state['index'].upsert(restaurant)
+            if state['version'] == version - 1:
+                state['version'] = version
+
+    def search(self, lat, lng, radius_km, limit):
+        return self.index.search(lat, lng, radius_km, limit)
+
+
+nearby_restaurants = NearbyRestaurants()
@@ -0,0 +1,208 @@
+# opening_hours.py
+import bisect
+import re
+import threading
+from collections import Counter
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from flask import current_app
+
+from cache import catalog_cache
+from models import Restaurant
+from routing import db_router
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+TIME_PATTERN = re.compile(r'^\s*(\d{1,2})(?:[:.](\d{2}))?\s*([ap])?\.?\s*m?\.?\s*$', re.IGNORECASE)
+
+
+def parse_time(text):
+    # Minutes after midnight for '9:00 AM', '9 pm', '12:30am' or '21:15'; ValueError otherwise
+    match = TIME_PATTERN.match(text or '')
+    if not match:
+        raise ValueError('Not a time: {!r}'.format(text))
+    hour, minute, half = int(match.group(1)), int(match.group(2) or 0), (match.group(3) or '').lower()
+    if minute > 59 or (half and not 1 <= hour <= 12) or hour > 23:
+        raise ValueError('Not a time: {!r}'.format(text))
+    if half:
+        hour = hour % 12 + (12 if half == 'p' else 0)
+    elif match.group(2) is None:
+        # A bare number is ambiguous
+        raise ValueError('Not a time: {!r}'.format(text))
+    return hour * 60 + minute
+
+
+def week_intervals(open_time, close_time):
+    # The same daily hours as [start, end) minutes of the week, Monday 00:00 being 0. A close
+    # at or before the open runs past midnight into the next day, Sunday's into Monday;
+    # equal times mean open around the clock.
+    opens, closes = parse_time(open_time), parse_time(close_time)
+    if opens == closes:
+        return [(0, MINUTES_PER_WEEK)]
+    length = (closes - opens) % MINUTES_PER_DAY
+    intervals = []
+    for day in range(7):
+        start = day * MINUTES_PER_DAY + opens
+        end = start + length
+        if end > MINUTES_PER_WEEK:
+            intervals.append((0, end - MINUTES_PER_WEEK))
+            end = MINUTES_PER_WEEK
+        intervals.append((start, end))
+    return sorted(intervals)
+
+
+def minute_of_week(moment):
+    return moment.weekday() * MINUTES_PER_DAY + moment.hour * 60 + moment.minute
+
+
+class IntervalIndex:
+    # Centered interval tree over the minutes of the week, with fixed centers, so intervals go in
+    # and out one at a time. Each interval is kept at the first node whose center it covers, in
+    # one list by start and one by end, which stab() walks only as far as they match. With depth
+    # bounded by log2(MINUTES_PER_WEEK), a lookup is O(log n + k). Boundaries, the minutes where
+    # some interval starts or ends, tell which lookups have the same answer.
+
+    def __init__(self):
+        self.nodes = {}
+        self.intervals = {}
+        self.boundaries = []
+        self.boundary_counts = Counter()
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def node(self, start, end):
+        # (center, starts, ends) of the node holding [start, end)
+        low, high = 0, MINUTES_PER_WEEK
+        while True:
+            center = (low + high) // 2
+            if end <= center:
+                high = center
+            elif start > center:
+                low = center + 1
+            else:
+                node = self.nodes.get(center)
+                if node is None:
+                    node = self.nodes[center] = ([], [])
+                return center, node
+
+    def add(self, key, intervals):
+        self.remove(key)
+        self.intervals[key] = intervals
+        for start, end in intervals:
+            center, (starts, ends) = self.node(start, end)
+            bisect.insort(starts, (start, key))
+            bisect.insort(ends, (-end, key))
+            for boundary in (start, end):
+                if not self.boundary_counts[boundary]:
+                    bisect.insort(self.boundaries, boundary)
+                self.boundary_counts[boundary] += 1
+
+    def remove(self, key):
+        for start, end in self.intervals.pop(key, ()):
+            center, (starts, ends) = self.node(start, end)
+            del starts[bisect.bisect_left(starts, (start, key))]
+            del ends[bisect.bisect_left(ends, (-end, key))]
+            if not starts:
+                del self.nodes[center]
+            for boundary in (start, end):
+                self.boundary_counts[boundary] -= 1
+                if not self.boundary_counts[boundary]:
+                    del self.boundary_counts[boundary]
+                    del self.boundaries[bisect.bisect_left(self.boundaries, boundary)]
+
+    def stab(self, minute):
+        # Keys with an interval covering minute
+        found = []
+        low, high = 0, MINUTES_PER_WEEK
+        while low < high:
+            center = (low + high) // 2
+            node = self.nodes.get(center)
+            if minute < center:
+                if node is not None:
+                    for start, key in node[0]:
+                        if start > minute:
+                            break
+                        found.append(key)
+                high = center
+            else:
+                if node is not None:
+                    for end, key in node[1]:
+                        if -end <= minute:
+                            break
+                        found.append(key)
+                low = center + 1
+        return found
+
+    def segment(self, minute):
+        # The last boundary at or before minute; every minute up to the next boundary stabs the same keys
+        position = bisect.bisect_right(self.boundaries, minute)
+        return self.boundaries[position - 1] if position else 0
+
+
+class OpenRestaurants:
+    # Which restaurants are open at a minute of the week, from their open_time and close_time,
+    # read as local times in OPENING_HOURS_TIMEZONE (the server's own when None). Restaurants
+    # whose hours cannot be read are never listed as open.
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('OPENING_HOURS_TIMEZONE', None)
+        app.extensions['opening_hours'] = {'index': None, 'version': None, 'lock': threading.Lock()}
+
+    def catalog_version(self):
+        # Rebuilt on a catalog version it did not see coming, like the nearby index
+        return catalog_cache.backend.get_version('restaurants')
+
+    @property
+    def index(self):
+        state = current_app.extensions['opening_hours']
+        version = self.catalog_version()
+        if state['index'] is None or state['version'] != version:
+            with state['lock']:
+                if state['index'] is None or state['version'] != version:
+                    index = IntervalIndex()
+                    # Kept until the next catalog version, so a lagging replica must not fill it
+                    with db_router.primary():
+                        rows = Restaurant.query.with_entities(Restaurant.id, Restaurant.open_time,
+                                                              Restaurant.close_time).all()
+                    for restaurant_id, open_time, close_time in rows:
+                        self.upsert(index, restaurant_id, open_time, close_time)
+                    state['index'] = index
+                    state['version'] = version
+        return state['index']
+
+    def upsert(self, index, restaurant_id, open_time, close_time):
+        try:
+            index.add(restaurant_id, week_intervals(open_time, close_time))
+        except ValueError:
+            index.remove(restaurant_id)
+
+    def refresh(self, restaurant):
+        # Call after the catalog version was bumped for this write
+        state = current_app.extensions['opening_hours']
+        if state['index'] is None:
+            return
+        version = self.catalog_version()
+        with state['lock']:
+            self.upsert(state['index'], restaurant.id, restaurant.open_time, restaurant.close_time)
+            if state['version'] == version - 1:
+                state['version'] = version
+
+    def now(self):
+        timezone = current_app.config['OPENING_HOURS_TIMEZONE']
+        return minute_of_week(datetime.now(ZoneInfo(timezone)) if timezone else datetime.now())
+
+    def open_at(self, minute):
+        # (segment, sorted ids of the restaurants open at minute)
+        index = self.index
+        with current_app.extensions['opening_hours']['lock']:
+            return index.segment(minute), sorted(index.stab(minute))
+
+
+open_restaurants = OpenRestaurants()
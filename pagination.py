@@ -0,0 +1,96 @@
+# pagination.py
+import base64
+import binascii
+import heapq
+from datetime import datetime
+from itertools import islice
+
+from flask import Response, current_app, request, stream_with_context
+from sqlalchemy import tuple_
+
+from archive import archive_horizon
+
+
+def encode_cursor(order):
+    raw = '{}|{}'.format(order.created_at.isoformat(), order.id)
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    # Raises ValueError for anything that was not produced by encode_cursor
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        created_at, order_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(created_at), int(order_id)
+    except (TypeError, UnicodeError, binascii.Error) as e:
+        raise ValueError(str(e))
+
+
+def page_args():
+    # Read limit/after/stream from the query string, raising ValueError on bad input
+    config = current_app.config
+    limit = request.args.get('limit', config['ORDER_HISTORY_PAGE_SIZE'], type=int)
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    limit = min(limit, config['ORDER_HISTORY_MAX_PAGE_SIZE'])
+
+    after = request.args.get('after')
+    after = decode_cursor(after) if after else None
+
+    stream = request.args.get('stream', '').lower() in ('1', 'true', 'yes')
+    return limit, after, stream
+
+
+def after_cursor(query, after):
+    # Orders are listed newest first, so the next page holds strictly smaller (created_at, id) keys.
+    # Works for orders and archived orders, as a query or as a select statement.
+    if after is None:
+        return query
+    model = query.column_descriptions[0]['entity']
+    return query.filter(tuple_(model.created_at, model.id) < after)
+
+
+def order_key(order):
+    return order.created_at, order.id
+
+
+def reaches_archive(orders, limit):
+    # A full page of hot orders that ends after the archive horizon has no archived order in it
+    return len(orders) <= limit or orders[-1].created_at < archive_horizon()
+
+
+def merge_newest(limit, *pages):
+    return list(islice(heapq.merge(*pages, key=order_key, reverse=True), limit))
+
+
+def cursor_page(orders, limit):
+    next_cursor = encode_cursor(orders[limit - 1]) if len(orders) > limit else None
+    return orders[:limit], next_cursor
+
+
+def keyset_page(query, limit, after, archived=None):
+    # archived, the same query on the archive, is only read once the page reaches past the hot window
+    orders = after_cursor(query, after).limit(limit + 1).all()
+    if archived is not None and reaches_archive(orders, limit):
+        orders = merge_newest(limit + 1, orders, after_cursor(archived, after).limit(limit + 1).all())
+    return cursor_page(orders, limit)
+
+
+def stream_orders(query, after, envelope, order_data, archived=None):
+    # Write the envelope, then the orders array one row at a time from a server side cursor,
+    # or from two merged in order when the archive is read as well
+    dumps = current_app.json.dumps
+    batch_size = current_app.config['ORDER_HISTORY_STREAM_BATCH_SIZE']
+    rows = after_cursor(query, after).yield_per(batch_size)
+    if archived is not None:
+        rows = heapq.merge(rows, after_cursor(archived, after).yield_per(batch_size), key=order_key, reverse=True)
+    head = dumps(envelope)[:-1]
+    head += ', "orders": [' if envelope else '"orders": ['
+
+    def generate():
+        yield head
+        for index, order in enumerate(rows):
+            yield (', ' if index else '') + dumps(order_data(order))
+        yield ']}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
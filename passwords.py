@@ -0,0 +1,105 @@
+# passwords.py
+import hmac
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import current_app, jsonify
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# Prefixes of the hashes werkzeug writes; anything else stored in a password column is plaintext
+HASH_METHODS = ('pbkdf2:', 'scrypt:')
+
+
+class PasswordHasherBusy(Exception):
+    pass
+
+
+def is_hashed(stored):
+    return stored.startswith(HASH_METHODS) and stored.count('$') == 2
+
+
+class PasswordHasher:
+    # Hashes and checks passwords with PASSWORD_HASH_METHOD, e.g. 'pbkdf2:sha256:600000' where the
+    # last part is the cost. The work runs on PASSWORD_HASH_WORKERS processes, so logins hash in
+    # parallel instead of taking turns on the GIL, with at most PASSWORD_HASH_MAX_PENDING queued per
+    # process; past that a request waits up to PASSWORD_HASH_TIMEOUT seconds, then is turned away.
+    # PASSWORD_HASH_WORKERS = 0 hashes in the request's own thread.
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000')
+        app.config.setdefault('PASSWORD_HASH_SALT_LENGTH', 16)
+        app.config.setdefault('PASSWORD_HASH_WORKERS', 2)
+        app.config.setdefault('PASSWORD_HASH_MAX_PENDING', 64)
+        app.config.setdefault('PASSWORD_HASH_TIMEOUT', 10)
+        self.reset(app)
+        app.register_error_handler(PasswordHasherBusy, self.busy)
+
+    def reset(self, app):
+        # The pool's processes belong to the parent, a forked worker starts its own
+        app.extensions['passwords'] = {'pool': None, 'dummy': None, 'lock': threading.Lock(),
+                                       'pending': threading.BoundedSemaphore(app.config['PASSWORD_HASH_MAX_PENDING'])}
+
+    @property
+    def pool(self):
+        state = current_app.extensions['passwords']
+        if state['pool'] is None:
+            with state['lock']:
+                if state['pool'] is None:
+                    # spawn, not fork: the app process has threads and open connections
+                    state['pool'] = ProcessPoolExecutor(current_app.config['PASSWORD_HASH_WORKERS'],
+                                                        mp_context=multiprocessing.get_context('spawn'))
+        return state['pool']
+
+    def call(self, function, *args):
+        config = current_app.config
+        if not config['PASSWORD_HASH_WORKERS']:
+            return function(*args)
+        pending = current_app.extensions['passwords']['pending']
+        if not pending.acquire(timeout=config['PASSWORD_HASH_TIMEOUT']):
+            raise PasswordHasherBusy()
+        try:
+            return self.pool.submit(function, *args).result()
+        finally:
+            pending.release()
+
+    def hash(self, password):
+        config = current_app.config
+        return self.call(generate_password_hash, password, config['PASSWORD_HASH_METHOD'],
+                         config['PASSWORD_HASH_SALT_LENGTH'])
+
+    def verify(self, stored, password):
+        # (matches, new hash or None). The new hash is set when a matching password was stored as
+        # plaintext or with another method or cost, so rows move to the current one as callers log in.
+        if not stored:
+            # Unknown users cost as much as wrong passwords, so timing does not tell usernames apart
+            self.call(check_password_hash, self.dummy_hash(), password)
+            return False, None
+        if not is_hashed(stored):
+            if not hmac.compare_digest(stored.encode(), password.encode()):
+                return False, None
+            return True, self.hash(password)
+        if not self.call(check_password_hash, stored, password):
+            return False, None
+        if not stored.startswith(current_app.config['PASSWORD_HASH_METHOD'] + '$'):
+            return True, self.hash(password)
+        return True, None
+
+    def busy(self, e):
+        response = jsonify({'msg': '', 'error': 'Server busy, retry shortly'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '1'
+        return response
+
+    def dummy_hash(self):
+        state = current_app.extensions['passwords']
+        if state['dummy'] is None:
+            state['dummy'] = self.hash('')
+        return state['dummy']
+
+
+passwords = PasswordHasher()
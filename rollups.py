@@ -0,0 +1,164 @@
+# rollups.py
+from collections import Counter, defaultdict
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import case, func, insert, make_url, select, text, union_all
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import (db, ArchivedDishOrdered, ArchivedOrder, Dish, DishDailySales, DishesOrdered, Order,
+                    RestaurantDailySales)
+
+rollups_cli = AppGroup('rollups', help='Maintain the per-restaurant sales rollups.')
+
+# Orders in these statuses bring no revenue and no dish sales
+CANCELLED_STATUSES = ('CANCELLED', 'REST_REJECTED')
+
+# INSERT ... ON CONFLICT, used here and by idempotency.py, by dialect name
+UPSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+
+def check_upserts(app):
+    # Fails at startup, rather than with a KeyError on the first order
+    backend = make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name()
+    if backend not in UPSERTS:
+        raise RuntimeError('SQLALCHEMY_DATABASE_URI uses {}, but the sales rollups and Idempotency-Key need '
+                           'INSERT ... ON CONFLICT, only available on {}'
+                           .format(backend, ' and '.join(sorted(UPSERTS))))
+
+
+def status_counts(status):
+    # (counts as a sale, cancelled, delivered) for an order in status
+    cancelled = status in CANCELLED_STATUSES
+    return 0 if cancelled else 1, 1 if cancelled else 0, 1 if status == 'DELIVERED' else 0
+
+
+def increment(model, rows, counters):
+    # Adds each row's counters, inserting rows that do not exist yet. One INSERT ... ON CONFLICT
+    # statement, so concurrent orders of a restaurant never lose an update.
+    if not rows:
+        return
+    table = model.__table__
+    statement = UPSERTS[db.session.get_bind().dialect.name](table).values(rows)
+    statement = statement.on_conflict_do_update(
+        index_elements=[column.name for column in table.primary_key.columns],
+        set_={counter: table.c[counter] + statement.excluded[counter] for counter in counters})
+    db.session.execute(statement)
+
+
+def record_order(order, quantities):
+    # Call in the order's transaction once it is flushed, with {dish id: quantity}
+    apply_counts(order, (0, 0, 0), 1, quantities)
+
+
+def record_status_change(order, old_status):
+    # Call in the transaction changing order.status away from old_status
+    if order.status != old_status:
+        apply_counts(order, status_counts(old_status), 0, None)
+
+
+def apply_counts(order, before, placed, quantities):
+    sale, cancelled, delivered = (now - then for now, then in zip(status_counts(order.status), before))
+    if not (placed or sale or cancelled or delivered):
+        return
+    day = order.created_at.date()
+    increment(RestaurantDailySales, [{
+        'restaurant_id': order.restaurant_id, 'day': day, 'orders': placed,
+        'cancelled': cancelled, 'delivered': delivered, 'revenue': (order.total or 0) * sale}],
+        ('orders', 'cancelled', 'delivered', 'revenue'))
+
+    if sale:
+        if quantities is None:
+            quantities = Counter()
+            for dish_id, quantity in db.session.execute(select(DishesOrdered.dish_id, DishesOrdered.quantity)
+                                                        .filter_by(order_id=order.id)):
+                quantities[dish_id] += quantity or 1
+        # Sorted, so concurrent orders lock the dish rows in the same order
+        increment(DishDailySales, [
+            {'restaurant_id': order.restaurant_id, 'day': day, 'dish_id': dish_id, 'quantity': quantity * sale}
+            for dish_id, quantity in sorted(quantities.items())], ('quantity',))
+
+
+def restaurant_sales(restaurant_id, start, end, top):
+    # Days from start to end (inclusive) that had orders, with each day's `top` dishes and the
+    # `top` dishes of the whole range. Reads one row per day and dish, however many orders there were.
+    days = db.session.scalars(select(RestaurantDailySales)
+                              .filter(RestaurantDailySales.restaurant_id == restaurant_id,
+                                      RestaurantDailySales.day.between(start, end))
+                              .order_by(RestaurantDailySales.day)).all()
+    dish_rows = db.session.execute(select(DishDailySales.day, DishDailySales.dish_id, DishDailySales.quantity)
+                                   .filter(DishDailySales.restaurant_id == restaurant_id,
+                                           DishDailySales.day.between(start, end),
+                                           DishDailySales.quantity > 0)).all()
+
+    by_day = defaultdict(Counter)
+    overall = Counter()
+    for day, dish_id, quantity in dish_rows:
+        by_day[day][dish_id] += quantity
+        overall[dish_id] += quantity
+    names = dict(db.session.execute(select(Dish.id, Dish.name).filter(Dish.id.in_(list(overall)))).all()) if overall else {}
+
+    def top_dishes(counts):
+        return [{'dish_id': dish_id, 'name': names.get(dish_id), 'quantity': quantity}
+                for dish_id, quantity in sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:top]]
+
+    day_data = [{'day': row.day.isoformat(), 'orders': row.orders, 'cancelled': row.cancelled,
+                 'delivered': row.delivered, 'revenue': round(row.revenue, 2),
+                 'top_dishes': top_dishes(by_day[row.day])} for row in days]
+    totals = {key: sum(day[key] for day in day_data) for key in ('orders', 'cancelled', 'delivered')}
+    totals['revenue'] = round(sum(row.revenue for row in days), 2)
+    return {'days': day_data, 'totals': totals, 'top_dishes': top_dishes(overall)}
+
+
+def rebuild():
+    # Recomputes both tables from the orders, archived or not, with two INSERT ... SELECT statements.
+    # On Postgres the tables are locked first: orders placed meanwhile wait for the rebuild and
+    # then add to the fresh counters, so none is missed or counted twice.
+    session = db.session
+    if session.get_bind().dialect.name == 'postgresql':
+        session.execute(text('SET LOCAL statement_timeout = 0'))
+        session.execute(text('LOCK TABLE restaurant_daily_sales, dish_daily_sales IN EXCLUSIVE MODE'))
+    session.execute(DishDailySales.__table__.delete())
+    session.execute(RestaurantDailySales.__table__.delete())
+
+    # Archived orders still count
+    orders = union_all(
+        select(Order.id, Order.restaurant_id, Order.total, Order.status, Order.created_at),
+        select(ArchivedOrder.id, ArchivedOrder.restaurant_id, ArchivedOrder.total, ArchivedOrder.status,
+               ArchivedOrder.created_at)).subquery()
+    lines = union_all(select(DishesOrdered.order_id, DishesOrdered.dish_id, DishesOrdered.quantity),
+                      select(ArchivedDishOrdered.order_id, ArchivedDishOrdered.dish_id,
+                             ArchivedDishOrdered.quantity)).subquery()
+
+    day = func.date(orders.c.created_at)
+    cancelled = orders.c.status.in_(CANCELLED_STATUSES)
+    session.execute(insert(RestaurantDailySales).from_select(
+        ['restaurant_id', 'day', 'orders', 'cancelled', 'delivered', 'revenue'],
+        select(orders.c.restaurant_id, day, func.count(orders.c.id),
+               func.sum(case((cancelled, 1), else_=0)),
+               func.sum(case((orders.c.status == 'DELIVERED', 1), else_=0)),
+               func.coalesce(func.sum(case((cancelled, 0), else_=orders.c.total)), 0))
+        .filter(orders.c.restaurant_id.isnot(None), orders.c.created_at.isnot(None))
+        .group_by(orders.c.restaurant_id, day)))
+    session.execute(insert(DishDailySales).from_select(
+        ['restaurant_id', 'day', 'dish_id', 'quantity'],
+        select(orders.c.restaurant_id, day, lines.c.dish_id, func.sum(func.coalesce(lines.c.quantity, 1)))
+        .join(lines, lines.c.order_id == orders.c.id)
+        .filter(orders.c.restaurant_id.isnot(None), orders.c.created_at.isnot(None), lines.c.dish_id.isnot(None),
+                orders.c.status.is_(None) | ~cancelled)
+        .group_by(orders.c.restaurant_id, day, lines.c.dish_id)))
+    session.commit()
+    return (session.scalar(select(func.count()).select_from(RestaurantDailySales)),
+            session.scalar(select(func.count()).select_from(DishDailySales)))
+
+
+@rollups_cli.command('rebuild')
+def rebuild_command():
+    """Rebuild the sales rollups from the orders table."""
+    days, dish_days = rebuild()
+    click.echo('Rebuilt {} restaurant days and {} dish days'.format(days, dish_days))
+
+
+def init_app(app):
+    check_upserts(app)
+    app.cli.add_command(rollups_cli)
@@ -0,0 +1,128 @@
+# routing.py
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, g, has_request_context
+from flask_jwt_extended import get_jwt_identity
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.sql import Select
+
+
+def engine_options(url, config):
+    options = {'pool_pre_ping': config['DB_POOL_PRE_PING'], 'pool_recycle': config['DB_POOL_RECYCLE']}
+    # SQLite gets its pool from flask_sqlalchemy, which does not take a size
+    if not url.startswith('sqlite'):
+        options.update(pool_size=config['DB_POOL_SIZE'], max_overflow=config['DB_MAX_OVERFLOW'],
+                       pool_timeout=config['DB_POOL_TIMEOUT'])
+    if url.startswith('postgresql') and config['DB_STATEMENT_TIMEOUT_MS']:
+        options['connect_args'] = {'options': '-c statement_timeout={}'.format(config['DB_STATEMENT_TIMEOUT_MS'])}
+    return options
+
+
+def current_identity():
+    try:
+        return get_jwt_identity()
+    except RuntimeError:
+        return None
+
+
+class RoutingSession(Session):
+    # Selects run on a replica inside views marked with @replica_reads, unless this
+    # session already wrote or the caller wrote recently. Everything else uses the primary.
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and isinstance(clause, Select) and not self._flushing and not self.info.get('wrote')
+                and has_request_context() and g.get('_replica_reads')):
+            replicas = current_app.extensions['db_router']['replicas']
+            if replicas:
+                return self._db.engines[replicas[next(current_app.extensions['db_router']['next']) % len(replicas)]]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def after_flush(session, flush_context):
+    session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def after_commit(session):
+    if session.info.pop('wrote', False) and has_request_context():
+        identity = current_identity()
+        if identity is not None:
+            db_router.record_write(identity)
+
+
+class DatabaseRouter:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # Must run before db.init_app, which creates the engines from this config
+        app.config.setdefault('DB_POOL_SIZE', 10)
+        app.config.setdefault('DB_MAX_OVERFLOW', 20)
+        app.config.setdefault('DB_POOL_TIMEOUT', 30)
+        app.config.setdefault('DB_POOL_PRE_PING', True)
+        app.config.setdefault('DB_POOL_RECYCLE', 1800)
+        app.config.setdefault('DB_STATEMENT_TIMEOUT_MS', None)
+        app.config.setdefault('DATABASE_REPLICA_URLS', [])
+        app.config.setdefault('DB_READ_YOUR_WRITES_SECONDS', 5)
+
+        options = engine_options(app.config['SQLALCHEMY_DATABASE_URI'], app.config)
+        options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+        binds = dict(app.config.get('SQLALCHEMY_BINDS', {}))
+        replicas = []
+        for position, url in enumerate(app.config['DATABASE_REPLICA_URLS']):
+            key = 'replica_{}'.format(position)
+            binds[key] = dict(engine_options(url, app.config), url=url)
+            replicas.append(key)
+        app.config['SQLALCHEMY_BINDS'] = binds
+
+        app.extensions['db_router'] = {'replicas': replicas, 'next': itertools.count(),
+                                       'writes': {}, 'lock': threading.Lock()}
+
+    def record_write(self, identity):
+        state = current_app.extensions['db_router']
+        if not state['replicas']:
+            return
+        now = time.monotonic()
+        window = current_app.config['DB_READ_YOUR_WRITES_SECONDS']
+        with state['lock']:
+            writes = state['writes']
+            writes[identity] = now
+            if len(writes) > 10000:
+                for key in [key for key, written_at in writes.items() if now - written_at > window]:
+                    del writes[key]
+
+    def wrote_recently(self, identity):
+        # Per process: with several workers a caller may land on one that has not seen its write,
+        # so DB_READ_YOUR_WRITES_SECONDS should also cover the usual replica lag.
+        written_at = current_app.extensions['db_router']['writes'].get(identity)
+        return written_at is not None and time.monotonic() - written_at < current_app.config['DB_READ_YOUR_WRITES_SECONDS']
+
+    @contextmanager
+    def primary(self):
+        previous = g.get('_replica_reads')
+        g._replica_reads = False
+        try:
+            yield
+        finally:
+            g._replica_reads = previous
+
+
+def replica_reads(view):
+    # Place below @jwt_required() so the caller is known
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g._replica_reads = not db_router.wrote_recently(current_identity())
+        return view(*args, **kwargs)
+    return wrapper
+
+
+db_router = DatabaseRouter()
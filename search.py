@@ -0,0 +1,285 @@
+# search.py
+import bisect
+import heapq
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from models import Dish, Restaurant
+
+TOKEN_RE = re.compile(r'\w+')
+
+# A match in a name counts for more than one in a cuisine or a description
+RESTAURANT_FIELDS = (('name', 3.0), ('cuisine', 2.0))
+DISH_FIELDS = (('name', 3.0), ('description', 1.0))
+
+# Score factor for a token that only matches the typed prefix
+PREFIX_FACTOR = 0.8
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.casefold()) if text else []
+
+
+def restaurant_document(restaurant):
+    return ('restaurant', restaurant.id), [(getattr(restaurant, field), weight) for field, weight in RESTAURANT_FIELDS]
+
+
+def dish_document(dish):
+    return ('dish', dish.id), [(getattr(dish, field), weight) for field, weight in DISH_FIELDS]
+
+
+class InvertedIndex:
+    # token -> {document: weight}, plus a sorted vocabulary for prefix lookups.
+    # Documents are ('restaurant', id) or ('dish', id) keys.
+    #
+    # Tokens with more than top_threshold documents also keep, per weight, the best
+    # documents by rating. Within one weight the rating alone decides the order, so
+    # single-term queries can merge those short lists instead of whole postings.
+    # Each list holds exactly the best len(list) documents of its weight, between
+    # top_size and top_capacity of them, or all of them when `complete` is set.
+
+    def __init__(self, rating_weight=0.2, max_expansions=64, min_prefix=2, top_size=100, top_threshold=128):
+        self.postings = {}
+        self.vocabulary = []
+        self.documents = {}
+        self.top = {}
+        self.rating_weight = rating_weight
+        self.max_expansions = max_expansions
+        self.min_prefix = min_prefix
+        self.top_size = top_size
+        self.top_threshold = top_threshold
+        self.top_capacity = top_size + top_size // 2
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, document, fields, rating):
+        # fields is a list of (text, weight); a token keeps the best weight it was seen with
+        weights = {}
+        for text, weight in fields:
+            for token in tokenize(text):
+                if weights.get(token, 0) < weight:
+                    weights[token] = weight
+
+        rating = rating or 0.0
+        with self.lock:
+            self._remove(document)
+            for token, weight in weights.items():
+                posting = self.postings.get(token)
+                if posting is None:
+                    posting = self.postings[token] = {}
+                    bisect.insort(self.vocabulary, token)
+                posting[document] = weight
+
+                tiers = self.top.get(token)
+                if tiers is not None:
+                    tier = tiers.setdefault(weight, [True, []])
+                    complete, best = tier
+                    entry = (-rating, document)
+                    if complete or entry < best[-1]:
+                        bisect.insort(best, entry)
+                        if len(best) > self.top_capacity:
+                            tier[0] = False
+                            del best[self.top_capacity:]
+            self.documents[document] = (tuple(weights), rating)
+            for token in weights:
+                if token not in self.top and len(self.postings[token]) > self.top_threshold:
+                    self.top_tiers(token)
+
+    def remove(self, document):
+        with self.lock:
+            self._remove(document)
+
+    def _remove(self, document):
+        entry = self.documents.pop(document, None)
+        if entry is None:
+            return
+        rating = entry[1]
+        for token in entry[0]:
+            posting = self.postings[token]
+            weight = posting.pop(document)
+            if not posting:
+                del self.postings[token]
+                del self.vocabulary[bisect.bisect_left(self.vocabulary, token)]
+
+            tiers = self.top.get(token)
+            if tiers is None or weight not in tiers:
+                continue
+            complete, best = tiers[weight]
+            position = bisect.bisect_left(best, (-rating, document))
+            if position < len(best) and best[position][1] == document:
+                del best[position]
+                # A list that ran short can no longer answer a full page, rebuild it when next needed
+                if not complete and len(best) < self.top_size:
+                    del self.top[token]
+
+    def top_tiers(self, token):
+        # {weight: [complete, [(-rating, document)]]} for a large posting
+        tiers = self.top.get(token)
+        if tiers is None:
+            grouped = {}
+            documents = self.documents
+            for document, weight in self.postings[token].items():
+                grouped.setdefault(weight, []).append((-documents[document][1], document))
+            tiers = self.top[token] = {
+                weight: [len(entries) <= self.top_capacity, heapq.nsmallest(self.top_capacity, entries)]
+                for weight, entries in grouped.items()}
+        return tiers
+
+    def single_term(self, matches, limit):
+        documents = self.documents
+        rating_weight = self.rating_weight
+        scores = {}
+        for token, posting, factor in matches:
+            if len(posting) > self.top_threshold and limit <= self.top_size:
+                entries = ((document, weight, -negative_rating)
+                           for weight, (complete, best) in self.top_tiers(token).items()
+                           for negative_rating, document in best[:limit])
+            else:
+                entries = ((document, weight, documents[document][1]) for document, weight in posting.items())
+            for document, weight, rating in entries:
+                score = weight * factor + rating_weight * rating
+                if score > scores.get(document, 0):
+                    scores[document] = score
+        return heapq.nlargest(limit, ((score, document) for document, score in scores.items()))
+
+    def expand(self, prefix):
+        vocabulary = self.vocabulary
+        position = bisect.bisect_left(vocabulary, prefix)
+        tokens = []
+        while (position < len(vocabulary) and len(tokens) < self.max_expansions
+               and vocabulary[position].startswith(prefix)):
+            tokens.append(vocabulary[position])
+            position += 1
+        return tokens
+
+    def search(self, query, limit):
+        # Every term must match. The last term also matches as a prefix so results
+        # show up while the user is still typing. Returns [(score, document)], best first.
+        terms = tokenize(query)
+        if not terms:
+            return []
+
+        with self.lock:
+            matches = []
+            for position, term in enumerate(terms):
+                if position == len(terms) - 1 and len(term) >= self.min_prefix:
+                    tokens = self.expand(term)
+                else:
+                    tokens = [term] if term in self.postings else []
+                if not tokens:
+                    return []
+                matches.append([(self.postings[token], 1.0 if token == term else PREFIX_FACTOR)
+                                for token in tokens])
+
+            if len(matches) == 1:
+                return self.single_term([(token, posting, factor)
+                                         for token, (posting, factor) in zip(tokens, matches[0])], limit)
+
+            # Start from the most selective term and only probe the others
+            matches.sort(key=lambda postings: sum(len(posting) for posting, factor in postings))
+            scores = {}
+            for posting, factor in matches[0]:
+                for document, weight in posting.items():
+                    if weight * factor > scores.get(document, 0):
+                        scores[document] = weight * factor
+
+            for postings in matches[1:]:
+                narrowed = {}
+                for document, score in scores.items():
+                    best = 0
+                    for posting, factor in postings:
+                        weight = posting.get(document)
+                        if weight is not None and weight * factor > best:
+                            best = weight * factor
+                    if best:
+                        narrowed[document] = score + best
+                scores = narrowed
+                if not scores:
+                    return []
+
+            documents = self.documents
+            rating_weight = self.rating_weight
+            return heapq.nlargest(limit, ((score + rating_weight * documents[document][1], document)
+                                          for document, score in scores.items()))
+
+
+class SearchIndex:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SEARCH_RATING_WEIGHT', 0.2)
+        app.config.setdefault('SEARCH_MAX_EXPANSIONS', 64)
+        app.config.setdefault('SEARCH_MIN_PREFIX', 2)
+        app.config.setdefault('SEARCH_SYNC_SECONDS', 30)
+        app.config.setdefault('SEARCH_DEFAULT_LIMIT', 20)
+        app.config.setdefault('SEARCH_MAX_LIMIT', 100)
+        app.extensions['search'] = {'index': None, 'synced_at': 0.0, 'watermark': None, 'lock': threading.Lock()}
+
+    @property
+    def index(self):
+        # Built on first use. Writes in this process update it directly; writes from other
+        # workers are picked up every SEARCH_SYNC_SECONDS from the modified_at columns.
+        state = current_app.extensions['search']
+        sync_seconds = current_app.config['SEARCH_SYNC_SECONDS']
+        if state['index'] is None or time.monotonic() - state['synced_at'] > sync_seconds:
+            with state['lock']:
+                if state['index'] is None:
+                    state['index'] = self.build(state)
+                elif time.monotonic() - state['synced_at'] > sync_seconds:
+                    self.sync(state)
+        return state['index']
+
+    def build(self, state):
+        config = current_app.config
+        index = InvertedIndex(config['SEARCH_RATING_WEIGHT'], config['SEARCH_MAX_EXPANSIONS'],
+                              config['SEARCH_MIN_PREFIX'], config['SEARCH_MAX_LIMIT'])
+        state['watermark'] = datetime.now()
+        for restaurant in Restaurant.query.yield_per(1000):
+            index.add(*restaurant_document(restaurant), restaurant.rating)
+        for dish in Dish.query.yield_per(1000):
+            index.add(*dish_document(dish), dish.rating)
+        state['synced_at'] = time.monotonic()
+        return index
+
+    def sync(self, state):
+        # Re-index rows changed since the last sync. The overlap of one sync period
+        # covers transactions that committed after the previous pass started.
+        index = state['index']
+        since = state['watermark'] - timedelta(seconds=current_app.config['SEARCH_SYNC_SECONDS'])
+        state['watermark'] = datetime.now()
+        for restaurant in Restaurant.query.filter(Restaurant.modified_at >= since):
+            index.add(*restaurant_document(restaurant), restaurant.rating)
+        for dish in Dish.query.filter(Dish.modified_at >= since):
+            index.add(*dish_document(dish), dish.rating)
+        state['synced_at'] = time.monotonic()
+
+    def add_restaurant(self, restaurant):
+        index = current_app.extensions['search']['index']
+        if index is not None:
+            index.add(*restaurant_document(restaurant), restaurant.rating)
+
+    def add_dish(self, dish):
+        index = current_app.extensions['search']['index']
+        if index is not None:
+            index.add(*dish_document(dish), dish.rating)
+
+    def add_dishes(self, dish_ids):
+        # After a bulk write, the dishes are read back only when this process has built the index
+        index = current_app.extensions['search']['index']
+        if index is not None and dish_ids:
+            for dish in Dish.query.filter(Dish.id.in_(dish_ids)):
+                index.add(*dish_document(dish), dish.rating)
+
+    def search(self, query, limit):
+        return self.index.search(query, limit)
+
+
+search_index = SearchIndex()
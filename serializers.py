@@ -0,0 +1,233 @@
+# serializers.py
+from datetime import date
+from operator import attrgetter
+
+from flask import request
+from flask.json.provider import DefaultJSONProvider
+
+from cache import LRUCache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Projections kept per serializer. ?fields= comes from the client, so the variants are
+# keyed by the known names it selects and bounded.
+VARIANT_CACHE_SIZE = 64
+
+
+def row_values(attributes):
+    # The attributes of a row as a tuple; attrgetter alone gives a bare value for one attribute
+    if len(attributes) > 1:
+        return attrgetter(*attributes)
+    if attributes:
+        get = attrgetter(attributes[0])
+        return lambda row: (get(row),)
+    return lambda row: ()
+
+
+class Serializer:
+    # Row -> dict of column values. fields are attribute names, or (key, attribute)
+    # pairs where the response key differs from the column.
+
+    def __init__(self, fields):
+        self.fields = tuple((field, field) if isinstance(field, str) else tuple(field) for field in fields)
+        self.keys = tuple(key for key, attribute in self.fields)
+        for key, attribute in self.fields:
+            if not attribute.isidentifier():
+                raise ValueError('Not an attribute name: {!r}'.format(attribute))
+        self.build = self.builder()
+        self.variants = LRUCache(VARIANT_CACHE_SIZE)
+
+    def __call__(self, row):
+        return self.build(row)
+
+    def builder(self):
+        keys, values = self.keys, row_values([attribute for key, attribute in self.fields])
+
+        def build(row):
+            return dict(zip(keys, values(row)))
+        return build
+
+    def empty(self):
+        return dict.fromkeys(self.keys)
+
+    def names(self, paths):
+        # The known top level names among paths, sorted; unknown names are dropped
+        return tuple(sorted({path.split('.', 1)[0] for path in paths}.intersection(self.keys)))
+
+    def only(self, paths):
+        # paths comes from fields_arg(); only top level names apply to a flat row
+        if paths is None:
+            return self
+        names = self.names(paths)
+        variant = self.variants.get(names)
+        if variant is None:
+            variant = Serializer([field for field in self.fields if field[0] in names])
+            self.variants.set(names, variant)
+        return variant
+
+
+class Related:
+    # A section read from a relationship: one related row (None gives all keys as None), or
+    # many rows. getter is an attribute name or a function of the row.
+
+    def __init__(self, getter, serializer, many=False):
+        self.getter = getter
+        self.serializer = serializer
+        self.many = many
+        self.build = self.builder()
+
+    def __call__(self, row):
+        return self.build(row)
+
+    def builder(self):
+        get = attrgetter(self.getter) if isinstance(self.getter, str) else self.getter
+        serialize, keys = self.serializer.build, self.serializer.keys
+        if self.many:
+            def build(row):
+                return [serialize(item) for item in get(row)]
+        else:
+            def build(row):
+                value = get(row)
+                return serialize(value) if value is not None else dict.fromkeys(keys)
+        return build
+
+    def names(self, paths):
+        return self.serializer.names(paths)
+
+    def only(self, paths):
+        return Related(self.getter, self.serializer.only(paths), self.many)
+
+
+class Record:
+    # Nested response built from named sections, each a Serializer applied to the row itself or
+    # a Related. Every level is a closure over the next, so a call does no attribute lookups.
+
+    def __init__(self, **sections):
+        self.sections = sections
+        self.build = self.builder()
+        self.variants = LRUCache(VARIANT_CACHE_SIZE)
+
+    def __call__(self, row):
+        return self.build(row)
+
+    def builder(self):
+        builds = tuple((key, section.build) for key, section in self.sections.items())
+
+        def build(row):
+            return {key: section(row) for key, section in builds}
+        return build
+
+    def only(self, paths):
+        # "restaurant" keeps the whole section, "restaurant.name" only that field of it
+        if paths is None:
+            return self
+        wanted = {}
+        for path in paths:
+            section, _, rest = path.partition('.')
+            if section in self.sections:
+                if not rest:
+                    wanted[section] = None
+                elif wanted.get(section, ()) is not None:
+                    wanted[section] = wanted.get(section, ()) + (rest,)
+        # None keeps the whole section, otherwise its known field names
+        key = tuple(sorted((section, rests if rests is None else self.sections[section].names(rests))
+                           for section, rests in wanted.items()))
+        variant = self.variants.get(key)
+        if variant is None:
+            selected = dict(key)
+            variant = Record(**{name: section if selected[name] is None else section.only(selected[name])
+                                for name, section in self.sections.items() if name in selected})
+            self.variants.set(key, variant)
+        return variant
+
+
+def fields_arg():
+    # ?fields=id,name,restaurant.rating as a sorted tuple of paths, or None for every field
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    return tuple(sorted({field.strip() for field in fields.split(',') if field.strip()})) or None
+
+
+restaurant_listing = Serializer(['id', 'name', 'mobile', 'address', 'image_url', 'reviews', 'distance',
+                                 'expected_delivery_time', 'cuisine', 'open_time', 'close_time', 'rating', 'offers'])
+restaurant_summary = Serializer(['id', 'name', 'distance', 'mobile', 'address', 'rating', 'image_url',
+                                 'expected_delivery_time', ('opens_at', 'open_time'), ('closes_at', 'close_time')])
+restaurant_detail = Serializer(restaurant_summary.fields + (('reviews', 'reviews'), ('cuisine', 'cuisine'),
+                                                            ('offers', 'offers')))
+dish_listing = Serializer(['id', 'name', 'description', 'image_url', 'price', 'rating', 'restaurant_id'])
+# A line item of an order, from the name and price stored when it was ordered
+ordered_dish = Serializer([('id', 'dish_id'), ('name', 'dish_name'), ('price', 'unit_price'), 'quantity'])
+order_summary = Serializer(['total', 'status', ('order_date', 'created_at'), 'id'])
+user_contact = Serializer(['address', 'name', 'mobile', 'id'])
+user_profile = Serializer(['name', 'address', 'mobile', 'type'])
+partner_contact = Serializer(['name', 'mobile', 'id'])
+
+restaurant_order = Record(order=order_summary,
+                          user=Related('user', user_contact),
+                          delivery_partner=Related('delivery_partner', partner_contact),
+                          dishes=Related('dishes_ordered', ordered_dish, many=True))
+delivery_partner_order = Record(order=order_summary,
+                                user=Related('user', user_contact),
+                                restaurant=Related('restaurant', restaurant_summary),
+                                dishes=Related('dishes_ordered', ordered_dish, many=True))
+user_order = Record(order=order_summary,
+                    delivery_partner=Related('delivery_partner', partner_contact),
+                    restaurant=Related('restaurant', restaurant_summary),
+                    dishes=Related('dishes_ordered', ordered_dish, many=True))
+
+
+def iso_default(o):
+    if isinstance(o, date):
+        return o.isoformat()
+    return DefaultJSONProvider.default(o)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    # Flask's provider with orjson doing the work when it is installed. JSON_DATETIME_FORMAT
+    # 'http' keeps Flask's RFC 822 dates; 'iso' lets orjson write datetimes natively.
+
+    def __init__(self, app):
+        super().__init__(app)
+        self.datetime_format = app.config['JSON_DATETIME_FORMAT']
+        self.use_orjson = orjson is not None and app.config['JSON_ENCODER'] != 'stdlib'
+        if self.datetime_format == 'iso':
+            self.default = iso_default
+
+    def options(self):
+        options = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        if self.datetime_format != 'iso':
+            options |= orjson.OPT_PASSTHROUGH_DATETIME
+        return options
+
+    def dumps(self, obj, **kwargs):
+        # Callers passing stdlib json options get the stdlib encoder
+        if not self.use_orjson or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self.options()).decode()
+
+    def loads(self, s, **kwargs):
+        if not self.use_orjson or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if not self.use_orjson:
+            return super().response(*args, **kwargs)
+        options = self.options()
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            options |= orjson.OPT_INDENT_2
+        body = orjson.dumps(self._prepare_response_obj(args, kwargs), default=self.default, option=options)
+        return self._app.response_class(body + b'\n', mimetype=self.mimetype)
+
+
+def init_app(app):
+    # Before metrics.init_app, which wraps whichever provider is installed
+    app.config.setdefault('JSON_ENCODER', 'auto')
+    app.config.setdefault('JSON_DATETIME_FORMAT', 'http')
+    app.json = FastJSONProvider(app)
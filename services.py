@@ -1,8 +1,101 @@
 # services.py
-from models import db, User
+from collections import Counter
+
+from sqlalchemy import insert, select
+from sqlalchemy.orm import joinedload, selectinload
+
+from models import db, User, Dish, Order, DishesOrdered, ArchivedOrder
+import rollups
 
 
 def create_user(name, username, password, address, mobile, user_type):
     new_user = User(name=name, username=username, password=password, address=address, mobile=mobile, type=user_type)
     db.session.add(new_user)
     db.session.commit()
+
+
+# Orders with their user, restaurant, delivery partner and line items in two round trips.
+# Line items carry their dish's name and price, so dishes is not read.
+ORDER_HISTORY_OPTIONS = (joinedload(Order.user),
+                         joinedload(Order.restaurant),
+                         joinedload(Order.delivery_partner),
+                         selectinload(Order.dishes_ordered))
+
+
+ARCHIVED_ORDER_HISTORY_OPTIONS = (joinedload(ArchivedOrder.user),
+                                  joinedload(ArchivedOrder.restaurant),
+                                  joinedload(ArchivedOrder.delivery_partner),
+                                  selectinload(ArchivedOrder.dishes_ordered))
+
+
+def order_history_query(**filters):
+    return (Order.query.filter_by(**filters)
+            .options(*ORDER_HISTORY_OPTIONS)
+            .order_by(Order.created_at.desc(), Order.id.desc()))
+
+
+def archived_order_history_query(**filters):
+    return (ArchivedOrder.query.filter_by(**filters)
+            .options(*ARCHIVED_ORDER_HISTORY_OPTIONS)
+            .order_by(ArchivedOrder.created_at.desc(), ArchivedOrder.id.desc()))
+
+
+def order_history_select(**filters):
+    # The same as order_history_query, as a statement for an AsyncSession
+    return (select(Order).filter_by(**filters)
+            .options(*ORDER_HISTORY_OPTIONS)
+            .order_by(Order.created_at.desc(), Order.id.desc()))
+
+
+def archived_order_history_select(**filters):
+    return (select(ArchivedOrder).filter_by(**filters)
+            .options(*ARCHIVED_ORDER_HISTORY_OPTIONS)
+            .order_by(ArchivedOrder.created_at.desc(), ArchivedOrder.id.desc()))
+
+
+def integer_id(value):
+    # An id from a JSON body: an integer, or a string of digits. Floats and booleans would
+    # silently turn into another id, so they are refused like any other value.
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError('Restaurant ID and dish IDs must be integers')
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError('Restaurant ID and dish IDs must be integers')
+
+
+def place_order(user_id, restaurant_id, dish_ids, order_status=None, user_type=None):
+    # Validate the dishes and write the order with its line items in one transaction, which
+    # the caller commits. Raises ValueError when a dish is unknown or belongs to another restaurant.
+    if not isinstance(dish_ids, list):
+        raise ValueError('Dish IDs must be a list')
+    restaurant_id = integer_id(restaurant_id)
+    dish_ids = [integer_id(dish_id) for dish_id in dish_ids]
+
+    dishes = {dish.id: dish for dish in Dish.query.filter(Dish.id.in_(set(dish_ids)),
+                                                          Dish.restaurant_id == restaurant_id)}
+    missing = sorted(set(dish_ids) - set(dishes))
+    if missing:
+        raise ValueError('Dishes not found for this restaurant: {}'.format(missing))
+
+    if user_type:
+        User.query.filter_by(id=user_id).update({'type': user_type})
+
+    # One line per distinct dish, in the order the dishes were first listed
+    quantities = Counter(dish_ids)
+    new_order = Order(
+        restaurant_id=restaurant_id,
+        user_id=user_id,
+        total=round(sum((dishes[dish_id].price or 0) * quantity for dish_id, quantity in quantities.items()), 2),
+        status=order_status
+    )
+    db.session.add(new_order)
+    db.session.flush()
+
+    db.session.execute(insert(DishesOrdered),
+                       [{'order_id': new_order.id, 'dish_id': dish_id, 'quantity': quantity,
+                         'unit_price': dishes[dish_id].price, 'dish_name': dishes[dish_id].name}
+                        for dish_id, quantity in quantities.items()])
+    rollups.record_order(new_order, quantities)
+    db.session.flush()
+    return new_order
@@ -0,0 +1,78 @@
+# tests/conftest.py
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask_jwt_extended import create_access_token  # noqa: E402
+
+import migrations  # noqa: E402
+from app import create_app  # noqa: E402
+from config import Config  # noqa: E402
+from models import db, DeliveryPartner, Dish, DishesOrdered, Order, Restaurant, User  # noqa: E402
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    # An app on a fresh SQLite file, with the schema upgraded. Admission control and the
+    # password pool are off unless a test turns them on.
+    def make(**settings):
+        settings.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite:///{}'.format(tmp_path / 'primary.db'))
+        settings.setdefault('ADMISSION_ENABLED', False)
+        settings.setdefault('PASSWORD_HASH_WORKERS', 0)
+        app = create_app(type('TestConfig', (Config,), settings))
+        with app.app_context():
+            migrations.upgrade()
+        return app
+    return make
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+
+@pytest.fixture
+def replica_app(make_app, tmp_path):
+    # A primary and a replica SQLite file; the replica starts with the schema and no rows
+    app = make_app(DATABASE_REPLICA_URLS=['sqlite:///{}'.format(tmp_path / 'replica.db')])
+    with app.app_context():
+        db.metadata.create_all(db.engines['replica_0'])
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def auth(app, identity, user_type='USER'):
+    with app.app_context():
+        claims = {'user_type': user_type} if user_type else {}
+        return {'Authorization': 'Bearer ' + create_access_token(identity=identity, additional_claims=claims)}
+
+
+def seed(app, orders=0, lines=2, bind=None):
+    # One user, restaurant and delivery partner with id 1, three dishes, and `orders` orders of
+    # `lines` dishes each. bind writes the same rows to another engine, such as a replica.
+    with app.app_context():
+        engine = db.engines[bind]
+        with engine.begin() as conn:
+            conn.execute(User.__table__.insert(), [{'id': 1, 'name': 'User', 'username': 'user', 'password': 'secret'}])
+            conn.execute(Restaurant.__table__.insert(), [{'id': 1, 'name': 'Kitchen', 'username': 'kitchen',
+                                                          'password': 'secret', 'open_time': '12:00 AM',
+                                                          'close_time': '12:00 AM'}])
+            conn.execute(DeliveryPartner.__table__.insert(), [{'id': 1, 'name': 'Partner', 'username': 'partner',
+                                                               'password': 'secret', 'mobile': '1'}])
+            conn.execute(Dish.__table__.insert(), [{'id': i, 'restaurant_id': 1, 'name': 'Dish {}'.format(i),
+                                                    'price': 10.0 * i} for i in (1, 2, 3)])
+            if orders:
+                conn.execute(Order.__table__.insert(), [{'id': i, 'restaurant_id': 1, 'user_id': 1,
+                                                         'delivery_partner_id': 1, 'total': 30.0, 'status': 'PAID'}
+                                                        for i in range(1, orders + 1)])
+                conn.execute(DishesOrdered.__table__.insert(), [
+                    {'order_id': i, 'dish_id': dish_id, 'quantity': 1, 'unit_price': 10.0 * dish_id,
+                     'dish_name': 'Dish {}'.format(dish_id)}
+                    for i in range(1, orders + 1) for dish_id in range(1, lines + 1)])
@@ -0,0 +1,44 @@
+# tests/test_admission.py
+from conftest import auth, seed
+
+
+def limited_app(make_app):
+    app = make_app(ADMISSION_ENABLED=True,
+                   ADMISSION_RATE_LIMITS={'api.get_orders_by_user': (0.001, 3), 'api.login': (0.001, 2)})
+    seed(app, orders=1)
+    return app
+
+
+def test_bucket_rejects_with_retry_after(make_app):
+    app = limited_app(make_app)
+    client = app.test_client()
+    headers = auth(app, 1)
+    statuses = [client.get('/users/orders/1', headers=headers).status_code for _ in range(4)]
+    assert statuses == [200, 200, 200, 429]
+    response = client.get('/users/orders/1', headers=headers)
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+
+
+def test_batch_sub_requests_take_tokens(make_app):
+    app = limited_app(make_app)
+    client = app.test_client()
+    headers = auth(app, 1)
+    reads = [{'method': 'GET', 'path': '/users/orders/1?limit={}'.format(i)} for i in range(1, 6)]
+    response = client.post('/batch', json={'requests': reads}, headers=headers)
+    assert response.status_code == 200
+    statuses = [item['status'] for item in response.json['responses']]
+    assert statuses == [200, 200, 200, 429, 429]
+    assert response.json['responses'][3]['headers']['Retry-After']
+
+    # The bucket emptied by the batch also holds back direct requests
+    assert client.get('/users/orders/1', headers=headers).status_code == 429
+
+
+def test_batch_cannot_multiply_login_attempts(make_app):
+    app = limited_app(make_app)
+    client = app.test_client()
+    logins = [{'method': 'POST', 'path': '/login', 'body': {'username': 'user', 'password': 'wrong{}'.format(i)}}
+              for i in range(4)]
+    response = client.post('/batch', json={'requests': logins}, headers=auth(app, 1))
+    assert [item['status'] for item in response.json['responses']] == [401, 401, 429, 429]
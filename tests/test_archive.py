@@ -0,0 +1,110 @@
+# tests/test_archive.py
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import func, select
+
+import archive
+from archive import archive_batch, archive_horizon, archive_orders
+from conftest import auth, seed
+from models import db, ArchivedDishOrdered, ArchivedOrder, DishesOrdered, Order
+
+# Orders 1-8 are older than the archive horizon, odd ones finished; orders 9-12 are recent and finished
+OLD, RECENT = range(1, 9), range(9, 13)
+
+
+@pytest.fixture
+def app(make_app):
+    app = make_app(ARCHIVE_AFTER_DAYS=30)
+    seed(app, orders=12)
+    now = datetime.now()
+    with app.app_context():
+        for order in Order.query:
+            if order.id in OLD:
+                order.created_at = now - timedelta(days=40 + order.id)
+                order.status = 'DELIVERED' if order.id % 2 else 'PAID'
+            else:
+                order.created_at = now - timedelta(hours=order.id)
+                order.status = 'DELIVERED'
+        db.session.commit()
+    return app
+
+
+def ids(model):
+    return sorted(db.session.scalars(select(model.id)))
+
+
+def line_items(model, order_id):
+    return db.session.execute(select(model.dish_id, model.quantity, model.unit_price, model.dish_name)
+                              .filter_by(order_id=order_id).order_by(model.dish_id)).all()
+
+
+def test_batch_moves_finished_orders_with_their_dishes(app):
+    with app.app_context():
+        before = {order_id: line_items(DishesOrdered, order_id) for order_id in (1, 3)}
+        created_at = db.session.get(Order, 1).created_at
+        assert archive_batch(archive_horizon(), 2) == 2
+        assert ids(ArchivedOrder) == [1, 3]
+        assert 1 not in ids(Order) and 3 not in ids(Order)
+        for order_id, lines in before.items():
+            assert line_items(ArchivedDishOrdered, order_id) == lines
+            assert line_items(DishesOrdered, order_id) == []
+        archived = db.session.get(ArchivedOrder, 1)
+        assert (archived.status, archived.created_at, archived.total) == ('DELIVERED', created_at, 30.0)
+
+
+def test_archiving_resumes_where_it_stopped(app, monkeypatch):
+    with app.app_context():
+        assert archive_orders(1, max_batches=2) == (2, 2)
+        assert ids(ArchivedOrder) == [1, 3]
+
+        # A batch that fails halfway leaves nothing behind
+        copy_rows = archive.copy_rows
+
+        def fail_on_dishes(source, target, condition):
+            if source is DishesOrdered:
+                raise RuntimeError('connection lost')
+            copy_rows(source, target, condition)
+        monkeypatch.setattr(archive, 'copy_rows', fail_on_dishes)
+        with pytest.raises(RuntimeError):
+            archive_orders(1)
+        db.session.rollback()
+        assert ids(ArchivedOrder) == [1, 3]
+        monkeypatch.undo()
+
+        assert archive_orders(1) == (2, 2)
+        assert archive_orders(1) == (0, 0)
+        assert ids(ArchivedOrder) == [1, 3, 5, 7]
+        assert ids(Order) == [2, 4, 6, 8] + list(RECENT)
+        assert db.session.scalar(select(func.count()).select_from(ArchivedDishOrdered)) == 8
+
+
+def test_cli_archives_in_batches(app):
+    result = app.test_cli_runner().invoke(args=['archive', 'orders', '--batch-size', '3'])
+    assert 'Archived 4 orders in 2 batches' in result.output
+
+
+@pytest.mark.parametrize('limit', [1, 2, 3, 5, 12])
+def test_history_pages_join_hot_and_archived_orders(app, limit):
+    client = app.test_client()
+    headers = auth(app, 1)
+    with app.app_context():
+        archive_orders(2)
+        assert ids(ArchivedOrder) == [1, 3, 5, 7]
+
+    seen, after = [], None
+    while True:
+        query = {'limit': limit, **({'after': after} if after else {})}
+        body = client.get('/users/orders/1', query_string=query, headers=headers).json
+        seen += [item['order']['id'] for item in body['orders']]
+        after = body['next_cursor']
+        if after is None:
+            break
+    # Newest first: the recent orders, then the old ones from both tables, without gaps or repeats
+    assert seen == list(range(9, 13)) + list(range(1, 9))
+
+    streamed = client.get('/users/orders/1', query_string={'stream': 1}, headers=headers).json
+    assert [item['order']['id'] for item in streamed['orders']] == seen
+    archived = client.get('/order/3', headers=headers).json
+    assert archived['order']['id'] == 3
+    assert [dish['name'] for dish in archived['dishes']] == ['Dish 1', 'Dish 2']
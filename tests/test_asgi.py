@@ -0,0 +1,73 @@
+# tests/test_asgi.py
+import asyncio
+import importlib
+import json
+
+import pytest
+from sqlalchemy import event
+
+from config import Config
+from conftest import auth, seed
+from models import db
+
+
+@pytest.fixture
+def application(app, monkeypatch):
+    # asgi builds its module-level app from Config on import
+    monkeypatch.setattr(Config, 'SQLALCHEMY_DATABASE_URI', 'sqlite://')
+    return lambda: importlib.import_module('asgi').Application(app)
+
+
+def call(application, path, headers):
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'', 'headers': [
+        (name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers.items()]}
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        messages.append(message)
+
+    async def run():
+        await application(scope, receive, send)
+        await application.database.dispose()
+
+    asyncio.run(run())
+    return messages[0]['status'], json.loads(messages[1]['body'])
+
+
+@pytest.fixture
+def sync_queries(app):
+    # Statements run on the synchronous engine, which would block the event loop
+    seed(app, orders=1)
+    statements = []
+    with app.app_context():
+        engine = db.engine
+
+    def listener(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', listener)
+    yield statements
+    event.remove(engine, 'before_cursor_execute', listener)
+
+
+@pytest.mark.parametrize('path, user_type', [('/order/1', 'USER'), ('/users/orders/1', 'USER'),
+                                             ('/restaurant/orders/1', 'RESTAURANT')])
+def test_async_views_load_the_caller_without_the_sync_session(app, application, sync_queries, path, user_type):
+    status, body = call(application(), path, auth(app, 1, user_type))
+    assert status == 200
+    assert sync_queries == []
+    if path == '/order/1':
+        assert body['user']['name'] == 'User'
+
+
+def test_async_views_reject_unknown_callers(app, application, sync_queries):
+    status, _ = call(application(), '/order/1', auth(app, 99))
+    assert status == 401
+    assert sync_queries == []
+    status, _ = call(application(), '/order/1', {'Authorization': 'Bearer nonsense'})
+    assert status == 422
+    status, _ = call(application(), '/order/1', auth(app, 1, user_type=None))
+    assert status == 401
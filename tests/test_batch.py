@@ -0,0 +1,87 @@
+# tests/test_batch.py
+import re
+
+import pytest
+from flask_jwt_extended import view_decorators
+
+from batch import batch_runner
+from conftest import auth, seed
+
+
+@pytest.fixture
+def client(app):
+    seed(app, orders=2)
+    return app.test_client()
+
+
+def run_batch(client, requests, parallel=False):
+    response = client.post('/batch', json={'requests': requests, 'parallel': parallel},
+                           headers=auth(client.application, 1))
+    assert response.status_code == 200
+    return response
+
+
+def spy(monkeypatch, target, name):
+    calls = []
+    original = getattr(target, name)
+
+    def wrapper(*args, **kwargs):
+        calls.append(args)
+        return original(*args, **kwargs)
+    monkeypatch.setattr(target, name, wrapper)
+    return calls
+
+
+@pytest.mark.parametrize('parallel', [False, True])
+def test_responses_keep_their_order_and_errors(client, parallel):
+    requests = [{'id': 'first', 'path': '/order/1'}, {'id': 'missing', 'path': '/order/99'},
+                {'id': 'unknown', 'path': '/nowhere'}, {'id': 'nested', 'method': 'POST', 'path': '/batch'},
+                {'id': 'second', 'path': '/order/2'}]
+    responses = run_batch(client, requests, parallel).json['responses']
+    assert [(item['id'], item['status']) for item in responses] == [
+        ('first', 200), ('missing', 404), ('unknown', 404), ('nested', 400), ('second', 200)]
+    assert responses[0]['body']['order']['id'] == 1
+    assert responses[3]['body']['error'] == 'Not allowed in a batch'
+    assert responses[4]['body']['order']['id'] == 2
+
+
+def test_identical_reads_run_once_until_a_write(client, monkeypatch):
+    dispatched = spy(monkeypatch, batch_runner, 'dispatch')
+    read = {'path': '/order/1'}
+    requests = [read, read, {'method': 'PUT', 'path': '/order/1', 'body': {'status': 'CANCELLED'}}, read]
+    responses = run_batch(client, requests).json['responses']
+    assert len(dispatched) == 3
+    assert responses[0] == responses[1]
+    assert responses[1]['body']['order']['status'] == 'PAID'
+    assert responses[3]['body']['order']['status'] == 'CANCELLED'
+
+
+@pytest.mark.parametrize('parallel', [False, True])
+def test_the_token_is_verified_once(client, monkeypatch, parallel):
+    decoded = spy(monkeypatch, view_decorators, '_decode_jwt_from_request')
+    requests = [{'path': '/order/1'}, {'path': '/order/2'}, {'path': '/users/orders/1'}]
+    responses = run_batch(client, requests, parallel).json['responses']
+    assert [item['status'] for item in responses] == [200, 200, 200]
+    assert len(decoded) == 1
+
+
+def test_parallel_reads_are_counted_in_server_timing(client):
+    # Parallel first, while the identity cache is cold, so it can't count fewer queries by luck
+    requests = [{'path': '/order/1'}, {'path': '/order/2'}, {'path': '/users/orders/1'}]
+    counts = [int(re.search(r'(\d+) queries', run_batch(client, requests, parallel).headers['Server-Timing']).group(1))
+              for parallel in (True, False)]
+    assert counts[0] >= counts[1] > 0
+
+
+def test_parallel_heavy_reads_take_admission_slots(make_app):
+    # The batch itself holds the only slot: reads on its thread share it, parallel ones need their own
+    app = make_app(ADMISSION_ENABLED=True, ADMISSION_MAX_CONCURRENT=1)
+    seed(app, orders=1)
+    client = app.test_client()
+    requests = [{'path': '/users/orders/1'}, {'path': '/users/orders/1?limit=1'}]
+    assert [item['status'] for item in run_batch(client, requests).json['responses']] == [200, 200]
+    responses = run_batch(client, requests, parallel=True).json['responses']
+    assert [item['status'] for item in responses] == [503, 503]
+    assert responses[0]['headers']['Retry-After']
+    # Every slot is back once the batch is done
+    assert client.get('/users/orders/1', headers=auth(app, 1)).status_code == 200
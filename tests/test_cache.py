@@ -0,0 +1,78 @@
+# tests/test_cache.py
+import pytest
+
+from conftest import auth, seed
+from models import db, Restaurant
+
+
+@pytest.fixture
+def client(app):
+    seed(app)
+    return app.test_client()
+
+
+def get(client, path, etag=None):
+    headers = auth(client.application, 1)
+    if etag:
+        headers['If-None-Match'] = etag
+    return client.get(path, headers=headers)
+
+
+def put(client, path, body):
+    return client.put(path, json=body, headers=auth(client.application, 1, 'RESTAURANT'))
+
+
+@pytest.mark.parametrize('path', ['/restaurants', '/dishes/1', '/dishes/1?fields=name'])
+def test_matching_etag_is_not_modified(client, path):
+    first = get(client, path)
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+    again = get(client, path, etag)
+    assert again.status_code == 304
+    assert again.data == b''
+    assert again.headers['ETag'] == etag
+    assert get(client, path, '"something-else"').status_code == 200
+
+
+def test_cached_body_is_served_until_invalidated(app, client):
+    etag = get(client, '/restaurants').headers['ETag']
+    # A write behind the API's back is not seen...
+    with app.app_context():
+        Restaurant.query.get(1).name = 'Renamed'
+        db.session.commit()
+    assert get(client, '/restaurants', etag).status_code == 304
+    # ...one through it is
+    assert put(client, '/restaurants/1', {'cuisine': 'Thai'}).status_code == 200
+    response = get(client, '/restaurants', etag)
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert response.json['restaurants'][0]['name'] == 'Renamed'
+
+
+def test_restaurant_write_changes_listing_and_menu_etags(client):
+    etags = {path: get(client, path).headers['ETag'] for path in ('/restaurants', '/dishes/1')}
+    assert put(client, '/restaurants/1', {'name': 'New Kitchen'}).status_code == 200
+    for path, etag in etags.items():
+        response = get(client, path, etag)
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+
+
+def test_dish_writes_change_the_menu_etag(client):
+    listing = get(client, '/restaurants').headers['ETag']
+    etag = get(client, '/dishes/1').headers['ETag']
+
+    assert put(client, '/dishes/1', {'dish_id': 1, 'dish': {'price': 12.5}}).status_code == 200
+    response = get(client, '/dishes/1', etag)
+    assert response.status_code == 200
+    assert 12.5 in [dish['price'] for dish in response.json['dishes']]
+    etag = response.headers['ETag']
+
+    response = client.post('/dishes/1', json={'dish': {'name': 'Soup', 'price': 4.0}},
+                           headers=auth(client.application, 1, 'RESTAURANT'))
+    assert response.status_code == 201
+    response = get(client, '/dishes/1', etag)
+    assert response.status_code == 200
+    assert len(response.json['dishes']) == 4
+    # The restaurant listing does not include dishes, so it keeps its ETag
+    assert get(client, '/restaurants', listing).status_code == 304
@@ -0,0 +1,77 @@
+# tests/test_dispatch.py
+import pytest
+
+import app as app_module
+from conftest import auth, seed
+from dispatch import dispatcher
+from models import db, DeliveryPartner, Order, Restaurant
+
+# Restaurant 1 sits at KITCHEN; partner 1 from seed() has no known position
+KITCHEN = (12.9716, 77.5946)
+
+
+@pytest.fixture
+def app(make_app):
+    app = make_app(DISPATCH_MAX_ACTIVE_ORDERS=1, DISPATCH_MAX_RADIUS_KM=5.0)
+    seed(app)
+    with app.app_context():
+        restaurant = Restaurant.query.get(1)
+        restaurant.latitude, restaurant.longitude = KITCHEN
+        db.session.add_all([
+            DeliveryPartner(id=2, name='Near', username='near', latitude=KITCHEN[0] + 0.002, longitude=KITCHEN[1]),
+            DeliveryPartner(id=3, name='Nearer', username='nearer', latitude=KITCHEN[0] + 0.001, longitude=KITCHEN[1]),
+            DeliveryPartner(id=4, name='Far', username='far', latitude=KITCHEN[0] + 1.0, longitude=KITCHEN[1]),
+        ])
+        db.session.add_all([Order(id=i, restaurant_id=1, user_id=1, total=10.0, status='PAID') for i in range(1, 6)])
+        db.session.commit()
+    return app
+
+
+def set_status(client, order_id, status):
+    return client.put('/order/{}'.format(order_id), json={'status': status}, headers=auth(client.application, 1))
+
+
+def test_nearest_partner_with_capacity(client):
+    assert set_status(client, 1, 'REST_ACCEPTED').json['delivery_partner_id'] == 3
+    # Partner 3 is full, so the next nearest one within the radius
+    assert set_status(client, 2, 'REST_ACCEPTED').json['delivery_partner_id'] == 2
+
+
+def test_falls_back_only_to_partners_without_a_position(client):
+    set_status(client, 1, 'REST_ACCEPTED')
+    set_status(client, 2, 'REST_ACCEPTED')
+    # Partner 4 is free but outside the radius; partner 1 can't be ranked by distance
+    assert set_status(client, 3, 'REST_ACCEPTED').json['delivery_partner_id'] == 1
+    response = set_status(client, 4, 'REST_ACCEPTED')
+    assert response.status_code == 409
+    assert response.json['error'] == 'No delivery partner available'
+
+
+def test_capacity_exhausted_when_pickup_is_unknown(app, client):
+    with app.app_context():
+        restaurant = Restaurant.query.get(1)
+        restaurant.latitude = restaurant.longitude = None
+        db.session.commit()
+    assigned = {set_status(client, i, 'REST_ACCEPTED').json['delivery_partner_id'] for i in range(1, 5)}
+    assert assigned == {1, 2, 3, 4}
+    assert set_status(client, 5, 'REST_ACCEPTED').status_code == 409
+
+
+def test_terminal_status_releases_the_partner(client):
+    for order_id in (1, 2, 3):
+        set_status(client, order_id, 'REST_ACCEPTED')
+    assert set_status(client, 4, 'REST_ACCEPTED').status_code == 409
+    set_status(client, 1, 'DELIVERED')
+    assert set_status(client, 4, 'REST_ACCEPTED').json['delivery_partner_id'] == 3
+
+
+def test_rolled_back_assignment_releases_the_partner(app, client, monkeypatch):
+    def fail(order, old_status):
+        raise RuntimeError('rollup failed')
+    monkeypatch.setattr(app_module.rollups, 'record_status_change', fail)
+    assert set_status(client, 1, 'REST_ACCEPTED').status_code == 500
+    with app.app_context():
+        assert Order.query.get(1).delivery_partner_id is None
+        assert dispatcher.engine.active[3] == 0
+    monkeypatch.undo()
+    assert set_status(client, 1, 'REST_ACCEPTED').json['delivery_partner_id'] == 3
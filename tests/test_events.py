@@ -0,0 +1,77 @@
+# tests/test_events.py
+import json
+
+import pytest
+
+from conftest import auth, seed
+from events import LocalBroker
+
+
+@pytest.fixture
+def app(make_app):
+    app = make_app(EVENTS_HEARTBEAT_SECONDS=0.1, EVENTS_QUEUE_SIZE=2)
+    seed(app, orders=1)
+    return app
+
+
+def events(chunks):
+    # The order_status payloads of the next chunk that carries one, skipping keepalives
+    for chunk in chunks:
+        chunk = chunk.decode()
+        if chunk.startswith('event: order_status'):
+            return json.loads(chunk.split('data: ', 1)[1])
+    return None
+
+
+def set_status(client, status):
+    assert client.put('/order/1', json={'status': status}, headers=auth(client.application, 1)).status_code == 200
+
+
+def test_status_change_reaches_the_order_stream(app, client):
+    response = client.get('/order/1/events', headers=auth(app, 1), buffered=False)
+    assert response.mimetype == 'text/event-stream'
+    chunks = iter(response.response)
+    assert next(chunks).startswith(b'retry:')
+    assert events(chunks)['status'] == 'PAID'
+
+    set_status(client, 'REST_ACCEPTED')
+    event = events(chunks)
+    assert (event['order_id'], event['status'], event['delivery_partner_id']) == (1, 'REST_ACCEPTED', 1)
+    response.close()
+    assert not app.extensions['events']['broker'].subscribers
+
+
+def test_new_orders_reach_the_restaurant_stream(app, client):
+    response = client.get('/restaurant/orders/1/events', headers=auth(app, 1), buffered=False)
+    chunks = iter(response.response)
+    next(chunks)
+    created = client.post('/order_now', json={'restaurant_id': 1, 'dish_ids': [1]}, headers=auth(app, 1)).json
+    assert events(chunks)['order_id'] == created['order_id']
+    response.close()
+
+
+def test_slow_subscriber_is_dropped_instead_of_blocking(app, client):
+    response = client.get('/order/1/events', headers=auth(app, 1), buffered=False)
+    chunks = iter(response.response)
+    next(chunks), events(chunks)
+    # Nobody reads the stream while more changes are published than its queue holds
+    for status in ('REST_ACCEPTED', 'PICKED_UP', 'DELIVERED'):
+        set_status(client, status)
+    # The stream ends, so the client reconnects and starts again from the current status
+    assert list(chunks) == []
+    assert not app.extensions['events']['broker'].subscribers
+
+
+def test_full_queue_only_drops_that_subscriber():
+    broker = LocalBroker(queue_size=2)
+    slow = broker.subscribe(['order:1'])
+    fast = broker.subscribe(['order:1', 'restaurant:1'])
+    for message in ('a', 'b', 'c'):
+        broker.publish('order:1', message)
+        assert fast.get(0) == message
+    assert slow.closed and not fast.closed
+    assert [slow.get(0), slow.get(0), slow.get(0)] == ['a', 'b', None]
+    slow.close()
+    assert broker.subscribers['order:1'] == {fast}
+    fast.close()
+    assert not broker.subscribers
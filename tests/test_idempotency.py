@@ -0,0 +1,98 @@
+# tests/test_idempotency.py
+from datetime import datetime, timedelta
+
+import pytest
+
+import app as app_module
+from conftest import auth, seed
+from events import LocalBroker
+from models import db, IdempotencyKey, Order
+
+ORDER = {'restaurant_id': 1, 'dish_ids': [1, 2]}
+
+
+def order_now(client, headers, key, body=ORDER):
+    return client.post('/order_now', json=body, headers=dict(headers, **{'Idempotency-Key': key}))
+
+
+def order_count(app):
+    with app.app_context():
+        return Order.query.count()
+
+
+@pytest.fixture
+def caller(app):
+    seed(app)
+    return auth(app, 1)
+
+
+def test_retry_replays_the_first_response(app, client, caller):
+    first = order_now(client, caller, 'a')
+    assert first.status_code == 201
+    retry = order_now(client, caller, 'a')
+    assert retry.status_code == 201
+    assert retry.json == first.json
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    # Also from the database, once the process cache has forgotten it
+    app.extensions['idempotency']['responses'].clear()
+    assert order_now(client, caller, 'a').json == first.json
+    assert order_count(app) == 1
+
+    assert order_now(client, caller, 'b').json['order_id'] != first.json['order_id']
+    assert order_count(app) == 2
+
+
+def test_key_reused_for_another_request_is_rejected(app, client, caller):
+    assert order_now(client, caller, 'a').status_code == 201
+    assert order_now(client, caller, 'a', dict(ORDER, dish_ids=[3])).status_code == 422
+    assert order_count(app) == 1
+
+
+def test_duplicate_of_a_running_request_gets_409(app, client, caller):
+    app.config['IDEMPOTENCY_WAIT_SECONDS'] = 0.2
+    # Another worker holds the key and has not answered yet
+    assert order_now(client, caller, 'a').status_code == 201
+    app.extensions['idempotency']['responses'].clear()
+    with app.app_context():
+        db.session.query(IdempotencyKey).update({'status_code': None, 'response': None,
+                                                 'created_at': datetime.now()})
+        db.session.commit()
+    response = order_now(client, caller, 'a')
+    assert response.status_code == 409
+    assert response.headers['Retry-After'] == '1'
+
+    # Until the holder is presumed dead after IDEMPOTENCY_LOCK_TIMEOUT
+    with app.app_context():
+        db.session.query(IdempotencyKey).update({'created_at': datetime.now() - timedelta(hours=1)})
+        db.session.commit()
+    assert order_now(client, caller, 'a').status_code == 201
+    assert order_count(app) == 2
+
+
+def test_failure_after_the_order_committed_keeps_the_key(app, client, caller, monkeypatch):
+    def fail(order):
+        raise RuntimeError('after the commit')
+
+    monkeypatch.setattr(app_module.event_hub, 'publish_order', fail)
+    assert order_now(client, caller, 'a').status_code == 500
+    monkeypatch.undo()
+
+    retry = order_now(client, caller, 'a')
+    assert retry.status_code == 201
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert order_count(app) == 1
+
+
+def test_broker_errors_do_not_fail_the_order(app, client, caller, monkeypatch):
+    def fail(self, topic, message):
+        raise ConnectionError('broker down')
+
+    monkeypatch.setattr(LocalBroker, 'publish', fail)
+    assert order_now(client, caller, 'a').status_code == 201
+    assert order_count(app) == 1
+
+
+def test_rejected_request_can_be_retried(app, client, caller):
+    assert order_now(client, caller, 'a', dict(ORDER, dish_ids=[99])).status_code == 400
+    assert order_now(client, caller, 'a', dict(ORDER, dish_ids=[99])).status_code == 400
+    assert order_count(app) == 0
@@ -0,0 +1,28 @@
+# tests/test_identity.py
+import pytest
+from flask_jwt_extended import decode_token
+
+from conftest import auth, seed
+
+
+@pytest.fixture
+def client(app):
+    seed(app, orders=1)
+    return app.test_client()
+
+
+@pytest.mark.parametrize('user_type', [None, 'ADMIN'])
+def test_tokens_without_a_known_user_type_are_rejected(app, client, user_type):
+    # Restaurant 1 and user 1 share an id; the token must not be read as the user's
+    response = client.get('/users/orders/1', headers=auth(app, 1, user_type))
+    assert response.status_code == 401
+    assert client.get('/users/orders/1', headers=auth(app, 1)).status_code == 200
+
+
+@pytest.mark.parametrize('user_type, claim', [(None, 'USER'), ('USER', 'USER'), ('RESTAURANT', 'RESTAURANT')])
+def test_login_issues_a_known_user_type(app, client, user_type, claim):
+    username = 'kitchen' if user_type == 'RESTAURANT' else 'user'
+    response = client.post('/login', json={'username': username, 'password': 'secret', 'user_type': user_type})
+    token = response.json['user_token']
+    with app.app_context():
+        assert decode_token(token)['user_type'] == claim
@@ -0,0 +1,43 @@
+# tests/test_indexes.py
+import pytest
+from sqlalchemy import text
+
+import migrations
+from models import db
+from services import order_history_query
+
+HISTORY_INDEXES = [('restaurant_id', 'ix_orders_restaurant_id_created_at'),
+                   ('user_id', 'ix_orders_user_id_created_at'),
+                   ('delivery_partner_id', 'ix_orders_delivery_partner_id_created_at')]
+
+
+def query_plan(query):
+    statement = query.statement.compile(db.engine, compile_kwargs={'literal_binds': True})
+    rows = db.session.execute(text('EXPLAIN QUERY PLAN {}'.format(statement))).all()
+    return ' | '.join(row[-1] for row in rows)
+
+
+@pytest.mark.parametrize('owner, index', HISTORY_INDEXES)
+def test_history_queries_use_the_owner_index(app, owner, index):
+    with app.app_context():
+        plan = query_plan(order_history_query(**{owner: 1}).limit(50))
+    assert 'USING INDEX {}'.format(index) in plan
+    # The index also gives the order, so no sort step is needed
+    assert 'TEMP B-TREE' not in plan
+
+
+@pytest.mark.parametrize('owner, index', HISTORY_INDEXES)
+def test_upgrade_adds_the_indexes_to_an_existing_database(app, owner, index):
+    # A database from before the indexes: drop them and forget the migration that adds them
+    with app.app_context():
+        with db.engine.begin() as conn:
+            for _, name in HISTORY_INDEXES:
+                conn.execute(text('DROP INDEX {}'.format(name)))
+            conn.execute(migrations.schema_migrations.delete().where(migrations.schema_migrations.c.version == 1))
+        assert 'USING INDEX {}'.format(index) not in query_plan(order_history_query(**{owner: 1}).limit(50))
+        # Ends the session's read, which still sees the schema without the indexes
+        db.session.remove()
+
+        applied = migrations.upgrade()
+        assert [version for version, description in applied] == [1]
+        assert 'USING INDEX {}'.format(index) in query_plan(order_history_query(**{owner: 1}).limit(50))
@@ -0,0 +1,128 @@
+# tests/test_menu_import.py
+import json
+
+import pytest
+
+from conftest import auth, seed
+from models import db, Dish, Restaurant
+
+NDJSON = 'application/x-ndjson'
+
+
+@pytest.fixture
+def app(make_app):
+    app = make_app(MENU_IMPORT_BATCH_SIZE=2, MENU_IMPORT_MAX_ROW_BYTES=100)
+    seed(app)
+    with app.app_context():
+        db.session.add(Restaurant(id=2, name='Other', username='other', open_time='12:00 AM', close_time='12:00 AM'))
+        db.session.add(Dish(id=4, restaurant_id=2, name='Elsewhere', price=99.0))
+        db.session.commit()
+    return app
+
+
+def upload(client, body, mimetype=NDJSON):
+    return client.post('/dishes/1/import', data=body, content_type=mimetype,
+                       headers=auth(client.application, 1, 'RESTAURANT'))
+
+
+def ndjson(*rows):
+    return '\n'.join(row if isinstance(row, str) else json.dumps(row) for row in rows) + '\n'
+
+
+def menu(app):
+    with app.app_context():
+        return {dish.id: (dish.name, dish.price, dish.rating)
+                for dish in Dish.query.filter_by(restaurant_id=1).order_by(Dish.id)}
+
+
+def test_ndjson_upserts_by_id_and_by_name(app, client):
+    response = upload(client, ndjson({'id': 2, 'price': 21}, '', {'name': ' Dish 1 ', 'rating': 4.5},
+                                     {'name': 'Soup', 'price': 4}, {'name': 'Soup', 'description': 'Hot'},
+                                     {'name': 'Salad', 'price': 6.5}, {'name': 'Salad', 'price': 7}))
+    assert response.status_code == 200
+    report = response.json
+    assert (report['rows'], report['created'], report['updated'], report['failed']) == (6, 2, 4, 0)
+    dishes = menu(app)
+    assert dishes[1] == ('Dish 1', 10.0, 4.5)
+    assert dishes[2] == ('Dish 2', 21.0, 4.0)
+    # Soup is created in the second batch and updated in the third, found by name in the database
+    assert sorted(value[:2] for key, value in dishes.items() if key > 3) == [('Salad', 7.0), ('Soup', 4.0)]
+    with app.app_context():
+        assert Dish.query.filter_by(name='Soup').one().description == 'Hot'
+
+
+def test_rows_failing_validation_are_reported_by_line(app, client):
+    response = upload(client, ndjson('{"name": "Broken"', ['not', 'an', 'object'], {'id': 'abc'},
+                                     {'name': 'Cheap', 'price': -1}, {'name': 'Hyped', 'rating': 7},
+                                     {'name': 12}, {'name': '  '}, {'price': 5}, {'id': 4, 'price': 1},
+                                     {'name': 'Tea', 'price': 2}))
+    report = response.json
+    assert (report['rows'], report['created'], report['updated'], report['failed']) == (10, 1, 0, 9)
+    assert report['errors'] == [
+        {'line': 1, 'error': 'Invalid JSON'},
+        {'line': 2, 'error': 'Row must be a JSON object'},
+        {'line': 3, 'error': 'id must be an integer'},
+        {'line': 4, 'error': 'price must be at least 0'},
+        {'line': 5, 'error': 'rating must be at least 0 and at most 5'},
+        {'line': 6, 'error': 'name must be a string'},
+        {'line': 7, 'error': 'name must not be empty'},
+        {'line': 8, 'error': 'name is required for a new dish'},
+        {'line': 9, 'error': 'Dish not found'}]
+    assert report['errors_truncated'] is False
+    with app.app_context():
+        assert db.session.get(Dish, 4).price == 99.0
+
+
+def test_error_list_is_capped(make_app):
+    app = make_app(MENU_IMPORT_MAX_ERRORS=2)
+    seed(app)
+    report = upload(app.test_client(), ndjson(*[{'price': 1}] * 5)).json
+    assert report['failed'] == 5
+    assert len(report['errors']) == 2
+    assert report['errors_truncated'] is True
+
+
+def test_csv_rows_leave_empty_cells_unchanged(app, client):
+    # Spreadsheets save CSV with a byte order mark
+    body = '\ufeffid,name,price,rating\n1,,12.5,\n,Soup,4,3\n,"Soup, large",6,\n2,,free,\n'
+    report = upload(client, body.encode(), 'text/csv').json
+    assert (report['rows'], report['created'], report['updated'], report['failed']) == (4, 2, 1, 1)
+    assert report['errors'] == [{'line': 5, 'error': 'price must be a number'}]
+    dishes = menu(app)
+    assert dishes[1] == ('Dish 1', 12.5, 4.0)
+    assert dishes[2] == ('Dish 2', 20.0, 4.0)
+    assert sorted(value for key, value in dishes.items() if key > 3) == [('Soup', 4.0, 3.0),
+                                                                         ('Soup, large', 6.0, 4.0)]
+
+
+def test_oversized_ndjson_row_is_skipped(app, client):
+    report = upload(client, ndjson({'name': 'x' * 200}, {'name': 'Tea', 'price': 2})).json
+    assert report['errors'] == [{'line': 1, 'error': 'Row is longer than 100 bytes'}]
+    assert report['created'] == 1
+
+
+def test_oversized_csv_line_stops_the_upload(app, client):
+    body = 'name,price\nTea,2\n{},3\nCoffee,4\n'.format('x' * 200)
+    report = upload(client, body.encode(), 'text/csv').json
+    assert report['created'] == 1
+    assert report['failed'] == 1
+    assert report['errors'][0]['error'].startswith('Unreadable CSV, the rest of the upload was skipped')
+
+
+def test_unsupported_or_empty_uploads(client):
+    assert upload(client, b'{}', 'application/json').status_code == 415
+    assert upload(client, b'\n\n').status_code == 400
+
+
+def test_import_changes_the_menu_etag(client):
+    headers = auth(client.application, 1)
+    etag = client.get('/dishes/1', headers=headers).headers['ETag']
+    # Nothing written, nothing to invalidate
+    upload(client, ndjson({'price': 1}))
+    assert client.get('/dishes/1', headers=dict(headers, **{'If-None-Match': etag})).status_code == 304
+
+    upload(client, ndjson({'name': 'Tea', 'price': 2}))
+    response = client.get('/dishes/1', headers=dict(headers, **{'If-None-Match': etag}))
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert 'Tea' in [dish['name'] for dish in response.json['dishes']]
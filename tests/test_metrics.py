@@ -0,0 +1,76 @@
+# tests/test_metrics.py
+import logging
+import re
+
+import pytest
+from sqlalchemy import event
+
+from conftest import auth, seed
+from models import db
+
+SERVER_TIMING = re.compile(r'db;dur=([\d.]+);desc="(\d+) queries", serialize;dur=([\d.]+), total;dur=([\d.]+)')
+
+
+@pytest.fixture
+def statements(app):
+    # Every statement the app runs, counted independently of metrics.py
+    seed(app, orders=3)
+    with app.app_context():
+        engine = db.engine
+    executed = []
+
+    def listener(conn, cursor, statement, *args):
+        executed.append(statement)
+    event.listen(engine, 'after_cursor_execute', listener)
+    yield executed
+    event.remove(engine, 'after_cursor_execute', listener)
+
+
+def timing(response):
+    db_ms, queries, serialize_ms, total_ms = SERVER_TIMING.fullmatch(response.headers['Server-Timing']).groups()
+    return float(db_ms), int(queries), float(serialize_ms), float(total_ms)
+
+
+@pytest.mark.parametrize('path', ['/order/1', '/users/orders/1', '/restaurants'])
+def test_server_timing_counts_every_query(app, client, statements, path):
+    response = client.get(path, headers=auth(app, 1))
+    assert response.status_code == 200
+    db_ms, queries, serialize_ms, total_ms = timing(response)
+    assert queries == len(statements) > 0
+    assert 0 < db_ms <= total_ms
+    assert 0 < serialize_ms <= total_ms
+
+
+def test_cached_response_runs_no_queries(app, client, statements):
+    client.get('/restaurants', headers=auth(app, 1))
+    statements.clear()
+    response = client.get('/restaurants', headers=auth(app, 1))
+    assert timing(response)[1] == len(statements) == 0
+
+
+def test_export_matches_the_requests(app, client):
+    seed(app, orders=1)
+    responses = [client.get('/order/1', headers=auth(app, 1)) for _ in range(3)]
+    client.get('/order/99', headers=auth(app, 1))
+    queries = sum(timing(response)[1] for response in responses)
+
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'http_requests_total{endpoint="api.get_order",method="GET",status="200"} 3' in text
+    assert 'http_requests_total{endpoint="api.get_order",method="GET",status="404"} 1' in text
+    assert 'http_db_queries_count{endpoint="api.get_order"} 4' in text
+    match = re.search(r'http_db_queries_sum\{endpoint="api.get_order"\} ([\d.]+)', text)
+    assert float(match.group(1)) >= queries
+    assert 'http_request_duration_seconds_bucket{endpoint="api.get_order",le="+Inf"} 4' in text
+
+
+def test_slow_requests_are_logged_with_their_sql(make_app, caplog):
+    app = make_app(METRICS_SLOW_REQUEST_MS=0)
+    seed(app, orders=1)
+    with caplog.at_level(logging.WARNING, logger=app.logger.name):
+        response = app.test_client().get('/order/1', headers=auth(app, 1))
+    (record,) = [record for record in caplog.records if record.getMessage().startswith('Slow request GET /order/1')]
+    message = record.getMessage()
+    assert '-> 200' in message
+    assert '{} queries'.format(timing(response)[1]) in message
+    # One line per statement after the summary
+    assert len(message.splitlines()) - 1 == timing(response)[1]
@@ -0,0 +1,64 @@
+# tests/test_migrations.py
+from functools import partial
+
+import pytest
+from sqlalchemy import select, text
+
+import migrations
+from conftest import seed
+from models import db, ArchivedDishOrdered, DishesOrdered
+
+# order id -> dish ids of its rows before migration 7; dish 99 no longer exists
+OLD_LINES = {1: [1, 1, 2, 1], 2: [3], 3: [2, 2], 4: [None, 99, 99]}
+COLLAPSED = [(1, 1, 3, 10.0, 'Dish 1'), (1, 2, 1, 20.0, 'Dish 2'), (2, 3, 1, 30.0, 'Dish 3'),
+             (3, 2, 2, 20.0, 'Dish 2'), (4, None, 1, None, None), (4, 99, 2, None, None)]
+
+
+def line_items(conn, model):
+    table = model.__table__
+    return [tuple(row) for row in conn.execute(
+        select(table.c.order_id, table.c.dish_id, table.c.quantity, table.c.unit_price, table.c.dish_name)
+        .order_by(table.c.order_id, table.c.dish_id.is_not(None), table.c.dish_id))]
+
+
+@pytest.fixture
+def old_app(app):
+    # A database from before migration 7: line items without quantity or dish snapshot, one row per dish ordered
+    seed(app, orders=4)
+    with app.app_context():
+        with db.engine.begin() as conn:
+            for table in ('dishes_ordered', 'dishes_ordered_archive'):
+                conn.execute(text('DROP TABLE {}'.format(table)))
+                conn.execute(text('CREATE TABLE {} (id INTEGER PRIMARY KEY, order_id INTEGER, dish_id INTEGER)'
+                                  .format(table)))
+                conn.execute(text('INSERT INTO {} (order_id, dish_id) VALUES (:order_id, :dish_id)'.format(table)),
+                             [{'order_id': order_id, 'dish_id': dish_id}
+                              for order_id, dish_ids in OLD_LINES.items() for dish_id in dish_ids])
+            conn.execute(migrations.schema_migrations.delete().where(migrations.schema_migrations.c.version == 7))
+        db.session.remove()
+    return app
+
+
+@pytest.mark.parametrize('batch_size', [10000, 1, 3])
+def test_upgrade_collapses_repeated_dishes_into_quantities(old_app, monkeypatch, batch_size):
+    monkeypatch.setattr(migrations, 'collapse_line_items',
+                        partial(migrations.collapse_line_items, batch_size=batch_size))
+    with old_app.app_context():
+        assert migrations.upgrade() == [(7, 'Quantities and dish snapshots on line items')]
+        with db.engine.connect() as conn:
+            for model in (DishesOrdered, ArchivedDishOrdered):
+                assert line_items(conn, model) == COLLAPSED
+            # The first row of each dish is the one kept
+            kept = conn.execute(text('SELECT id FROM dishes_ordered WHERE order_id = 1 ORDER BY id')).scalars().all()
+            assert kept == [1, 3]
+
+
+def test_collapsing_again_changes_nothing(old_app):
+    with old_app.app_context():
+        migrations.upgrade()
+        with db.engine.connect() as conn:
+            # Later price changes must not rewrite the snapshots either
+            conn.execute(text('UPDATE dishes SET price = price * 2'))
+            conn.commit()
+            migrations.line_item_quantities(conn)
+            assert line_items(conn, DishesOrdered) == COLLAPSED
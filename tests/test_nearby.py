@@ -0,0 +1,60 @@
+# tests/test_nearby.py
+import random
+
+import pytest
+
+from conftest import auth, seed
+from geo import haversine_km
+from models import db, Restaurant
+
+CENTER = (12.9716, 77.5946)
+
+
+@pytest.fixture
+def client(app):
+    # Restaurants 2-41 scattered up to about 12 km from CENTER; restaurant 1 has no position
+    seed(app)
+    places = random.Random(7)
+    with app.app_context():
+        db.session.add_all([
+            Restaurant(id=i, name='Place {}'.format(i), username='place{}'.format(i),
+                       latitude=CENTER[0] + places.uniform(-0.1, 0.1), longitude=CENTER[1] + places.uniform(-0.1, 0.1))
+            for i in range(2, 42)])
+        db.session.commit()
+    return app.test_client()
+
+
+def nearby(client, **args):
+    return client.get('/restaurants/nearby', query_string=dict({'lat': CENTER[0], 'lng': CENTER[1]}, **args),
+                      headers=auth(client.application, 1))
+
+
+def expected(app, radius, limit):
+    # Brute force over every restaurant with a position
+    with app.app_context():
+        distances = sorted((haversine_km(CENTER[0], CENTER[1], r.latitude, r.longitude), r.id)
+                           for r in Restaurant.query.filter(Restaurant.latitude.isnot(None)))
+    return [restaurant_id for distance, restaurant_id in distances if distance <= radius][:limit]
+
+
+@pytest.mark.parametrize('radius, limit', [(1, 50), (2.5, 50), (5, 5), (8, 50), (25, 200), (25, 1)])
+def test_nearest_first_within_the_radius(app, client, radius, limit):
+    restaurants = nearby(client, radius=radius, limit=limit).json['restaurants']
+    assert [restaurant['id'] for restaurant in restaurants] == expected(app, radius, limit)
+    distances = [restaurant['distance_km'] for restaurant in restaurants]
+    assert distances == sorted(distances)
+    assert all(distance <= radius for distance in distances)
+
+
+def test_moved_restaurant_is_found_at_its_new_position(app, client):
+    assert 1 not in [restaurant['id'] for restaurant in nearby(client, radius=25).json['restaurants']]
+    response = client.put('/restaurants/1', json={'latitude': CENTER[0] + 0.001, 'longitude': CENTER[1]},
+                          headers=auth(app, 1, 'RESTAURANT'))
+    assert response.status_code == 200
+    first = nearby(client, limit=1).json['restaurants'][0]
+    assert (first['id'], first['distance']) == (1, '0.1 km')
+
+
+@pytest.mark.parametrize('args', [{'lat': 'x'}, {'lat': 91}, {'lng': -181}, {'radius': 0}, {'limit': 0}])
+def test_invalid_arguments(client, args):
+    assert nearby(client, **args).status_code == 400
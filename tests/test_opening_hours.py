@@ -0,0 +1,99 @@
+# tests/test_opening_hours.py
+import random
+
+import pytest
+from flask import g
+
+from conftest import auth, seed
+from models import db, Restaurant
+from nearby import nearby_restaurants
+from opening_hours import MINUTES_PER_WEEK, IntervalIndex, open_restaurants, parse_time, week_intervals
+
+
+@pytest.mark.parametrize('text, minutes', [('9:00 AM', 540), ('9 pm', 1260), ('12:30am', 30), ('12 PM', 720),
+                                           ('21:15', 1275), ('11.45 p.m.', 1425)])
+def test_parse_time(text, minutes):
+    assert parse_time(text) == minutes
+
+
+@pytest.mark.parametrize('text', ['noon', '13 PM', '9', '', None, '24:00'])
+def test_parse_time_rejects(text):
+    with pytest.raises(ValueError):
+        parse_time(text)
+
+
+def test_hours_past_midnight_wrap_into_monday():
+    intervals = week_intervals('9:00 PM', '2:00 AM')
+    assert intervals[0] == (0, 120)
+    assert intervals[-1] == (6 * 1440 + 1260, MINUTES_PER_WEEK)
+
+
+def test_index_matches_a_scan():
+    rng = random.Random(1)
+    times = ['{}:{:02d} {}'.format(hour, minute, half) for hour in range(1, 13) for minute in (0, 30)
+             for half in ('AM', 'PM')]
+    index, expected = IntervalIndex(), {}
+    for _ in range(2000):
+        key = rng.randrange(200)
+        if rng.random() < 0.1:
+            index.remove(key)
+            expected.pop(key, None)
+        else:
+            expected[key] = week_intervals(rng.choice(times), rng.choice(times))
+            index.add(key, expected[key])
+    for _ in range(2000):
+        minute = rng.randrange(MINUTES_PER_WEEK)
+        found = sorted(index.stab(minute))
+        assert found == sorted(key for key, intervals in expected.items()
+                               if any(start <= minute < end for start, end in intervals))
+        assert sorted(index.stab(index.segment(minute))) == found
+
+
+def test_open_now_index_reads_the_primary(replica_app, monkeypatch):
+    # The replica has not seen the restaurant yet; the index must not be built from it
+    seed(replica_app)
+    monkeypatch.setattr(open_restaurants, 'now', lambda: 600)
+    client = replica_app.test_client()
+    response = client.get('/restaurants?open_now=1', headers=auth(replica_app, 1))
+    assert [restaurant['id'] for restaurant in response.json['restaurants']] == [1]
+
+
+def test_nearby_index_reads_the_primary(replica_app):
+    # Built lazily by whichever view asks first, including one reading from replicas
+    seed(replica_app)
+    with replica_app.app_context():
+        restaurant = db.session.get(Restaurant, 1)
+        restaurant.latitude, restaurant.longitude = 12.9, 77.6
+        db.session.commit()
+    with replica_app.test_request_context():
+        g._replica_reads = True
+        assert len(nearby_restaurants.index) == 1
+
+
+@pytest.mark.parametrize('minute, open_ids', [(600, [1, 2]), (1020, [1]), (1320, [1, 3]), (1440 + 60, [1, 3]),
+                                              (60, [1, 3]), (6 * 1440 + 1439, [1, 3])])
+def test_open_now_lists_the_restaurants_open_at_that_minute(app, client, monkeypatch, minute, open_ids):
+    # 1 is open around the clock, 2 from 9 to 5, 3 overnight, including Sunday into Monday; 4 has unreadable hours
+    seed(app)
+    with app.app_context():
+        db.session.add_all([Restaurant(id=2, name='Day', username='day', open_time='9:00 AM', close_time='5:00 PM'),
+                            Restaurant(id=3, name='Night', username='night', open_time='9:00 PM', close_time='2:00 AM'),
+                            Restaurant(id=4, name='Unknown', username='unknown', open_time='noon', close_time='late')])
+        db.session.commit()
+    monkeypatch.setattr(open_restaurants, 'now', lambda: minute)
+    response = client.get('/restaurants?open_now=1', headers=auth(app, 1))
+    assert [restaurant['id'] for restaurant in response.json['restaurants']] == open_ids
+    # Without the filter every restaurant is listed
+    assert len(client.get('/restaurants', headers=auth(app, 1)).json['restaurants']) == 4
+
+
+def test_open_now_follows_updated_hours(app, client, monkeypatch):
+    seed(app)
+    monkeypatch.setattr(open_restaurants, 'now', lambda: 600)
+    assert len(client.get('/restaurants?open_now=1', headers=auth(app, 1)).json['restaurants']) == 1
+    response = client.put('/restaurants/1', json={'open_time': '6:00 PM', 'close_time': '11:00 PM'},
+                          headers=auth(app, 1, 'RESTAURANT'))
+    assert response.status_code == 200
+    assert client.get('/restaurants?open_now=1', headers=auth(app, 1)).json['restaurants'] == []
+    monkeypatch.setattr(open_restaurants, 'now', lambda: 1140)
+    assert [r['id'] for r in client.get('/restaurants?open_now=1', headers=auth(app, 1)).json['restaurants']] == [1]
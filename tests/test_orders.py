@@ -0,0 +1,58 @@
+# tests/test_orders.py
+import pytest
+
+from conftest import auth, seed
+from models import db, Dish, DishesOrdered, Order, Restaurant
+
+
+@pytest.fixture
+def client(app):
+    seed(app)
+    with app.app_context():
+        db.session.add(Restaurant(id=2, name='Other', username='other', open_time='12:00 AM', close_time='12:00 AM'))
+        db.session.add(Dish(id=4, restaurant_id=2, name='Elsewhere', price=99.0))
+        db.session.commit()
+    return app.test_client()
+
+
+def order_now(client, body):
+    return client.post('/order_now', json=body, headers=auth(client.application, 1))
+
+
+def test_total_comes_from_dish_prices(app, client):
+    response = order_now(client, {'restaurant_id': 1, 'dish_ids': [1, 2, 2], 'total_price': 0.01})
+    assert response.status_code == 201
+    with app.app_context():
+        order = Order.query.get(response.json['order_id'])
+        assert order.total == 50.0
+        lines = DishesOrdered.query.filter_by(order_id=order.id).order_by(DishesOrdered.dish_id).all()
+        assert [(line.dish_id, line.quantity, line.unit_price, line.dish_name) for line in lines] == [
+            (1, 1, 10.0, 'Dish 1'), (2, 2, 20.0, 'Dish 2')]
+
+
+def test_dish_from_another_restaurant_is_rejected(app, client):
+    response = order_now(client, {'restaurant_id': 1, 'dish_ids': [1, 4]})
+    assert response.status_code == 400
+    assert response.json['error'] == 'Dishes not found for this restaurant: [4]'
+    assert order_now(client, {'restaurant_id': 1, 'dish_ids': [99]}).status_code == 400
+    with app.app_context():
+        assert Order.query.count() == 0
+
+
+@pytest.mark.parametrize('body', [{'restaurant_id': 'one', 'dish_ids': [1]},
+                                  {'restaurant_id': 1.5, 'dish_ids': [1]},
+                                  {'restaurant_id': 1, 'dish_ids': [1, 'two']},
+                                  {'restaurant_id': 1, 'dish_ids': [1, 2.5]},
+                                  {'restaurant_id': 1, 'dish_ids': [True]},
+                                  {'restaurant_id': 1, 'dish_ids': [[1]]},
+                                  {'restaurant_id': 1, 'dish_ids': '12'},
+                                  {'restaurant_id': 1, 'dish_ids': {'1': 1}}])
+def test_non_integer_ids_are_a_bad_request(app, client, body):
+    response = order_now(client, body)
+    assert response.status_code == 400
+    with app.app_context():
+        assert Order.query.count() == 0
+
+
+def test_ids_given_as_digit_strings_are_accepted(client):
+    assert order_now(client, {'restaurant_id': '1', 'dish_ids': ['1', 3]}).status_code == 201
@@ -0,0 +1,79 @@
+# tests/test_pagination.py
+import base64
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import auth, seed
+from models import db, Order
+from pagination import decode_cursor, encode_cursor
+
+NOW = datetime(2026, 1, 1, 12, 0)
+
+
+@pytest.fixture
+def client(app):
+    # Seven orders: 1-4 share a created_at, 5-7 are a minute apart and newer
+    seed(app, orders=7)
+    with app.app_context():
+        for order in Order.query:
+            order.created_at = NOW + timedelta(minutes=max(0, order.id - 4))
+        db.session.commit()
+    return app.test_client()
+
+
+def history(client, **args):
+    return client.get('/users/orders/1', query_string=args, headers=auth(client.application, 1))
+
+
+def order_ids(body):
+    return [item['order']['id'] for item in body['orders']]
+
+
+def test_cursor_round_trips():
+    order = Order(id=42, created_at=NOW)
+    assert decode_cursor(encode_cursor(order)) == (NOW, 42)
+
+
+def test_pages_follow_the_cursor_through_ties(client):
+    ids, after = [], None
+    while True:
+        body = history(client, limit=2, **({'after': after} if after else {})).json
+        ids += order_ids(body)
+        after = body['next_cursor']
+        if after is None:
+            break
+    # Newest first, and the orders sharing a created_at by descending id
+    assert ids == [7, 6, 5, 4, 3, 2, 1]
+
+
+def test_last_page_has_no_cursor(client):
+    body = history(client, limit=7).json
+    assert len(body['orders']) == 7
+    assert body['next_cursor'] is None
+
+
+@pytest.mark.parametrize('after', ['not-base64!', base64.urlsafe_b64encode(b'no separator').decode(),
+                                   base64.urlsafe_b64encode(b'2026-01-01T12:00:00|x').decode(),
+                                   base64.urlsafe_b64encode(b'yesterday|1').decode(),
+                                   base64.urlsafe_b64encode(b'\xff\xfe|1').decode()])
+def test_malformed_cursor_is_a_bad_request(client, after):
+    response = history(client, after=after)
+    assert response.status_code == 400
+    assert response.json['error'] == 'Invalid limit or cursor'
+
+
+def test_bad_limit_is_a_bad_request(client):
+    assert history(client, limit=0).status_code == 400
+
+
+def test_streamed_history_matches_the_pages(client):
+    paged = history(client, limit=7).json
+    response = history(client, stream=1)
+    assert response.is_streamed
+    body = response.json
+    assert body['user'] == paged['user']
+    assert body['orders'] == paged['orders']
+    # The stream starts after a cursor like a page does
+    after = history(client, limit=3).json['next_cursor']
+    assert order_ids(history(client, stream=1, after=after).json) == [4, 3, 2, 1]
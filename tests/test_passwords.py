@@ -0,0 +1,46 @@
+# tests/test_passwords.py
+import pytest
+
+from conftest import auth, seed
+from models import db, User
+from passwords import is_hashed
+
+
+def test_login_rehashes_plaintext_and_checks_the_password(app, client):
+    seed(app)
+    assert client.post('/login', json={'username': 'user', 'password': 'wrong'}).status_code == 401
+    assert client.post('/login', json={'username': 'user', 'password': 'secret'}).status_code == 200
+    with app.app_context():
+        assert is_hashed(db.session.get(User, 1).password)
+    assert client.post('/login', json={'username': 'user', 'password': 'secret'}).status_code == 200
+    assert client.post('/login', json={'username': 'nobody', 'password': 'secret'}).status_code == 401
+
+
+def test_signup_stores_a_hash(app, client):
+    response = client.post('/register/user', json={'name': 'New', 'username': 'new', 'password': 'pass'})
+    assert response.status_code == 201
+    with app.app_context():
+        stored = User.query.filter_by(username='new').one().password
+    assert is_hashed(stored) and 'pass' not in stored
+    assert client.post('/login', json={'username': 'new', 'password': 'pass'}).status_code == 200
+
+
+@pytest.mark.parametrize('password', [123, ['secret'], {'a': 1}, True])
+def test_non_string_passwords_are_rejected(app, client, password):
+    seed(app)
+    admin = auth(app, 1)
+    requests = [
+        ('POST', '/login', {'username': 'user', 'password': password}, None),
+        ('POST', '/register/user', {'name': 'n', 'username': 'new', 'password': password}, None),
+        ('POST', '/register/restaurant', {'username': 'r', 'password': password, 'name': 'n', 'mobile': '1',
+                                          'address': 'a', 'cuisine': 'c', 'open_time': '9:00 AM',
+                                          'close_time': '9:00 PM'}, admin),
+        ('POST', '/register/delivery-partner', {'username': 'd', 'password': password, 'name': 'n', 'mobile': '1'},
+         None),
+        ('PUT', '/restaurants/1', {'password': password}, auth(app, 1, 'RESTAURANT')),
+        ('PUT', '/delivery_partner/1', {'password': password}, auth(app, 1, 'DELIVERY_PARTNER')),
+    ]
+    for method, path, body, headers in requests:
+        response = client.open(path, method=method, json=body, headers=headers)
+        assert response.status_code == 400, path
+        assert response.is_json
@@ -0,0 +1,25 @@
+# tests/test_query_counts.py
+import re
+
+import pytest
+
+from conftest import auth, seed
+
+ENDPOINTS = [('/restaurant/orders/1', 'RESTAURANT'), ('/delivery_partner/orders/1', 'DELIVERY_PARTNER'),
+             ('/users/orders/1', 'USER'), ('/order/1', 'USER')]
+
+
+def query_count(app, path, user_type):
+    response = app.test_client().get(path, headers=auth(app, 1, user_type))
+    assert response.status_code == 200
+    return int(re.search(r'"(\d+) queries"', response.headers['Server-Timing']).group(1))
+
+
+@pytest.mark.parametrize('path, user_type', ENDPOINTS)
+def test_query_count_does_not_grow_with_orders(make_app, tmp_path, path, user_type):
+    counts = []
+    for orders in (1, 40):
+        app = make_app(SQLALCHEMY_DATABASE_URI='sqlite:///{}'.format(tmp_path / 'orders_{}.db'.format(orders)))
+        seed(app, orders=orders, lines=3)
+        counts.append(query_count(app, path, user_type))
+    assert counts[0] == counts[1]
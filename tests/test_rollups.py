@@ -0,0 +1,52 @@
+# tests/test_rollups.py
+import pytest
+from flask import Flask
+from sqlalchemy import select
+
+import rollups
+from conftest import auth, seed
+from models import db, DishDailySales, RestaurantDailySales
+
+
+def snapshot():
+    restaurant_days = db.session.execute(
+        select(RestaurantDailySales.restaurant_id, RestaurantDailySales.day, RestaurantDailySales.orders,
+               RestaurantDailySales.cancelled, RestaurantDailySales.delivered, RestaurantDailySales.revenue)
+        .order_by(RestaurantDailySales.restaurant_id, RestaurantDailySales.day)).all()
+    dish_days = db.session.execute(
+        select(DishDailySales.restaurant_id, DishDailySales.day, DishDailySales.dish_id, DishDailySales.quantity)
+        .order_by(DishDailySales.restaurant_id, DishDailySales.day, DishDailySales.dish_id)).all()
+    return ([row[:5] + (round(row[5], 2),) for row in restaurant_days],
+            [tuple(row) for row in dish_days if row.quantity])
+
+
+def test_incremental_rollups_match_a_rebuild(app):
+    seed(app)
+    client = app.test_client()
+    headers = auth(app, 1)
+    baskets = [[1], [1, 2, 2], [3, 3, 3], [2, 3], [1, 1]]
+    order_ids = [client.post('/order_now', json={'restaurant_id': 1, 'dish_ids': dish_ids}, headers=headers)
+                 .json['order_id'] for dish_ids in baskets]
+    for order_id, statuses in zip(order_ids, [['REST_ACCEPTED', 'DELIVERED'], ['CANCELLED'], ['REST_REJECTED'],
+                                              ['CANCELLED', 'PAID'], []]):
+        for status in statuses:
+            assert client.put('/order/{}'.format(order_id), json={'status': status},
+                              headers=headers).status_code == 200
+
+    with app.app_context():
+        incremental = snapshot()
+        rollups.rebuild()
+        assert snapshot() == incremental
+    (day,) = incremental[0]
+    # Five orders, two of them cancelled or rejected, one delivered; [1], [2, 3] and [1, 1] bring revenue
+    assert day[2:] == (5, 2, 1, 10.0 + 50.0 + 20.0)
+    assert [(dish_id, quantity) for _, _, dish_id, quantity in incremental[1]] == [(1, 3), (2, 1), (3, 1)]
+
+
+def test_unsupported_database_fails_at_startup():
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'mysql://localhost/food_delivery'
+    with pytest.raises(RuntimeError, match='INSERT ... ON CONFLICT'):
+        rollups.init_app(app)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql+psycopg://localhost/food_delivery'
+    rollups.init_app(app)
@@ -0,0 +1,66 @@
+# tests/test_routing.py
+import pytest
+from flask import g
+from sqlalchemy import update
+
+from conftest import auth, seed
+from models import db, Order, Restaurant, User
+
+
+@pytest.fixture
+def routed_app(replica_app):
+    # The same rows on both databases, named after the one they live on
+    seed(replica_app, orders=1)
+    seed(replica_app, orders=1, bind='replica_0')
+    with replica_app.app_context():
+        for bind, name in ((None, 'primary'), ('replica_0', 'replica')):
+            with db.engines[bind].begin() as conn:
+                conn.execute(User.__table__.insert(), [{'id': 2, 'name': 'other', 'username': 'other'}])
+                conn.execute(update(Restaurant.__table__).values(name=name))
+                conn.execute(update(User.__table__).filter_by(id=1).values(name=name))
+                conn.execute(update(Order.__table__).values(status=name.upper()))
+    return replica_app
+
+
+def test_replica_reads_select_from_the_replica(routed_app):
+    client = routed_app.test_client()
+    response = client.get('/order/1', headers=auth(routed_app, 1))
+    assert response.json['order']['status'] == 'REPLICA'
+    history = client.get('/users/orders/1', headers=auth(routed_app, 1)).json
+    assert history['orders'][0]['order']['status'] == 'REPLICA'
+
+
+def test_reads_after_a_flush_use_the_primary(routed_app):
+    with routed_app.test_request_context():
+        g._replica_reads = True
+        assert db.session.get(Order, 1).status == 'REPLICA'
+        db.session.expunge_all()
+        db.session.add(User(name='new', username='new'))
+        db.session.flush()
+        assert db.session.get(Order, 1).status == 'PRIMARY'
+        db.session.rollback()
+
+
+def test_caller_reads_the_primary_after_its_write(routed_app):
+    client = routed_app.test_client()
+    writer, other = auth(routed_app, 1), auth(routed_app, 2)
+    assert client.put('/order/1', json={'status': 'PREPARING'}, headers=writer).status_code == 200
+
+    assert client.get('/order/1', headers=writer).json['order']['status'] == 'PREPARING'
+    assert client.get('/order/1', headers=other).json['order']['status'] == 'REPLICA'
+
+    routed_app.config['DB_READ_YOUR_WRITES_SECONDS'] = 0
+    assert client.get('/order/1', headers=writer).json['order']['status'] == 'REPLICA'
+
+
+def test_catalog_and_identity_builds_use_the_primary(routed_app):
+    client = routed_app.test_client()
+    restaurants = client.get('/restaurants', headers=auth(routed_app, 1)).json['restaurants']
+    assert [restaurant['name'] for restaurant in restaurants] == ['primary']
+    menu = client.get('/dishes/1', headers=auth(routed_app, 1)).json
+    assert menu['restaurant']['name'] == 'primary'
+
+    # The restaurant comes from the order's replica read, the caller from the identity cache
+    response = client.get('/order/1', headers=auth(routed_app, 1)).json
+    assert response['restaurant']['name'] == 'replica'
+    assert response['user']['name'] == 'primary'
@@ -0,0 +1,32 @@
+# tests/test_search.py
+import time
+
+import pytest
+
+from conftest import auth, seed
+
+
+@pytest.fixture
+def east_of_utc(monkeypatch):
+    # Local time ahead of UTC, where a UTC stamp would fall before the sync watermark
+    monkeypatch.setenv('TZ', 'Asia/Kolkata')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_sync_picks_up_a_restaurant_updated_by_another_worker(make_app, east_of_utc):
+    app = make_app(SEARCH_SYNC_SECONDS=0)
+    seed(app)
+    client = app.test_client()
+    assert client.get('/search?q=kitchen', headers=auth(app, 1)).json['results']
+
+    # Another worker's update, which this process's index only sees through sync
+    other = make_app()
+    response = other.test_client().put('/restaurants/1', json={'name': 'Biryani House'},
+                                       headers=auth(other, 1, 'RESTAURANT'))
+    assert response.status_code == 200
+
+    results = client.get('/search?q=biryani', headers=auth(app, 1)).json['results']
+    assert [result['restaurant']['name'] for result in results] == ['Biryani House']
@@ -0,0 +1,55 @@
+# tests/test_serializers.py
+from types import SimpleNamespace
+
+import pytest
+
+from serializers import VARIANT_CACHE_SIZE, Record, Related, Serializer, order_summary, user_order
+
+
+def order(delivery_partner=True):
+    return SimpleNamespace(
+        id=7, total=30.0, status='PAID', created_at='today',
+        restaurant=SimpleNamespace(id=1, name='Kitchen', distance='1 km', mobile='1', address='Road', rating=4.5,
+                                   image_url=None, expected_delivery_time='30 minutes', open_time='9:00 AM',
+                                   close_time='9:00 PM'),
+        delivery_partner=SimpleNamespace(id=2, name='Partner', mobile='2') if delivery_partner else None,
+        dishes_ordered=[SimpleNamespace(dish_id=i, dish_name='Dish {}'.format(i), unit_price=10.0, quantity=1)
+                        for i in (1, 2)])
+
+
+def test_record_serializes_sections_and_missing_relations():
+    data = user_order(order(delivery_partner=False))
+    assert data['order'] == {'total': 30.0, 'status': 'PAID', 'order_date': 'today', 'id': 7}
+    assert data['delivery_partner'] == {'name': None, 'mobile': None, 'id': None}
+    assert data['restaurant']['opens_at'] == '9:00 AM'
+    assert [line['name'] for line in data['dishes']] == ['Dish 1', 'Dish 2']
+
+
+def test_only_keeps_whole_sections_and_single_fields():
+    projected = user_order.only(('delivery_partner.mobile', 'dishes.name', 'order', 'unknown'))
+    assert projected(order()) == {'order': {'total': 30.0, 'status': 'PAID', 'order_date': 'today', 'id': 7},
+                                  'delivery_partner': {'mobile': '2'},
+                                  'dishes': [{'name': 'Dish 1'}, {'name': 'Dish 2'}]}
+    assert user_order.only(('order.id',)) is user_order.only(('order.id',))
+    assert user_order.only(None) is user_order
+
+
+def test_single_and_empty_field_lists_and_function_getters():
+    row = SimpleNamespace(id=1, name='x')
+    assert Serializer(['id'])(row) == {'id': 1}
+    assert Serializer([])(row) == {}
+    assert Record(row=Related(lambda row: row, Serializer([('key', 'name')])))(row) == {'row': {'key': 'x'}}
+    with pytest.raises(ValueError):
+        Serializer(['restaurant.name'])
+
+
+def test_variants_are_keyed_by_known_names_and_bounded():
+    assert user_order.only(('order.id', 'order.nope')) is user_order.only(('order.id',))
+    assert user_order.only(('order.id', 'nope')) is user_order.only(('order.id',))
+    assert list(user_order.only(('restaurant', 'order'))(order())) == ['order', 'restaurant']
+    for position in range(VARIANT_CACHE_SIZE * 4):
+        user_order.only(('order.id', 'junk{}'.format(position)))
+        order_summary.only(('id', 'junk{}'.format(position)))
+    assert len(user_order.variants) <= VARIANT_CACHE_SIZE
+    assert len(order_summary.variants) <= VARIANT_CACHE_SIZE
+    assert len(order_summary.only(('id', 'junk')).keys) == 1